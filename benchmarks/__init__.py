@@ -0,0 +1,14 @@
+"""
+Performance benchmarks of Win9xManager
+
+Times the paths whose speed users notice - snapshot and restore throughput,
+disk image creation, launch config rendering, GUI and command line startup -
+on synthetic disk images, with a stub in place of DOSBox-X (stub/dosbox-x).
+Run from the repository root:
+
+    python -m benchmarks [--quick] [--output results.json]
+
+Results are written as JSON with percentiles of every measurement, and are
+compared with a baseline from an earlier run on the same machine, so a
+regression makes the run fail (see benchmarks.suite).
+"""
@@ -0,0 +1,88 @@
+"""
+Synthetic disk images and a sandboxed manager directory for the benchmarks
+"""
+
+import os
+import shutil
+from pathlib import Path
+
+from win9xman.utils.paths import default_base_dir
+
+MB = 1024 * 1024
+
+# Directory of the stub standing in for DOSBox-X
+STUB_DIR = Path(__file__).resolve().parent / "stub"
+# Cycles per millisecond the stub reaches with the dynamic core
+STUB_CAPACITY = 60000
+
+
+def _data_block(index, compressible):
+    """Get one MB of data that no other block repeats
+
+    Compressible blocks look like text, the others are random, as in the
+    mix of program files and documents of an installed system.
+    """
+    if not compressible:
+        return os.urandom(MB)
+    line = f"block {index:08d} lorem ipsum dolor sit amet, consectetur adipiscing elit\n".encode()
+    return (line * (MB // len(line) + 1))[:MB]
+
+
+def make_sparse_image(path, size_mb, data_mb):
+    """Create a raw image that is mostly holes
+
+    The data is spread over the image one MB at a time, so both the holes
+    and the data ranges are scattered like on a disk after a fresh install.
+
+    Args:
+        path: Image to create
+        size_mb: Size of the image in MB
+        data_mb: MB of data in it
+    """
+    data_mb = min(data_mb, size_mb)
+    stride = size_mb // data_mb if data_mb else 0
+    with open(path, 'wb') as f:
+        f.truncate(size_mb * MB)
+        for index in range(data_mb):
+            f.seek(index * stride * MB)
+            f.write(_data_block(index, compressible=index % 2 == 0))
+
+
+def make_dense_image(path, size_mb):
+    """Create a raw image written from start to end, half of it compressible"""
+    with open(path, 'wb') as f:
+        for index in range(size_mb):
+            f.write(_data_block(index, compressible=index % 2 == 0))
+
+
+def sandbox_environment(work_dir):
+    """Point the manager's runtime and cache directories into the work directory
+
+    Also puts the DOSBox-X stub first on the PATH, with a known speed, for
+    this process and the ones it starts.
+
+    Returns:
+        dict: The environment for child processes
+    """
+    for name in ('XDG_RUNTIME_DIR', 'XDG_CACHE_HOME'):
+        directory = Path(work_dir) / name.lower()
+        directory.mkdir(mode=0o700, exist_ok=True)
+        os.environ[name] = str(directory)
+    os.environ['PATH'] = f"{STUB_DIR}{os.pathsep}{os.environ.get('PATH', '')}"
+    os.environ['FAKE_DOSBOX_CAPACITY'] = str(STUB_CAPACITY)
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = f"{default_base_dir()}{os.pathsep}{env.get('PYTHONPATH', '')}"
+    return env
+
+
+def make_base_dir(work_dir):
+    """Create a manager directory with the templates of the repository
+
+    Returns:
+        Path: The directory
+    """
+    base_dir = Path(work_dir) / "manager"
+    shutil.copytree(default_base_dir() / "templates", base_dir / "templates", dirs_exist_ok=True)
+    (base_dir / "config").mkdir(parents=True, exist_ok=True)
+    return base_dir
@@ -0,0 +1,427 @@
+"""
+The benchmarks, their statistics and the comparison with a baseline
+
+Every benchmark repeats one operation and records a sample per repeat:
+throughput in MB/s of virtual disk for snapshots and restores, latency in
+ms for the rest. Results summarize the samples as percentiles:
+
+    {"version": 1, "created": ..., "host": {...}, "parameters": {...},
+     "results": {"snapshot.dense": {"unit": "MB/s", "higher_is_better": true,
+                                    "n": 3, "min": ..., "p50": ..., "p90": ...,
+                                    "p99": ..., "max": ..., "mean": ...}, ...},
+     "skipped": {"gui_startup": "no display"},
+     "comparison": {...}}
+
+A run is compared with the baseline, when one was saved with the same
+parameters: a median more than the tolerance worse than the baseline's is a
+regression, and makes the run exit with status 1. Baselines only mean
+something on the machine that made them, so benchmarks/baseline.json is not
+kept in git.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+from benchmarks import fixtures
+from win9xman.core import savestate, snapshot
+from win9xman.core.calibrate import CORES, CPU_TYPES, MIN_CYCLES, Calibrator
+from win9xman.core.disk import make_hdd_image
+from win9xman.core.resolver import resolve_emulator
+from win9xman.utils.config import create_temp_config, render_autoexec
+from win9xman.utils.paths import Layout, default_base_dir
+from win9xman.utils.profiles import get_profile, save_profile
+
+RESULTS_VERSION = 1
+DEFAULT_BASELINE = Path(__file__).resolve().parent / "baseline.json"
+DEFAULT_TOLERANCE = 0.2  # 20% slower than the baseline is a regression
+PERCENTILES = (50, 90, 99)
+MB = fixtures.MB
+
+# Parameters of a full run, and of a --quick one
+FULL = {'size_mb': 2048, 'data_mb': 256, 'repeats': 3, 'iterations': 200, 'calibrate_seconds': 0.5}
+QUICK = {'size_mb': 256, 'data_mb': 32, 'repeats': 2, 'iterations': 50, 'calibrate_seconds': 0.2}
+
+
+class SkipBenchmark(Exception):
+    """The benchmark can't run here, e.g. without a display"""
+
+
+def percentile(samples, p):
+    """Get a percentile of samples, interpolating between the closest two"""
+    ordered = sorted(samples)
+    rank = (len(ordered) - 1) * p / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def summarize(samples, unit, higher_is_better):
+    """Reduce the samples of a benchmark to its statistics"""
+    summary = {'unit': unit, 'higher_is_better': higher_is_better, 'n': len(samples),
+               'min': min(samples), 'max': max(samples), 'mean': sum(samples) / len(samples)}
+    for p in PERCENTILES:
+        summary[f"p{p}"] = percentile(samples, p)
+    return {key: round(value, 3) if isinstance(value, float) else value for key, value in summary.items()}
+
+
+def timed(func, *args, **kwargs):
+    """Call a function
+
+    Returns:
+        tuple: (seconds it took, its return value)
+    """
+    started = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - started, result
+
+
+class Context:
+    """What the benchmarks work with
+
+    Args:
+        work_dir: Directory for the images and everything the benchmarks write
+        parameters: Sizes and counts, see FULL
+        compression: Snapshot compression codec
+    """
+
+    def __init__(self, work_dir, parameters, compression):
+        self.work_dir = Path(work_dir)
+        self.parameters = parameters
+        self.compression = compression
+        self.env = fixtures.sandbox_environment(self.work_dir)
+        self.layout = Layout(fixtures.make_base_dir(self.work_dir))
+        self.images = {}
+
+    def image(self, kind):
+        """Get a synthetic image, sparse or dense, made on first use"""
+        if kind not in self.images:
+            path = self.work_dir / f"{kind}.img"
+            log(f"Creating {self.parameters['size_mb']} MB {kind} image")
+            if kind == "sparse":
+                fixtures.make_sparse_image(path, self.parameters['size_mb'], self.parameters['data_mb'])
+            else:
+                fixtures.make_dense_image(path, self.parameters['size_mb'])
+            self.images[kind] = path
+        return self.images[kind]
+
+
+def log(message):
+    """Report progress on stderr, stdout may carry the results"""
+    print(message, file=sys.stderr, flush=True)
+
+
+def bench_snapshots(context):
+    """Snapshot and restore throughput on the sparse and the dense image"""
+    results = {}
+    size_mb = context.parameters['size_mb']
+    for kind in ("sparse", "dense"):
+        image = context.image(kind)
+        snapshot_rates, restore_rates = [], []
+        for repeat in range(context.parameters['repeats']):
+            # A fresh directory each time, or deduplication would skip the work
+            snapshot_dir = context.work_dir / "snapshots" / f"{kind}-{repeat}"
+            snapshot_dir.mkdir(parents=True)
+            restored = context.work_dir / f"restored-{kind}.img"
+            try:
+                seconds, snapshot_file = timed(snapshot.create_snapshot, image, snapshot_dir,
+                                               f"bench-{repeat}", compression=context.compression)
+                snapshot_rates.append(size_mb / seconds)
+                seconds, _ = timed(snapshot.restore_snapshot, snapshot_file, restored)
+                restore_rates.append(size_mb / seconds)
+            finally:
+                shutil.rmtree(snapshot_dir, ignore_errors=True)
+                for path in context.work_dir.glob(f"restored-{kind}.img*"):
+                    path.unlink()
+        results[f"snapshot.{kind}"] = summarize(snapshot_rates, "MB/s", True)
+        results[f"restore.{kind}"] = summarize(restore_rates, "MB/s", True)
+    return results
+
+
+def bench_create_image(context):
+    """Time to create a blank FAT32 disk image"""
+    samples = []
+    for repeat in range(context.parameters['repeats']):
+        path = context.work_dir / f"created-{repeat}.img"
+        try:
+            seconds, _ = timed(make_hdd_image, path, context.parameters['size_mb'])
+            samples.append(1000 * seconds)
+        finally:
+            if path.exists():
+                path.unlink()
+    return {'create_image': summarize(samples, "ms", False)}
+
+
+def bench_temp_config(context):
+    """Launch config latency, rendered (cache miss) and reused (cache hit)"""
+    layout = context.layout
+    autoexec = render_autoexec(layout.templates_dir, "win98", layout.hdd_image("win98"),
+                               layout.drive_dir("win98"))
+
+    def render(content):
+        return create_temp_config(layout.dosbox_conf, content, layout.templates_dir, layout.base_dir)
+
+    # Also creates the base config, which only the first launch does
+    render(autoexec)
+
+    misses, hits = [], []
+    for iteration in range(context.parameters['iterations']):
+        seconds, _ = timed(render, f"{autoexec}\nrem {iteration} {time.time_ns()}")
+        misses.append(1000 * seconds)
+        seconds, _ = timed(render, autoexec)
+        hits.append(1000 * seconds)
+    return {'temp_config.miss': summarize(misses, "ms", False),
+            'temp_config.hit': summarize(hits, "ms", False)}
+
+
+def _run_python(context, code_or_args, env=None):
+    """Time a Python process started in the sandbox, in ms
+
+    Args:
+        env: Optional variables to add to the environment of the sandbox
+    """
+    command = [sys.executable] + code_or_args
+    seconds, result = timed(subprocess.run, command, env=dict(context.env, **(env or {})), cwd=default_base_dir(),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"{' '.join(command)} failed: {result.stderr.strip()}")
+    return 1000 * seconds
+
+
+def bench_cli_startup(context):
+    """Time for the command line to start, resolve DOSBox-X and exit"""
+    args = ["-m", "win9xman", "--base-dir", str(context.layout.base_dir), "emulator"]
+    # The first run probes the stub and fills the cache, as a first start does
+    _run_python(context, args)
+    samples = [_run_python(context, args) for _ in range(context.parameters['repeats'] * 3)]
+    return {'cli_startup': summarize(samples, "ms", False)}
+
+
+def bench_launch(context):
+    """Time launches through the command line, booting, saving a state and resuming it
+
+    The stub stands in for DOSBox-X, so this is the overhead of the manager:
+    config rendering, locking, the process supervision and, when saving a
+    state, hashing the image.
+    """
+    layout = context.layout
+    hdd_image = layout.raw_image("win98")
+    hdd_image.parent.mkdir(exist_ok=True)
+    make_hdd_image(hdd_image, context.parameters['size_mb'])
+    args = ["-m", "win9xman", "--base-dir", str(layout.base_dir), "--quiet", "launch"]
+
+    cold, save, resume = [], [], []
+    try:
+        # The first launch probes the stub and renders the base config
+        _run_python(context, args + ["--cold"])
+        for repeat in range(context.parameters['repeats']):
+            cold.append(_run_python(context, args + ["--cold"]))
+            save.append(_run_python(context, args + ["--save-state"], {'FAKE_DOSBOX_SAVE': "1"}))
+            if savestate.current_state(hdd_image, "win98") is None:
+                raise RuntimeError("No state was recorded from the save file the stub wrote")
+            resume.append(_run_python(context, args))
+    finally:
+        hdd_image.unlink()
+    return {'launch.cold': summarize(cold, "ms", False),
+            'launch.save_state': summarize(save, "ms", False),
+            'launch.resume': summarize(resume, "ms", False)}
+
+
+def check_profile(profile, target_load):
+    """Make sure a calibrated profile fits the speed of the stub
+
+    Raises:
+        RuntimeError: If it doesn't
+    """
+    cycles = (profile or {}).get('cycles', '').split()
+    expected = ["max", f"{round(100 * target_load)}%", "limit"]
+    if cycles[:3] != expected or len(cycles) != 4 or not cycles[3].isdigit():
+        raise RuntimeError(f"Calibrated cycles {profile and profile.get('cycles')!r} aren't 'max N% limit N'")
+    # The stub takes a full core at its capacity, so the limit is below it
+    if not MIN_CYCLES <= int(cycles[3]) < fixtures.STUB_CAPACITY:
+        raise RuntimeError(f"Calibrated limit {cycles[3]} is outside {MIN_CYCLES}-{fixtures.STUB_CAPACITY}")
+    # Its dynamic core is about three times as fast as the others; the CPU
+    # types are too close to tell apart reliably
+    if profile.get('core') != CORES[0] or profile.get('cputype') not in CPU_TYPES:
+        raise RuntimeError(f"Calibrated {profile.get('core')} {profile.get('cputype')} "
+                           f"instead of {CORES[0]} and one of {', '.join(CPU_TYPES)}")
+
+
+def bench_calibrate(context):
+    """Time a short calibration against the stub, checking the profile it saves"""
+    emulator = resolve_emulator(str(fixtures.STUB_DIR / "dosbox-x"), refresh=True)
+    if emulator is None:
+        raise RuntimeError("The DOSBox-X stub can't be run")
+
+    samples = []
+    for repeat in range(context.parameters['repeats']):
+        calibrator = Calibrator(emulator, context.layout, context.parameters['calibrate_seconds'])
+        seconds, (options, details) = timed(calibrator.calibrate)
+        samples.append(1000 * seconds)
+        save_profile(context.layout.profiles_conf, "bench", options, details)
+        check_profile(get_profile(context.layout.profiles_conf, "bench"), calibrator.target_load)
+    return {'calibrate': summarize(samples, "ms", False)}
+
+
+GUI_STARTUP = """
+import sys, tkinter as tk
+from win9xman.ui.manager import Win9xManager
+root = tk.Tk()
+Win9xManager(root, base_dir=sys.argv[1])
+root.update()
+root.destroy()
+"""
+
+
+def bench_gui_startup(context):
+    """Time until the manager window is drawn, interpreter start included"""
+    if sys.platform.startswith("linux") and not (os.environ.get("DISPLAY") or os.environ.get("WAYLAND_DISPLAY")):
+        raise SkipBenchmark("no display")
+    try:
+        import tkinter  # noqa: F401
+    except ImportError:
+        raise SkipBenchmark("Tkinter is not installed")
+
+    args = ["-c", GUI_STARTUP, str(context.layout.base_dir)]
+    samples = [_run_python(context, args) for _ in range(context.parameters['repeats'] * 3)]
+    return {'gui_startup': summarize(samples, "ms", False)}
+
+
+BENCHMARKS = {
+    'snapshots': bench_snapshots,
+    'create_image': bench_create_image,
+    'temp_config': bench_temp_config,
+    'cli_startup': bench_cli_startup,
+    'launch': bench_launch,
+    'calibrate': bench_calibrate,
+    'gui_startup': bench_gui_startup,
+}
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """Compare the medians of a run with those of a baseline
+
+    Returns:
+        dict: Per benchmark in both, the two medians, the relative change
+        (positive is better) and whether it is a regression
+    """
+    comparison = {}
+    for name, result in results['results'].items():
+        base = baseline['results'].get(name)
+        if not base or not base['p50']:
+            continue
+        change = (result['p50'] - base['p50']) / base['p50']
+        if not result['higher_is_better']:
+            change = -change
+        comparison[name] = {'baseline': base['p50'], 'current': result['p50'], 'unit': result['unit'],
+                            'change': round(change, 3), 'regressed': change < -tolerance}
+    return comparison
+
+
+def run(context, selected=None):
+    """Run the benchmarks
+
+    Args:
+        context: The Context
+        selected: Names of the benchmarks to run, all by default
+
+    Returns:
+        dict: The results, as described in the module docstring
+    """
+    results = {
+        'version': RESULTS_VERSION,
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'host': {'node': platform.node(), 'machine': platform.machine(), 'system': platform.platform(),
+                 'python': platform.python_version(), 'cpus': os.cpu_count()},
+        'parameters': dict(context.parameters, compression=context.compression),
+        'results': {},
+        'skipped': {},
+    }
+    for name, bench in BENCHMARKS.items():
+        if selected and name not in selected:
+            continue
+        log(f"Running {name}")
+        try:
+            results['results'].update(bench(context))
+        except SkipBenchmark as e:
+            log(f"Skipped {name}: {e}")
+            results['skipped'][name] = str(e)
+    return results
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks",
+                                     description="Benchmark Win9xManager and compare with a baseline")
+    parser.add_argument("--quick", action="store_true",
+                        help="Small images and few repeats, for a check in under a minute")
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), metavar="NAME",
+                        help=f"Benchmarks to run: {', '.join(BENCHMARKS)} (default: all)")
+    parser.add_argument("--size-mb", type=int, help="Size of the synthetic images (default: 2048, quick: 256)")
+    parser.add_argument("--repeats", type=int, help="Repeats of the slow benchmarks (default: 3, quick: 2)")
+    parser.add_argument("--compression", default="auto", help="Snapshot compression codec (default: auto)")
+    parser.add_argument("--work-dir", help="Directory for the images, on the file system to measure "
+                                           "(default: a new temporary directory)")
+    parser.add_argument("-o", "--output", help="File to write the results to instead of standard output")
+    parser.add_argument("--baseline", default=str(DEFAULT_BASELINE),
+                        help="Baseline to compare with (default: benchmarks/baseline.json)")
+    parser.add_argument("--save-baseline", action="store_true", help="Store the results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=100 * DEFAULT_TOLERANCE, metavar="PERCENT",
+                        help="Slowdown flagged as a regression (default: %(default).0f)")
+    return parser
+
+
+def main(argv=None):
+    """Run the benchmarks from the command line
+
+    Returns:
+        int: 1 if a regression was found, 0 otherwise
+    """
+    args = build_parser().parse_args(argv)
+    parameters = dict(QUICK if args.quick else FULL)
+    if args.size_mb:
+        parameters['size_mb'] = args.size_mb
+        parameters['data_mb'] = max(1, args.size_mb // 8)
+    if args.repeats:
+        parameters['repeats'] = args.repeats
+
+    work_dir = Path(tempfile.mkdtemp(prefix="win9xman-bench-", dir=args.work_dir))
+    try:
+        results = run(Context(work_dir, parameters, args.compression), args.only)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    status = 0
+    baseline_path = Path(args.baseline)
+    if baseline_path.exists():
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        if baseline.get('parameters') != results['parameters']:
+            log(f"Not comparing with {baseline_path}: it was made with other parameters")
+        else:
+            results['comparison'] = compare(results, baseline, args.tolerance / 100)
+            for name, entry in sorted(results['comparison'].items()):
+                flag = "REGRESSION" if entry['regressed'] else "ok"
+                log(f"{name}: {entry['current']} {entry['unit']} vs {entry['baseline']} "
+                    f"({100 * entry['change']:+.1f}%) {flag}")
+            if any(entry['regressed'] for entry in results['comparison'].values()):
+                status = 1
+
+    text = json.dumps(results, indent=2) + "\n"
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        sys.stdout.write(text)
+    if args.save_baseline:
+        with open(baseline_path, 'w') as f:
+            f.write(text)
+        log(f"Baseline saved to {baseline_path}")
+    return status
@@ -1,45 +1,26 @@
 #!/usr/bin/env python3
 """
 Windows 9x Manager - A GUI tool to launch Windows 95/98 in DOSBox-X
+
+Run without arguments to open the GUI, or with a command for the command
+line interface (see win9xman.py --help). Tkinter is only imported for the GUI.
 """
 
-import tkinter as tk
-from tkinter import ttk, messagebox
 import os
 import sys
 
 # Aggiungi la directory corrente al path per importare i moduli locali
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
-from win9xman.ui.manager import Win9xManager
-from win9xman.utils.system import check_requirements
-
 def main():
     """Main entry point for the application"""
-    # Check if required dependencies are installed
-    if not check_requirements():
-        return
-        
-    root = tk.Tk()
-    root.title("Windows 9x Manager")
-    
-    # Use system theme
-    try:
-        ttk.Style().theme_use('clam')  # A decent cross-platform theme
-    except tk.TclError:
-        pass  # If theme not available, use default
-    
-    # Create the app
-    app = Win9xManager(root)
-    
-    # Add program icon if available
-    icon_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "assets", "icon.png")
-    if os.path.exists(icon_path):
-        img = tk.PhotoImage(file=icon_path)
-        root.tk.call('wm', 'iconphoto', root._w, img)
+    if len(sys.argv) > 1:
+        from win9xman.cli import main as cli_main
+        return cli_main()
     
-    # Start the main loop
-    root.mainloop()
+    from win9xman.ui.app import main as gui_main
+    gui_main()
+    return 0
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,15 @@
+"""
+Entry point for python -m win9xman: the command line interface, or the GUI
+when no command is given
+"""
+
+import sys
+
+if len(sys.argv) > 1:
+    from win9xman.cli import main
+
+    sys.exit(main())
+else:
+    from win9xman.ui.app import main
+
+    main()
@@ -0,0 +1,488 @@
+"""
+Command line interface of Win9xManager
+
+Runs the disk and snapshot operations of the manager without a display, for
+scripts, cron jobs and headless servers. Tkinter is never imported here.
+
+Examples:
+    win9xman.py create-image --size 2000 --vhd
+    win9xman.py --os win95 snapshot "before drivers"
+    win9xman.py restore latest
+    win9xman.py launch --iso iso/win98.iso
+    win9xman.py launch --save-state
+    win9xman.py calibrate --target-load 70
+"""
+
+import argparse
+import subprocess
+import sys
+import time
+
+from win9xman.core import journal, retention, savestate, snapshot, verify, vhd
+from win9xman.core.calibrate import BENCHMARK_SECONDS, TARGET_LOAD, Calibrator
+from win9xman.core.disk import make_hdd_image
+from win9xman.core.emulator import ERROR, WARNING, EmulatorProcess, Supervisor
+from win9xman.core.fatfs import FatError
+from win9xman.core.lock import ImageLock, run_locked
+from win9xman.core.resolver import resolve_emulator
+from win9xman.utils.config import create_temp_config, load_settings, render_autoexec
+from win9xman.utils.paths import OS_NAMES, OS_TITLES, Layout
+from win9xman.utils.profiles import NO_PROFILE, host_profile_name, save_profile
+from win9xman.utils.system import check_requirements
+
+# Errors reported as a message and exit status 1 instead of a traceback
+EXPECTED_ERRORS = (OSError, ValueError, FatError, vhd.VhdError, verify.IntegrityError,
+                   subprocess.SubprocessError)
+
+PROGRESS_INTERVAL = 0.5  # seconds between two progress updates
+
+
+class Progress:
+    """Progress callback printing a percentage on stderr
+
+    Args:
+        title: What is being done
+        total: Expected number of bytes, 0 if unknown
+        enabled: Print anything at all; off for --quiet and when stderr
+            isn't a terminal
+    """
+
+    def __init__(self, title, total=0, enabled=True):
+        self.title = title
+        self.total = total
+        self.enabled = enabled
+        self.done = 0
+        self._shown = 0.0
+
+    def __call__(self, nbytes):
+        self.done += nbytes
+        now = time.monotonic()
+        if self.enabled and now - self._shown >= PROGRESS_INTERVAL:
+            self._shown = now
+            self._print()
+
+    def _print(self, end=""):
+        text = f"{self.done / (1024 * 1024):.1f} MB"
+        if self.total:
+            text = f"{min(100.0, 100.0 * self.done / self.total):5.1f}% ({text})"
+        print(f"\r{self.title}: {text}", end=end, file=sys.stderr, flush=True)
+
+    def finish(self):
+        """End the progress line"""
+        if self.enabled and self._shown:
+            self._print(end="\n")
+
+
+def _progress(args, title, total=0):
+    """Create the progress callback of a command"""
+    return Progress(title, total, enabled=not args.quiet and sys.stderr.isatty())
+
+
+def _find_snapshot(snapshot_dir, name):
+    """Look a snapshot record up by name, or 'latest'
+
+    Besides the full name, the end of a name (e.g. without its timestamp)
+    or the note of a snapshot find it, if only one snapshot matches.
+
+    Raises:
+        ValueError: If there is no such snapshot, or several match
+    """
+    with snapshot.open_catalog(snapshot_dir) as catalog:
+        if name == 'latest':
+            records = catalog.list(order_by='created', descending=True)
+            record = records[0] if records else None
+        else:
+            record = catalog.get(name)
+            if record is None:
+                matches = [candidate for candidate in catalog.list(search=name)
+                           if candidate['name'].endswith(name) or candidate['note'] == name]
+                if len(matches) > 1:
+                    raise ValueError(f"{name} matches several snapshots: "
+                                     f"{', '.join(match['name'] for match in matches)}")
+                record = matches[0] if matches else None
+    if record is None:
+        raise ValueError(f"No snapshot named {name} in {snapshot_dir}")
+    return record
+
+
+def cmd_create_image(args, layout, settings):
+    """Create a blank disk image"""
+    hdd_image = layout.raw_image(args.os)
+    if args.vhd:
+        hdd_image = hdd_image.with_suffix(vhd.VHD_SUFFIX)
+    existing = [path for path in (layout.raw_image(args.os), layout.raw_image(args.os).with_suffix(vhd.VHD_SUFFIX))
+                if path.exists()]
+    if existing and not args.force:
+        raise FileExistsError(f"{existing[0]} already exists, use --force to replace it")
+
+    for path in existing:
+        run_locked(path, path.unlink)
+
+    progress = _progress(args, "Creating disk image", args.size * 1024 * 1024)
+    make_hdd_image(hdd_image, args.size, progress)
+    progress.finish()
+    print(hdd_image)
+    return 0
+
+
+def cmd_snapshot(args, layout, settings):
+    """Snapshot the disk image"""
+    hdd_image = layout.hdd_image(args.os)
+    snapshot_dir = layout.snapshot_dir(args.os)
+    if not hdd_image.exists():
+        raise FileNotFoundError(f"{hdd_image} not found")
+
+    progress = _progress(args, "Creating snapshot", vhd.disk_size(hdd_image))
+    # Locked, so a running DOSBox-X can't change the image while it is read
+    snapshot_file = run_locked(
+        hdd_image, snapshot.create_snapshot,
+        hdd_image, snapshot_dir, snapshot.snapshot_file_name(args.name),
+        parent=snapshot.latest_manifest(snapshot_dir),
+        compression=settings.get('snapshots', 'compression'),
+        workers=settings.getint('snapshots', 'workers'),
+        reflink=settings.getboolean('snapshots', 'reflink'),
+        progress=progress, note=args.note or args.name)
+    progress.finish()
+    print(snapshot_file)
+
+    if settings.getboolean('retention', 'auto_prune'):
+        report = retention.apply_retention(snapshot_dir, retention.RetentionPolicy.from_settings(settings))
+        for name in report['pruned']:
+            print(f"Pruned {name}", file=sys.stderr)
+    return 0
+
+
+def cmd_snapshots(args, layout, settings):
+    """List the snapshots, newest first"""
+    with snapshot.open_catalog(layout.snapshot_dir(args.os)) as catalog:
+        records = catalog.list(order_by='created', descending=True, search=args.search)
+    for record in records:
+        print("\t".join([record['name'], (record['created'] or '').replace('T', ' '),
+                         str(record['image_size'] or 0), str(record['stored_size'] or 0),
+                         record['note'] or '']))
+    return 0
+
+
+def cmd_restore(args, layout, settings):
+    """Replace the disk image with a snapshot"""
+    hdd_image = layout.hdd_image(args.os)
+    snapshot_dir = layout.snapshot_dir(args.os)
+    record = _find_snapshot(snapshot_dir, args.name)
+
+    verify_first = settings.getboolean('snapshots', 'verify_before_restore') and not args.no_verify
+    progress = _progress(args, "Restoring snapshot", (record['image_size'] or 0) * (2 if verify_first else 1))
+    run_locked(hdd_image, snapshot.restore_snapshot, snapshot_dir / record['file'], hdd_image,
+               workers=settings.getint('snapshots', 'workers'), progress=progress, verify=verify_first)
+    progress.finish()
+    print(f"Restored {record['name']} to {hdd_image}")
+    return 0
+
+
+def cmd_verify(args, layout, settings):
+    """Check the disk image or a snapshot for corruption"""
+    workers = settings.getint('snapshots', 'workers')
+
+    if args.snapshot:
+        snapshot_dir = layout.snapshot_dir(args.os)
+        record = _find_snapshot(snapshot_dir, args.snapshot)
+        what = f"Snapshot {record['name']}"
+        progress = _progress(args, "Verifying snapshot", record['image_size'] or 0)
+        bad_blocks = snapshot.verify_snapshot(snapshot_dir / record['file'], workers, progress)
+    else:
+        hdd_image = layout.hdd_image(args.os)
+        what = str(hdd_image)
+        try:
+            tree = verify.read_tree(verify.tree_path(hdd_image))
+        except (OSError, ValueError):
+            tree = None
+
+        # The seal is only meaningful until Windows writes to the image again
+        if tree is None or tree.get('mtime') != hdd_image.stat().st_mtime:
+            if not args.seal:
+                print(f"{hdd_image} has no current integrity seal; use --seal to seal it now",
+                      file=sys.stderr)
+                return 1
+            progress = _progress(args, "Sealing disk image", hdd_image.stat().st_size)
+            run_locked(hdd_image, verify.seal_image, hdd_image, workers, progress)
+            progress.finish()
+            print(f"{hdd_image} sealed")
+            return 0
+
+        progress = _progress(args, "Verifying disk image", hdd_image.stat().st_size)
+        bad_blocks = run_locked(hdd_image, verify.verify_image, hdd_image, tree, workers=workers,
+                                progress=progress)
+    progress.finish()
+
+    if bad_blocks:
+        print(f"{what} is corrupt, bad blocks: {', '.join(str(block) for block in bad_blocks)}",
+              file=sys.stderr)
+        return 1
+    print(f"{what} is intact")
+    return 0
+
+
+def _autoexec(args, layout, resume=False):
+    """Build the [autoexec] section for the launch and config commands"""
+    if args.install and not args.iso:
+        raise ValueError("--install needs --iso")
+    return render_autoexec(layout.templates_dir, args.os, layout.hdd_image(args.os),
+                           layout.drive_dir(args.os), args.iso, install=args.install, resume=resume)
+
+
+def _resume_state(args, layout):
+    """Get the save state a plain launch resumes from, or None"""
+    if args.iso or args.cold or getattr(args, 'save_state', False):
+        return None
+    return savestate.current_state(layout.hdd_image(args.os), args.os)
+
+
+def cmd_config(args, layout, settings):
+    """Write the DOSBox-X config a launch would use"""
+    state = _resume_state(args, layout)
+    overrides = savestate.savefile_overrides(state) if state else None
+    launch_conf = create_temp_config(layout.dosbox_conf, _autoexec(args, layout, resume=state is not None),
+                                     layout.templates_dir, layout.base_dir, overrides,
+                                     settings.get('performance', 'profile'))
+    content = launch_conf.read_text()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(content)
+    else:
+        sys.stdout.write(content)
+    return 0
+
+
+def cmd_launch(args, layout, settings):
+    """Run DOSBox-X in the foreground, passing its output through"""
+    emulator = check_requirements(configured=settings.get('emulator', 'path'))
+    if emulator is None:
+        return 1
+    hdd_image = layout.hdd_image(args.os)
+    if not hdd_image.exists():
+        raise FileNotFoundError(f"{hdd_image} not found, create it with create-image first")
+
+    instances = settings['instances']
+    placement = Supervisor().placement(instances.get('cpu_affinity'), instances.getint('cpus_per_instance'),
+                                       instances.getint('nice'), instances.get('ionice'))
+    state = _resume_state(args, layout)
+    autoexec = _autoexec(args, layout, resume=state is not None)
+
+    overrides, extra_args = None, []
+    if state:
+        overrides, extra_args, loaded = savestate.resume_options(emulator, state)
+        if not loaded:
+            print("This DOSBox-X can't load states at startup: choose Load State in its menu to resume",
+                  file=sys.stderr)
+    elif args.save_state:
+        capture, started = savestate.begin_capture(hdd_image)
+        overrides = savestate.savefile_overrides(capture)
+        print("Choose Save State in the DOSBox-X menu at the desktop, then quit DOSBox-X right away",
+              file=sys.stderr)
+
+    with ImageLock(hdd_image) as lock:
+        launch_conf = create_temp_config(layout.dosbox_conf, autoexec, layout.templates_dir, layout.base_dir,
+                                         overrides, settings.get('performance', 'profile'))
+        process = EmulatorProcess(OS_TITLES[args.os], emulator.command_line("-conf", launch_conf, *extra_args),
+                                  placement=placement,
+                                  pass_fds=(lock.fileno(),) if lock.fileno() is not None else ())
+        process.start()
+
+        shown = 0
+        try:
+            while True:
+                ended = process.wait(0.2)
+                lines, shown = process.lines_since(shown)
+                for level, text in lines:
+                    print(text, file=sys.stderr if level in (ERROR, WARNING) else sys.stdout, flush=True)
+                if ended:
+                    break
+        except KeyboardInterrupt:
+            process.terminate()
+            process.wait()
+
+        # Hashed before the image is unlocked, so the record matches the state
+        if args.save_state and not process.error:
+            progress = _progress(args, "Recording saved state", hdd_image.stat().st_size)
+            state = savestate.finish_capture(hdd_image, args.os, started,
+                                             settings.getint('snapshots', 'workers'), progress)
+            progress.finish()
+            print(f"Saved state {state}" if state else "No state was saved", file=sys.stderr)
+
+    if process.error:
+        raise process.error
+    print(f"DOSBox-X exited with status {process.returncode} after {process.elapsed():.0f}s", file=sys.stderr)
+    return process.returncode
+
+
+def cmd_state(args, layout, settings):
+    """Show or remove the save state launches resume from"""
+    hdd_image = layout.hdd_image(args.os)
+    if args.drop:
+        run_locked(hdd_image, savestate.drop_state, hdd_image)
+        return 0
+
+    info = savestate.read_info(hdd_image)
+    progress = _progress(args, "Hashing disk image", hdd_image.stat().st_size if hdd_image.exists() else 0)
+    state = savestate.current_state(hdd_image, args.os, rehash=args.check,
+                                    workers=settings.getint('snapshots', 'workers'), progress=progress)
+    progress.finish()
+    if state is None:
+        if info:
+            print(f"The saved state of {hdd_image} was stale and has been removed", file=sys.stderr)
+        else:
+            print(f"{hdd_image} has no saved state, launch --save-state captures one", file=sys.stderr)
+        return 1
+    print(f"State: {state}")
+    print(f"Captured: {info['captured'].replace('T', ' ')}")
+    print(f"Disk hash: {info['root']}")
+    return 0
+
+
+def cmd_emulator(args, layout, settings):
+    """Show the DOSBox-X installation launches use"""
+    configured = settings.get('emulator', 'path')
+    emulator = resolve_emulator(configured, refresh=args.refresh)
+    if emulator is None:
+        check_requirements(configured=configured)
+        return 1
+    print(f"Kind: {emulator.kind}")
+    print(f"Command: {' '.join(emulator.command)}")
+    print(f"Version: {emulator.version or 'unknown'}")
+    print(f"Options: {' '.join('-' + option for option in emulator.options)}")
+    return 0
+
+
+def cmd_calibrate(args, layout, settings):
+    """Find the best CPU options for this host and save them as a profile"""
+    emulator = check_requirements(configured=settings.get('emulator', 'path'))
+    if emulator is None:
+        return 1
+    if not 0 < args.target_load <= 100:
+        raise ValueError("--target-load must be between 1 and 100")
+
+    name = args.name or settings.get('performance', 'profile')
+    if name in ('', NO_PROFILE):
+        name = host_profile_name()
+
+    def show(measurement):
+        if not args.quiet:
+            print(measurement, file=sys.stderr)
+
+    calibrator = Calibrator(emulator, layout, args.duration, args.target_load / 100, progress=show)
+    options, details = calibrator.calibrate()
+    save_profile(layout.profiles_conf, name, options, details)
+
+    print(f"[{name}]")
+    for option, value in options.items():
+        print(f"{option} = {value}")
+    return 0
+
+
+def _common_options(defaults=True):
+    """Create the parser of the options accepted before and after the command
+
+    The subcommands must not set defaults of their own, or they would
+    override the options given before the command.
+    """
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--os", choices=OS_NAMES, default="win98" if defaults else argparse.SUPPRESS,
+                        help="Windows version to work on (default: win98)")
+    common.add_argument("--base-dir", default=None if defaults else argparse.SUPPRESS,
+                        help="Manager directory (default: the one of win9xman.py)")
+    common.add_argument("-q", "--quiet", action="store_true", default=False if defaults else argparse.SUPPRESS,
+                        help="Don't show progress")
+    return common
+
+
+def build_parser():
+    """Create the argument parser with one subcommand per operation"""
+    common = _common_options(defaults=False)
+    parser = argparse.ArgumentParser(prog="win9xman", parents=[_common_options()],
+                                     description="Manage Windows 9x installations in DOSBox-X. "
+                                                 "Run without a command to open the GUI.")
+    commands = parser.add_subparsers(dest="command", required=True, metavar="COMMAND")
+
+    command = commands.add_parser("create-image", parents=[common], help="Create a blank FAT32 disk image")
+    command.add_argument("--size", type=int, default=2000, help="Size in MB (default: 2000)")
+    command.add_argument("--vhd", action="store_true", help="Create a dynamic VHD instead of a raw image")
+    command.add_argument("--force", action="store_true", help="Replace an existing disk image")
+    command.set_defaults(func=cmd_create_image)
+
+    command = commands.add_parser("snapshot", parents=[common], help="Snapshot the disk image")
+    command.add_argument("name", help="Name of the snapshot")
+    command.add_argument("--note", help="Note stored with the snapshot (default: the name)")
+    command.set_defaults(func=cmd_snapshot)
+
+    command = commands.add_parser("snapshots", parents=[common],
+                                  help="List snapshots: name, created, size, stored size, note")
+    command.add_argument("--search", help="Only list snapshots whose name or note contains this text")
+    command.set_defaults(func=cmd_snapshots)
+
+    command = commands.add_parser("restore", parents=[common], help="Restore a snapshot to the disk image")
+    command.add_argument("name", help="Snapshot name as listed by snapshots, its end or note if unique, or latest")
+    command.add_argument("--no-verify", action="store_true", help="Don't check the snapshot first")
+    command.set_defaults(func=cmd_restore)
+
+    command = commands.add_parser("verify", parents=[common], help="Check the disk image or a snapshot")
+    command.add_argument("--snapshot", metavar="NAME", help="Check this snapshot, or latest")
+    command.add_argument("--seal", action="store_true", help="Seal the disk image if it has no current seal")
+    command.set_defaults(func=cmd_verify)
+
+    for name, func, help_text in (("launch", cmd_launch, "Run Windows in DOSBox-X"),
+                                  ("config", cmd_config, "Print the DOSBox-X config of a launch")):
+        command = commands.add_parser(name, parents=[common], help=help_text)
+        command.add_argument("--iso", help="ISO image to mount as drive D")
+        command.add_argument("--install", action="store_true", help="Run Windows setup from the ISO")
+        command.add_argument("--cold", action="store_true", help="Boot even if a saved state could be resumed")
+        if name == "launch":
+            command.add_argument("--save-state", action="store_true",
+                                 help="Boot, then record the state saved in DOSBox-X for later launches")
+        if name == "config":
+            command.add_argument("-o", "--output", help="File to write instead of standard output")
+        command.set_defaults(func=func)
+
+    command = commands.add_parser("state", parents=[common], help="Show the saved state launches resume from")
+    command.add_argument("--check", action="store_true",
+                         help="If the disk image file changed, hash it to see if its contents did")
+    command.add_argument("--drop", action="store_true", help="Remove the saved state")
+    command.set_defaults(func=cmd_state)
+
+    command = commands.add_parser("calibrate", parents=[common],
+                                  help="Benchmark DOSBox-X and save the best CPU options as a profile")
+    command.add_argument("--name", help="Profile name (default: the profile setting, or the host name)")
+    command.add_argument("--target-load", type=float, default=100 * TARGET_LOAD, metavar="PERCENT",
+                         help="Highest share of a host core DOSBox-X may use (default: %(default).0f)")
+    command.add_argument("--duration", type=float, default=BENCHMARK_SECONDS, metavar="SECONDS",
+                         help="Length of each benchmark run (default: %(default).0f)")
+    command.set_defaults(func=cmd_calibrate)
+
+    command = commands.add_parser("emulator", parents=[common], help="Show the DOSBox-X installation used")
+    command.add_argument("--refresh", action="store_true", help="Probe DOSBox-X again instead of using the cache")
+    command.set_defaults(func=cmd_emulator)
+
+    return parser
+
+
+def main(argv=None):
+    """Run a command
+
+    Returns:
+        int: Exit status
+    """
+    args = build_parser().parse_args(argv)
+    layout = Layout(args.base_dir)
+    settings = load_settings(layout.settings_conf)
+
+    try:
+        for directory in layout.directories():
+            directory.mkdir(exist_ok=True, parents=True)
+
+        # Finish or undo disk image changes interrupted by a crash, as the GUI does
+        for name, action in sorted(journal.recover_directory(layout.img_dir).items()):
+            print(f"Recovered interrupted operation on {name}: {action}", file=sys.stderr)
+
+        return args.func(args, layout, settings)
+    except EXPECTED_ERRORS as e:
+        print(f"win9xman: error: {e}", file=sys.stderr)
+        return 1
@@ -0,0 +1,246 @@
+"""
+Calibration of the DOSBox-X CPU options for the host
+
+The cycles DOSBox-X should emulate depend on the host: a fixed default is
+too slow on a fast machine and stutters on a slow one, where DOSBox-X can't
+keep up and takes the time of the sound and video threads. Calibration runs
+a small DOS program that executes a known number of instructions, with
+several CPU options, and times DOSBox-X from the outside:
+
+- the cycles achieved are the instructions run per millisecond of wall
+  time, once the time DOSBox-X takes to start and quit is taken off;
+- the host CPU load is the CPU time DOSBox-X used per second of wall time.
+
+Each core and CPU type first runs flat out (cycles = max) to find the
+fastest; then a bisection finds the highest cycle count that DOSBox-X keeps
+up with while staying under the target load. The result is a set of
+options for a performance profile (see win9xman.utils.profiles).
+
+Any program that takes DOSBox-X's command line can stand in for it, which
+is how the calibration loop is tested without an emulator.
+"""
+
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+from win9xman.utils.config import create_temp_config, runtime_directory
+from win9xman.utils.profiles import NO_PROFILE
+
+CORES = ("dynamic", "normal")
+CPU_TYPES = ("pentium_mmx", "pentium")
+
+MIN_CYCLES = 3000        # slowest setting Windows 9x is usable with
+TARGET_LOAD = 0.8        # share of a host core DOSBox-X may take
+KEPT_UP = 0.95           # share of the requested cycles that must be achieved
+BENCHMARK_SECONDS = 2.0  # emulated work per run, at the expected speed
+SEARCH_STEPS = 5
+CYCLES_STEP = 500        # granularity of the cycle limit found
+FIRST_ESTIMATE = 50000   # cycles/ms expected before anything was measured
+RUN_TIMEOUT = 120        # seconds
+
+BENCHMARK_NAME = "BENCH.COM"
+# Instructions of one pass of the inner loop of the benchmark program
+LOOP_INSTRUCTIONS = 65536 + 2
+MAX_PASSES = 0xFFFF
+
+
+def benchmark_program(passes):
+    """Build a DOS .COM program that runs a fixed number of instructions, then exits
+
+    Args:
+        passes: Passes of 65536 LOOP instructions, 0 to exit at once
+
+    Returns:
+        bytes: The program
+    """
+    exit_program = bytes([0xB8, 0x00, 0x4C,   # mov ax, 4C00h
+                          0xCD, 0x21])        # int 21h
+    if not passes:
+        return exit_program
+    return bytes([0xBA, passes & 0xFF, passes >> 8,  # mov dx, passes
+                  0xB9, 0x00, 0x00,                  # mov cx, 0 (65536 iterations)
+                  0xE2, 0xFE,                        # loop $
+                  0x4A,                              # dec dx
+                  0x75, 0xF8]) + exit_program        # jnz back to mov cx
+
+
+class Measurement:
+    """The outcome of one benchmark run
+
+    Args:
+        cycles: The cycles setting run with
+        core: The core setting
+        cputype: The cputype setting
+        instructions: Instructions the benchmark executed
+        wall: Seconds the benchmark took, startup excluded
+        cpu: Host CPU seconds it used, startup excluded
+    """
+
+    def __init__(self, cycles, core, cputype, instructions, wall, cpu):
+        self.cycles = cycles
+        self.core = core
+        self.cputype = cputype
+        self.instructions = instructions
+        self.wall = wall
+        self.cpu = cpu
+
+    @property
+    def achieved(self):
+        """Cycles emulated per millisecond"""
+        return self.instructions / self.wall / 1000 if self.wall > 0 else 0.0
+
+    @property
+    def load(self):
+        """Host CPU load, 1.0 for a full core"""
+        return self.cpu / self.wall if self.wall > 0 else 0.0
+
+    def __str__(self):
+        return (f"{self.core} {self.cputype} cycles={self.cycles}: "
+                f"{self.achieved:.0f} cycles/ms, load {100 * self.load:.0f}%")
+
+
+def run_timed(command, timeout=RUN_TIMEOUT):
+    """Run a command to completion, measuring its wall and CPU time
+
+    Returns:
+        tuple: (wall seconds, CPU seconds of the process and its children)
+
+    Raises:
+        subprocess.TimeoutExpired: If it takes longer than timeout
+        subprocess.CalledProcessError: If it exits with an error
+    """
+    started = time.monotonic()
+    process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    while True:
+        pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+        if pid:
+            break
+        if time.monotonic() - started > timeout:
+            process.kill()
+            process.wait()
+            raise subprocess.TimeoutExpired(command, timeout)
+        time.sleep(0.01)
+    wall = time.monotonic() - started
+
+    # Reaped here, so Popen must not wait for it again
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
+    return wall, usage.ru_utime + usage.ru_stime
+
+
+class Calibrator:
+    """Runs the benchmark in DOSBox-X and searches for the best CPU options
+
+    Args:
+        emulator: The Emulator to calibrate (see win9xman.core.resolver)
+        layout: Layout of the manager, for the base config and templates
+        duration: Seconds each run should take at the expected speed
+        target_load: Highest host CPU load allowed, 1.0 for a full core
+        progress: Optional callable receiving each Measurement as it is
+            made; may raise to stop the calibration
+    """
+
+    def __init__(self, emulator, layout, duration=BENCHMARK_SECONDS, target_load=TARGET_LOAD, progress=None):
+        self.emulator = emulator
+        self.layout = layout
+        self.duration = duration
+        self.target_load = target_load
+        self.progress = progress
+        self.measurements = []
+        self._work_dir = None
+        self._startup = (0.0, 0.0)
+        self._estimate = FIRST_ESTIMATE
+
+    def _run(self, passes, cycles, core, cputype):
+        """Run the benchmark program once
+
+        Returns:
+            tuple: (wall seconds, CPU seconds), startup included
+        """
+        with open(self._work_dir / BENCHMARK_NAME, 'wb') as f:
+            f.write(benchmark_program(passes))
+
+        autoexec = f'mount c "{self._work_dir}"\nc:\n{BENCHMARK_NAME}\nexit\n'
+        overrides = {'cpu': {'cycles': cycles, 'core': core, 'cputype': cputype},
+                     'mixer': {'nosound': 'true'}}
+        # Profiles would override the options being measured
+        conf = create_temp_config(self.layout.dosbox_conf, autoexec, self.layout.templates_dir,
+                                  self.layout.base_dir, overrides, profile=NO_PROFILE)
+        return run_timed(self.emulator.command_line("-conf", conf))
+
+    def measure(self, cycles, core, cputype):
+        """Time the benchmark with some CPU options
+
+        Args:
+            cycles: The cycles setting, "max" or "fixed N"
+            core: The core setting
+            cputype: The cputype setting
+
+        Returns:
+            Measurement: The result
+        """
+        expected = int(cycles.split()[-1]) if cycles.startswith("fixed") else self._estimate
+        passes = max(1, min(MAX_PASSES, round(self.duration * expected * 1000 / LOOP_INSTRUCTIONS)))
+
+        wall, cpu = self._run(passes, cycles, core, cputype)
+        measurement = Measurement(cycles, core, cputype, passes * LOOP_INSTRUCTIONS,
+                                  max(wall - self._startup[0], 1e-6), max(cpu - self._startup[1], 0.0))
+        self.measurements.append(measurement)
+        if self.progress:
+            self.progress(measurement)
+        return measurement
+
+    def calibrate(self):
+        """Find the best CPU options for the host
+
+        Returns:
+            tuple: (options dict with cycles, core and cputype, details dict
+            to record with them)
+        """
+        self._work_dir = Path(tempfile.mkdtemp(prefix="calibrate-", dir=runtime_directory()))
+        try:
+            # Time to start and quit DOSBox-X, taken off every run
+            self._startup = self._run(0, "max", CORES[0], CPU_TYPES[0])
+
+            # The fastest core and CPU type, each running flat out
+            fastest = None
+            for core in CORES:
+                for cputype in CPU_TYPES:
+                    measurement = self.measure("max", core, cputype)
+                    if fastest is None or measurement.achieved > fastest.achieved:
+                        fastest = measurement
+                        # Size the next runs to take about the requested duration
+                        self._estimate = fastest.achieved
+
+            # The highest cycles DOSBox-X keeps up with under the target load
+            low, high = MIN_CYCLES, max(MIN_CYCLES, int(fastest.achieved))
+            for _ in range(SEARCH_STEPS):
+                cycles = (low + high) // 2 // CYCLES_STEP * CYCLES_STEP
+                if cycles <= low:
+                    break
+                measurement = self.measure(f"fixed {cycles}", fastest.core, fastest.cputype)
+                if measurement.achieved >= KEPT_UP * cycles and measurement.load <= self.target_load:
+                    low = cycles
+                else:
+                    high = cycles
+        finally:
+            shutil.rmtree(self._work_dir, ignore_errors=True)
+
+        options = {
+            # Adaptive up to the limit, so DOSBox-X backs off when the host is busy
+            'cycles': f"max {round(100 * self.target_load)}% limit {low}",
+            'core': fastest.core,
+            'cputype': fastest.cputype,
+        }
+        details = {
+            'max_cycles': str(int(fastest.achieved)),
+            'calibrated': time.strftime("%Y-%m-%dT%H:%M:%S"),
+            'emulator': self.emulator.version or self.emulator.kind,
+        }
+        return options, details
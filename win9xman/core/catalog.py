@@ -0,0 +1,139 @@
+"""
+Snapshot catalog
+
+Every snapshot directory keeps a small SQLite database describing its
+snapshots (size, hash, parent, note, creation time, ...), so snapshots can be
+listed, sorted and filtered without opening the snapshot files. The catalog
+is updated in the same transaction that creates or deletes a snapshot and is
+re-synchronised from the directory listing if files were added or removed
+behind its back.
+"""
+
+import sqlite3
+from pathlib import Path
+
+CATALOG_NAME = "catalog.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    name TEXT PRIMARY KEY,
+    file TEXT NOT NULL,
+    format TEXT NOT NULL,
+    os TEXT,
+    note TEXT,
+    created TEXT,
+    image_size INTEGER,
+    stored_size INTEGER,
+    hash TEXT,
+    parent TEXT
+);
+CREATE INDEX IF NOT EXISTS snapshots_created ON snapshots (created);
+CREATE INDEX IF NOT EXISTS snapshots_parent ON snapshots (parent);
+"""
+
+COLUMNS = ('name', 'file', 'format', 'os', 'note', 'created',
+           'image_size', 'stored_size', 'hash', 'parent')
+
+# Columns the snapshot list can be sorted by
+SORT_COLUMNS = ('name', 'created', 'image_size', 'stored_size', 'os', 'note')
+
+
+class SnapshotCatalog:
+    """SQLite index of the snapshots in one snapshot directory
+
+    Use as a context manager; the connection is closed on exit. Each
+    instance owns its own connection, so worker threads open their own
+    catalog.
+    """
+
+    def __init__(self, snapshot_dir):
+        self.snapshot_dir = Path(snapshot_dir)
+        self.path = self.snapshot_dir / CATALOG_NAME
+        self.conn = sqlite3.connect(str(self.path), timeout=30)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Close the database connection"""
+        self.conn.close()
+
+    def transaction(self):
+        """Context manager committing on success and rolling back on error"""
+        return self.conn
+
+    def add(self, record):
+        """Insert or replace a snapshot record
+
+        Args:
+            record: Dict with the keys listed in COLUMNS; missing keys are NULL
+        """
+        values = [record.get(column) for column in COLUMNS]
+        self.conn.execute(
+            f"INSERT OR REPLACE INTO snapshots ({', '.join(COLUMNS)}) "
+            f"VALUES ({', '.join('?' * len(COLUMNS))})", values)
+
+    def update(self, name, **fields):
+        """Update some fields of a snapshot record"""
+        assignments = ', '.join(f"{column} = ?" for column in fields)
+        self.conn.execute(f"UPDATE snapshots SET {assignments} WHERE name = ?",
+                          list(fields.values()) + [name])
+
+    def remove(self, name):
+        """Remove a snapshot record"""
+        self.conn.execute("DELETE FROM snapshots WHERE name = ?", (name,))
+
+    def get(self, name):
+        """Get a snapshot record as a dict, or None"""
+        row = self.conn.execute("SELECT * FROM snapshots WHERE name = ?", (name,)).fetchone()
+        return dict(row) if row else None
+
+    def children(self, name):
+        """List the names of the snapshots whose parent is the given one"""
+        rows = self.conn.execute("SELECT name FROM snapshots WHERE parent = ? ORDER BY name", (name,))
+        return [row['name'] for row in rows]
+
+    def list(self, order_by='created', descending=False, search=None, os_name=None):
+        """List snapshot records
+
+        Args:
+            order_by: Column to sort by, one of SORT_COLUMNS
+            descending: Sort in descending order
+            search: Only include snapshots whose name or note contains this text
+            os_name: Only include snapshots of this OS
+
+        Returns:
+            list: Snapshot records as dicts
+        """
+        if order_by not in SORT_COLUMNS:
+            raise ValueError(f"Cannot sort snapshots by {order_by}")
+
+        query = "SELECT * FROM snapshots"
+        conditions = []
+        params = []
+        if search:
+            conditions.append("(name LIKE ? OR note LIKE ?)")
+            params.extend([f"%{search}%"] * 2)
+        if os_name:
+            conditions.append("os = ?")
+            params.append(os_name)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        direction = 'DESC' if descending else 'ASC'
+        query += f" ORDER BY {order_by} {direction}, name {direction}"
+
+        return [dict(row) for row in self.conn.execute(query, params)]
+
+    def names(self):
+        """Get the set of snapshot names in the catalog"""
+        return {row['name'] for row in self.conn.execute("SELECT name FROM snapshots")}
+
+    def total_stored_size(self):
+        """Get the space used by all snapshots, as recorded"""
+        row = self.conn.execute("SELECT COALESCE(SUM(stored_size), 0) AS total FROM snapshots").fetchone()
+        return row['total']
@@ -0,0 +1,184 @@
+"""
+Content-addressed chunk store used by disk image snapshots
+"""
+
+import hashlib
+import lzma
+import os
+import threading
+import zlib
+from pathlib import Path
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DEFAULT_BLOCK_SIZE = 1024 * 1024  # 1 MiB blocks
+
+# Object file suffix for each supported compression codec
+CODEC_SUFFIXES = {
+    'none': '',
+    'zlib': '.z',
+    'lzma': '.xz',
+    'zstd': '.zst',
+}
+
+_zstd_local = threading.local()
+
+
+def resolve_codec(codec):
+    """Map a configured codec name to a usable one
+
+    ``auto`` picks zstd when the zstandard module is installed and zlib
+    otherwise.
+    """
+    if codec == 'auto':
+        return 'zstd' if zstandard is not None else 'zlib'
+    if codec not in CODEC_SUFFIXES:
+        raise ValueError(f"Unknown compression codec: {codec}")
+    if codec == 'zstd' and zstandard is None:
+        raise ValueError("zstd compression requires the zstandard module")
+    return codec
+
+
+def compress_block(data, codec):
+    """Compress a block with the given codec"""
+    if codec == 'zlib':
+        return zlib.compress(data, 6)
+    if codec == 'lzma':
+        return lzma.compress(data, preset=1)
+    if codec == 'zstd':
+        # Compressor objects are not thread safe, keep one per thread
+        if not hasattr(_zstd_local, 'compressor'):
+            _zstd_local.compressor = zstandard.ZstdCompressor(level=3)
+        return _zstd_local.compressor.compress(data)
+    return data
+
+
+def decompress_block(data, codec):
+    """Decompress a block stored with the given codec"""
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    if codec == 'lzma':
+        return lzma.decompress(data)
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ValueError("zstd compressed snapshot requires the zstandard module")
+        if not hasattr(_zstd_local, 'decompressor'):
+            _zstd_local.decompressor = zstandard.ZstdDecompressor()
+        return _zstd_local.decompressor.decompress(data)
+    return data
+
+
+def hash_block(data):
+    """Return the hex digest used to address a block of data"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def is_zero_block(data):
+    """Check whether a block only contains zero bytes"""
+    return not data.strip(b"\x00")
+
+
+class ChunkStore:
+    """Store each distinct block of data exactly once, addressed by its hash
+
+    Objects live in ``<root>/objects/<xx>/<digest>[.suffix]`` where ``xx``
+    are the first two characters of the digest, to keep directories small,
+    and the suffix names the codec the block is compressed with. Digests are
+    always computed over the uncompressed data, so blocks stored with
+    different codecs still deduplicate.
+    """
+
+    def __init__(self, root, compression='none'):
+        self.root = Path(root)
+        self.objects_dir = self.root / "objects"
+        self.compression = resolve_codec(compression)
+
+    def path_for(self, digest, codec='none'):
+        """Get the path of the object file for a digest"""
+        return self.objects_dir / digest[:2] / f"{digest}{CODEC_SUFFIXES[codec]}"
+
+    def find(self, digest):
+        """Find how a block is stored
+
+        Returns:
+            tuple: (path, codec) of the object, or None if not stored
+        """
+        # Check the codec in use first, it's the most likely hit
+        codecs = [self.compression] + [c for c in CODEC_SUFFIXES if c != self.compression]
+        for codec in codecs:
+            path = self.path_for(digest, codec)
+            if path.exists():
+                return path, codec
+        return None
+
+    def has(self, digest):
+        """Check if a block is already stored"""
+        return self.find(digest) is not None
+
+    def put(self, digest, data):
+        """Store a block unless an identical one is already present
+
+        Args:
+            digest: Hex digest of the data, as returned by hash_block
+            data: Block contents
+
+        Returns:
+            int: Number of bytes written, 0 if the block already existed
+        """
+        if self.has(digest):
+            return 0
+
+        path = self.path_for(digest, self.compression)
+        path.parent.mkdir(exist_ok=True, parents=True)
+        data = compress_block(data, self.compression)
+
+        # Write to a temporary name first so a crash never leaves a
+        # truncated object behind under its final name
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return len(data)
+
+    def get(self, digest):
+        """Read a stored block, decompressing it if needed"""
+        found = self.find(digest)
+        if found is None:
+            raise FileNotFoundError(f"Block {digest} missing from chunk store {self.root}")
+        path, codec = found
+        with open(path, 'rb') as f:
+            return decompress_block(f.read(), codec)
+
+    def remove(self, digest):
+        """Delete a stored block if present"""
+        for codec in CODEC_SUFFIXES:
+            try:
+                self.path_for(digest, codec).unlink()
+            except FileNotFoundError:
+                pass
+
+    def iter_objects(self):
+        """Iterate over (digest, path) of all stored objects
+
+        Leftover temporary files from interrupted writes are reported with a
+        digest of None.
+        """
+        if not self.objects_dir.exists():
+            return
+        for prefix_dir in self.objects_dir.iterdir():
+            if not prefix_dir.is_dir():
+                continue
+            for path in prefix_dir.iterdir():
+                if path.name.startswith('.'):
+                    yield None, path
+                else:
+                    yield path.name.split('.', 1)[0], path
+
+    def iter_digests(self):
+        """Iterate over the digests of all stored blocks"""
+        for digest, _ in self.iter_objects():
+            if digest is not None:
+                yield digest
@@ -0,0 +1,92 @@
+"""
+Compaction of disk images
+
+When Windows deletes files it only marks their clusters free in the FAT; the
+data stays in the image and keeps taking space on the host, and every
+snapshot, compression and hashing pass keeps processing it. Compacting reads
+the FAT, finds the free clusters and punches holes over them, so the image
+shrinks to the space its files really use. Where the host file system can't
+punch holes the free clusters are zeroed instead, which snapshots then skip
+as zero blocks.
+
+The image must not be in use by DOSBox-X while it is compacted.
+"""
+
+import os
+
+from win9xman.core.chunkstore import is_zero_block
+from win9xman.core.fatfs import FatError, FatVolume, free_runs
+from win9xman.core.image import RawImage
+from win9xman.core.vhd import is_vhd
+from win9xman.utils.fileops import intersect_ranges, iter_data_ranges, punch_hole
+
+ZERO_CHUNK_SIZE = 1024 * 1024
+
+
+def allocated_size(path):
+    """Get the space a file takes on the host, holes excluded"""
+    st = os.stat(path)
+    return st.st_blocks * 512 if hasattr(st, 'st_blocks') else st.st_size
+
+
+def _zero_range(fd, offset, length):
+    """Overwrite a byte range with zeros, skipping parts that already are"""
+    end = offset + length
+    while offset < end:
+        size = min(ZERO_CHUNK_SIZE, end - offset)
+        data = os.pread(fd, size, offset)
+        if not is_zero_block(data):
+            os.pwrite(fd, bytes(size), offset)
+        offset += size
+
+
+def compact_image(hdd_image, progress=None):
+    """Give the space of the free clusters of a disk image back to the host
+
+    Args:
+        hdd_image: Path of the raw disk image
+        progress: Optional callable receiving the number of bytes of the
+            image processed
+
+    Returns:
+        dict: 'free_bytes' in the filesystem, the host space allocated
+        'before' and 'after', and the 'method' used ('punch' or 'zero')
+
+    Raises:
+        FatError: If the image is a VHD
+    """
+    if is_vhd(hdd_image):
+        raise FatError("Only raw disk images can be compacted; convert the VHD to raw first")
+    before = allocated_size(hdd_image)
+
+    with RawImage(hdd_image, writable=True) as image:
+        volume = FatVolume(image)
+        runs = [(volume.cluster_offset(start), count * volume.cluster_size)
+                for start, count in free_runs(volume.read_fat(), volume.fat_type)]
+        free_bytes = sum(length for _, length in runs)
+
+        fd = image.fileno()
+        # Free clusters that are already holes need no work
+        targets = intersect_ranges(runs, list(iter_data_ranges(fd, image.size)))
+
+        method = 'punch'
+        done = 0
+        for offset, length in targets:
+            if method == 'punch' and not punch_hole(fd, offset, length):
+                method = 'zero'
+            if method == 'zero':
+                _zero_range(fd, offset, length)
+            if progress:
+                progress(offset + length - done)
+            done = offset + length
+
+        os.fsync(fd)
+        if progress:
+            progress(image.size - done)
+
+    return {
+        'free_bytes': free_bytes,
+        'before': before,
+        'after': allocated_size(hdd_image),
+        'method': method,
+    }
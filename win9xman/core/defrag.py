@@ -0,0 +1,313 @@
+"""
+Offline defragmentation of FAT32 disk images
+
+The defragmenter rewrites the filesystem into a new image with every cluster
+chain contiguous. Directories are laid out depth first, each directory
+followed by its files, so files that are used together are stored together.
+Only used clusters are copied; free space becomes a hole in the new image.
+The new image is swapped in through the journal (see win9xman.core.journal),
+so an interrupted run leaves the original image untouched.
+
+The image must not be in use by DOSBox-X while it is defragmented.
+"""
+
+import array
+import os
+import struct
+import sys
+from pathlib import Path
+
+from win9xman.core.fatfs import (ATTR_LONG_NAME, ATTR_VOLUME_ID, DELETED_MARKER, DIR_ENTRY_SIZE,
+                                 FatError, FatVolume)
+from win9xman.core.image import RawImage
+from win9xman.core.journal import replace_image
+from win9xman.core.vhd import is_vhd
+from win9xman.utils.fileops import copy_range, intersect_ranges, iter_data_ranges
+
+FAT32_MASK = 0x0FFFFFFF
+FAT32_EOC = 0x0FFFFFFF
+FAT32_BAD = 0x0FFFFFF7
+
+# Fields of the FAT32 boot sector
+ROOT_CLUSTER_OFFSET = 44
+FSINFO_SECTOR_OFFSET = 48
+BACKUP_BOOT_SECTOR_OFFSET = 50
+
+DOT_NAME = b'.          '
+DOTDOT_NAME = b'..         '
+
+
+class _Chain:
+    """A cluster chain of the filesystem and where it moves to"""
+
+    __slots__ = ('first', 'runs', 'is_dir', 'parent', 'clusters')
+
+    def __init__(self, first, runs, is_dir=False, parent=None):
+        self.first = first
+        self.runs = runs
+        self.is_dir = is_dir
+        self.parent = parent
+        self.clusters = None
+
+
+def _walk_chains(volume):
+    """List every cluster chain of the filesystem in the defragmented order
+
+    Each directory comes first, then its files, then its subdirectories.
+    """
+    chains = []
+
+    def visit(entry, parent):
+        cluster = entry.cluster if entry else volume.root_cluster
+        chains.append(_Chain(cluster, volume.cluster_runs(cluster), True, parent))
+        entries = volume.listdir(entry)
+        for child in entries:
+            if not child.is_dir and child.cluster:
+                chains.append(_Chain(child.cluster, volume.cluster_runs(child.cluster)))
+        for child in entries:
+            if child.is_dir and child.cluster:
+                visit(child, cluster)
+
+    visit(None, None)
+    return chains
+
+
+def analyze(volume):
+    """Measure the fragmentation of a FAT filesystem
+
+    Args:
+        volume: An open FatVolume
+
+    Returns:
+        dict: Numbers of 'files' (directories included), 'fragmented' files,
+        'fragments' (contiguous runs) and the 'percent' of fragmented files
+    """
+    return _fragmentation(_walk_chains(volume))
+
+
+def _fragmentation(chains):
+    """Compute the fragmentation statistics of a list of chains"""
+    fragmented = sum(1 for chain in chains if len(chain.runs) > 1)
+    return {
+        'files': len(chains),
+        'fragmented': fragmented,
+        'fragments': sum(len(chain.runs) for chain in chains),
+        'percent': 100.0 * fragmented / len(chains) if chains else 0.0,
+    }
+
+
+def analyze_image(hdd_image):
+    """Measure the fragmentation of the filesystem in a disk image"""
+    with RawImage(hdd_image) as image:
+        return analyze(FatVolume(image))
+
+
+def _check_consistency(fat, chains):
+    """Refuse to move clusters of a filesystem with errors
+
+    Raises:
+        FatError: If clusters are cross-linked or lost
+    """
+    used = set()
+    for chain in chains:
+        for start, count in chain.runs:
+            for cluster in range(start, start + count):
+                if cluster in used:
+                    raise FatError("The filesystem has cross-linked files; "
+                                   "run ScanDisk in Windows first")
+                used.add(cluster)
+
+    allocated = sum(1 for cluster in range(2, len(fat))
+                    if fat[cluster] & FAT32_MASK not in (0, FAT32_BAD))
+    if allocated != len(used):
+        raise FatError(f"The filesystem has {allocated - len(used)} lost clusters; "
+                       "run ScanDisk in Windows first")
+
+
+def _plan(fat, chains):
+    """Assign every chain a contiguous run of new clusters
+
+    Sets the new clusters of each chain.
+
+    Returns:
+        tuple: (mapping of old to new first clusters, new FAT, first free
+        cluster after the relocated data)
+    """
+    new_fat = array.array('I', bytes(len(fat) * 4))
+    new_fat[0], new_fat[1] = fat[0], fat[1]
+    # Bad clusters stay where they are, chains are laid out around them
+    bad = {cluster for cluster in range(2, len(fat)) if fat[cluster] & FAT32_MASK == FAT32_BAD}
+    for cluster in bad:
+        new_fat[cluster] = FAT32_BAD
+
+    mapping = {}
+    next_cluster = 2
+    for chain in chains:
+        count = sum(length for _, length in chain.runs)
+        clusters = []
+        while len(clusters) < count:
+            if next_cluster not in bad:
+                clusters.append(next_cluster)
+            next_cluster += 1
+        for cluster, following in zip(clusters, clusters[1:]):
+            new_fat[cluster] = following
+        new_fat[clusters[-1]] = FAT32_EOC
+        mapping[chain.first] = clusters[0]
+        chain.clusters = clusters
+
+    return mapping, new_fat, next_cluster
+
+
+def _patch_directory(data, mapping, self_cluster, parent_cluster):
+    """Point the entries of a directory at the new cluster numbers"""
+    for pos in range(0, len(data), DIR_ENTRY_SIZE):
+        first = data[pos]
+        if first == 0:
+            break
+        attributes = data[pos + 11]
+        if first == DELETED_MARKER or attributes & 0x3F == ATTR_LONG_NAME or attributes & ATTR_VOLUME_ID:
+            continue
+
+        name = bytes(data[pos:pos + 11])
+        if name == DOT_NAME:
+            cluster = self_cluster
+        elif name == DOTDOT_NAME:
+            cluster = parent_cluster
+        else:
+            high, = struct.unpack_from('<H', data, pos + 20)
+            low, = struct.unpack_from('<H', data, pos + 26)
+            if not high << 16 | low:
+                continue
+            cluster = mapping[high << 16 | low]
+        struct.pack_into('<H', data, pos + 20, cluster >> 16)
+        struct.pack_into('<H', data, pos + 26, cluster & 0xFFFF)
+
+
+def _cluster_runs(clusters):
+    """Group a list of cluster numbers into [first, count] runs"""
+    runs = []
+    for cluster in clusters:
+        if runs and runs[-1][0] + runs[-1][1] == cluster:
+            runs[-1][1] += 1
+        else:
+            runs.append([cluster, 1])
+    return runs
+
+
+def _copy_extents(fd_in, fd_out, source, target, progress=None):
+    """Copy data laid out in one list of extents into another of equal total size"""
+    source = [list(extent) for extent in source]
+    target = [list(extent) for extent in target]
+    while source and target:
+        length = min(source[0][1], target[0][1])
+        copy_range(fd_in, fd_out, source[0][0], length, progress, out_offset=target[0][0])
+        for extents in (source, target):
+            extents[0][0] += length
+            extents[0][1] -= length
+            if not extents[0][1]:
+                extents.pop(0)
+
+
+def _write_defragmented(image, volume, chains, mapping, new_fat, next_free, out_path, progress=None):
+    """Write the defragmented filesystem to a new image file"""
+    cluster_size = volume.cluster_size
+    data_end = volume.cluster_offset(volume.cluster_count + 2)
+    boot = image.read(volume.offset, volume.bytes_per_sector)
+
+    with open(out_path, 'wb') as out:
+        fd_in = image.fileno()
+        fd_out = out.fileno()
+        out.truncate(image.size)
+
+        # The partition table, boot area and anything past the data area
+        # stay as they are
+        kept = [(0, volume.fat_offset), (data_end, image.size - data_end)]
+        for offset, length in intersect_ranges(kept, list(iter_data_ranges(fd_in, image.size))):
+            copy_range(fd_in, fd_out, offset, length)
+
+        new_root = struct.pack('<I', mapping[volume.root_cluster])
+        os.pwrite(fd_out, new_root, volume.offset + ROOT_CLUSTER_OFFSET)
+        backup, = struct.unpack_from('<H', boot, BACKUP_BOOT_SECTOR_OFFSET)
+        if backup and backup != 0xFFFF:
+            os.pwrite(fd_out, new_root, volume.offset + backup * volume.bytes_per_sector + ROOT_CLUSTER_OFFSET)
+
+        fat = new_fat
+        if sys.byteorder != 'little':
+            fat = new_fat[:]
+            fat.byteswap()
+        for copy in range(volume.num_fats):
+            os.pwrite(fd_out, fat.tobytes(), volume.fat_offset + copy * volume.fat_size)
+
+        for chain in chains:
+            target = [(volume.cluster_offset(start), count * cluster_size)
+                      for start, count in _cluster_runs(chain.clusters)]
+
+            if not chain.is_dir:
+                source = [(volume.cluster_offset(start), count * cluster_size) for start, count in chain.runs]
+                _copy_extents(fd_in, fd_out, source, target, progress)
+                continue
+
+            # Directories are rewritten with their entries pointing at the new clusters
+            data = bytearray(b''.join(image.read(volume.cluster_offset(start), count * cluster_size)
+                                      for start, count in chain.runs))
+            parent = 0 if chain.parent in (None, volume.root_cluster) else mapping[chain.parent]
+            _patch_directory(data, mapping, chain.clusters[0], parent)
+            position = 0
+            for offset, length in target:
+                os.pwrite(fd_out, data[position:position + length], offset)
+                position += length
+            if progress:
+                progress(len(data))
+
+        fsinfo_sector, = struct.unpack_from('<H', boot, FSINFO_SECTOR_OFFSET)
+        fsinfo_offset = volume.offset + fsinfo_sector * volume.bytes_per_sector
+        if fsinfo_sector not in (0, 0xFFFF) and image.read(fsinfo_offset, 4) == b'RRaA':
+            free = sum(1 for cluster in range(2, len(new_fat)) if new_fat[cluster] == 0)
+            os.pwrite(fd_out, struct.pack('<II', free, next_free if next_free < len(new_fat) else 0xFFFFFFFF),
+                      fsinfo_offset + 488)
+
+
+def defragment_image(hdd_image, progress=None):
+    """Rewrite a FAT32 disk image with every file stored contiguously
+
+    Needs free host space for the used part of the image while it runs.
+
+    Args:
+        hdd_image: Path of the raw disk image
+        progress: Optional callable receiving the number of bytes copied
+
+    Returns:
+        dict: The fragmentation 'before' and 'after', as returned by analyze
+
+    Raises:
+        FatError: If the image isn't a raw FAT32 image or its filesystem has
+            errors
+    """
+    hdd_image = Path(hdd_image)
+    if is_vhd(hdd_image):
+        raise FatError("Only raw disk images can be defragmented; convert the VHD to raw first")
+
+    with RawImage(hdd_image) as image:
+        volume = FatVolume(image)
+        if volume.fat_type != 32:
+            raise FatError(f"Only FAT32 volumes can be defragmented, not FAT{volume.fat_type}")
+
+        fat = volume.read_fat()
+        chains = _walk_chains(volume)
+        _check_consistency(fat, chains)
+        before = _fragmentation(chains)
+
+        mapping, new_fat, next_free = _plan(fat, chains)
+        replace_image(hdd_image,
+                      lambda tmp_path: _write_defragmented(image, volume, chains, mapping, new_fat,
+                                                           next_free, tmp_path, progress),
+                      operation='defragment')
+
+    return {'before': before, 'after': analyze_image(hdd_image)}
+
+
+def used_size(hdd_image):
+    """Get the number of bytes in use by files and directories of an image"""
+    with RawImage(hdd_image) as image:
+        volume = FatVolume(image)
+        return sum(count for chain in _walk_chains(volume) for _, count in chain.runs) * volume.cluster_size
@@ -2,54 +2,95 @@
 Disk image management functions
 """
 
-import subprocess
-import tkinter as tk
-from tkinter import ttk, messagebox
+from pathlib import Path
+
+from win9xman.core.fat import format_fat32
+from win9xman.core.jobs import JobManager
+from win9xman.core.journal import replace_image
+from win9xman.core.lock import ImageLock
+from win9xman.core.verify import tree_path
+from win9xman.core.vhd import RAW_SUFFIX, VHD_SUFFIX, convert_to_raw, convert_to_vhd, is_vhd
+
+
+def create_hdd_image(root, hdd_image, hdd_size, job_monitor=None):
+    """Create a new HDD image file with confirmation and progress dialogs
+
+    Kept for callers of the old API; the dialogs live in
+    win9xman.ui.disk.create_hdd_image, which this forwards to, so Tkinter
+    is only imported when it is called.
 
-def create_hdd_image(root, hdd_image, hdd_size):
-    """Create a new HDD image file
-    
     Args:
         root: The Tkinter root window
         hdd_image: Path to the HDD image file to create
         hdd_size: Size of the HDD in MB
-    
+        job_monitor: The JobMonitor to run the job with; a temporary one is
+            used when not given
+
     Returns:
         bool: True if the image was created successfully, False otherwise
     """
-    # Confirm creation
-    if not messagebox.askyesno("Confirm HDD Creation", 
-                             f"Create new disk image of {hdd_size}MB?"):
-        return False
-    
-    # Show progress while creating the image
-    progress_window = tk.Toplevel(root)
-    progress_window.title("Creating HDD Image")
-    progress_window.geometry("400x100")
-    progress_window.transient(root)
-    progress_window.grab_set()
-    
-    ttk.Label(progress_window, text=f"Creating disk image of {hdd_size}MB...").pack(pady=10)
-    progress = ttk.Progressbar(progress_window, mode="indeterminate", length=300)
-    progress.pack(pady=10, padx=20)
-    progress.start()
-    
-    result = [False]  # Use list for result
-    
-    # Schedule the actual creation task
-    def create_task():
-        try:
-            # Create disk image using DOSBox-X's imgmake command
-            cmd = ["dosbox-x", "-c", f"imgmake \"{hdd_image}\" -size {hdd_size} -fat 32 -t hd", "-c", "exit"]
-            subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            result[0] = True
-            progress_window.destroy()
-            messagebox.showinfo("Success", f"Disk image of {hdd_size}MB created successfully.")
-        except subprocess.CalledProcessError:
-            progress_window.destroy()
-            messagebox.showerror("Error", "Failed to create HDD image. Please check your permissions.")
-    
-    root.after(100, create_task)
-    root.wait_window(progress_window)
-    
-    return result[0]
+    from win9xman.ui import disk, jobs
+
+    if job_monitor is not None:
+        return disk.create_hdd_image(root, hdd_image, hdd_size, job_monitor)
+
+    job_manager = JobManager(max_workers=1)
+    try:
+        return disk.create_hdd_image(root, hdd_image, hdd_size, jobs.JobMonitor(root, job_manager))
+    finally:
+        job_manager.shutdown(cancel=False)
+
+
+def make_hdd_image(hdd_image, hdd_size, progress=None):
+    """Create a blank FAT32 hard disk image
+
+    The partition table and filesystem are written directly into a sparse
+    file, or a dynamic VHD, no DOSBox-X process is needed.
+
+    Args:
+        hdd_image: Path to the HDD image file to create, ending in .vhd for
+            a dynamic VHD
+        hdd_size: Size of the HDD in MB
+        progress: Optional callable receiving the number of bytes written
+
+    Raises:
+        ValueError: If the size is too small for FAT32
+    """
+    format_fat32(hdd_image, hdd_size * 1024 * 1024, progress=progress)
+
+
+def convert_image(hdd_image, progress=None):
+    """Convert a disk image to the other format, raw to VHD or back
+
+    The converted image gets the same name with the other suffix and is
+    swapped in crash-safely (see win9xman.core.journal); the original is
+    removed only once it is complete.
+
+    Args:
+        hdd_image: Path of the raw image or VHD
+        progress: Optional callable receiving the number of bytes processed
+
+    Returns:
+        Path: The path of the converted image
+
+    Raises:
+        FileExistsError: If an image with the other suffix already exists
+        ImageLockedError: If the converted image's name is locked
+    """
+    hdd_image = Path(hdd_image)
+    if is_vhd(hdd_image):
+        target, convert = hdd_image.with_suffix(RAW_SUFFIX), convert_to_raw
+    else:
+        target, convert = hdd_image.with_suffix(VHD_SUFFIX), convert_to_vhd
+    if target.exists():
+        raise FileExistsError(f"{target.name} already exists")
+
+    # The journal is kept for the target, so recovery must find it locked too
+    with ImageLock(target):
+        replace_image(target, lambda tmp_path: convert(hdd_image, tmp_path, progress),
+                      operation='convert', source=hdd_image)
+    hdd_image.unlink()
+    if tree_path(hdd_image).exists():
+        tree_path(hdd_image).unlink()
+    return target
+
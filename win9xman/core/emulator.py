@@ -0,0 +1,517 @@
+"""
+Supervision of DOSBox-X processes
+
+DOSBox-X runs as a child process watched by a background thread, so the
+manager stays responsive while Windows runs and disk jobs can run alongside
+it. The combined stdout and stderr of the emulator are read line by line,
+classified and kept in a bounded log. State changes are announced on a
+thread-safe queue which the UI drains from the Tk main loop, the same way as
+job events (see win9xman.core.jobs).
+
+Each instance can be pinned to CPUs and given a lower CPU and I/O priority,
+so several guests can share a many-core host without slowing each other down.
+Pinned instances hold a shared lock on a file per CPU in the runtime
+directory, which DOSBox-X inherits like the image lock (see
+win9xman.core.lock), so every manager and command line of the user sees
+which CPUs are taken when it picks CPUs for a new instance.
+"""
+
+import collections
+import itertools
+import os
+import queue
+import shutil
+import subprocess
+import threading
+import time
+from pathlib import Path
+
+from win9xman.utils.config import runtime_directory
+
+STARTING = "starting"
+RUNNING = "running"
+EXITED = "exited"
+FAILED = "failed"  # the process could not be started at all
+
+FINISHED_STATES = (EXITED, FAILED)
+
+# Log levels of output lines
+INFO = "info"
+WARNING = "warning"
+ERROR = "error"
+
+# Output lines kept per process
+LOG_LINES = 5000
+
+ERROR_WORDS = ("error", "fatal", "failed", "cannot", "can't", "unable", "not found")
+WARNING_WORDS = ("warning", "warn:")
+
+# ionice scheduling classes
+IO_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+
+# Directory of the CPU lock files, in the runtime directory
+CPU_LOCKS_DIR = "cpus"
+
+# Package each placement tool comes with, for the warning when it is missing
+PLACEMENT_TOOLS = {'taskset': "util-linux", 'nice': "coreutils", 'ionice': "util-linux"}
+
+_process_ids = itertools.count(1)
+
+
+def parse_line(line):
+    """Classify a line of DOSBox-X output
+
+    Args:
+        line: The line as read, with or without its line ending
+
+    Returns:
+        tuple: (level, text) where level is INFO, WARNING or ERROR
+    """
+    text = line.rstrip("\r\n")
+    # Debug builds prefix their log messages
+    if text.startswith("LOG:"):
+        text = text[4:].strip()
+
+    lowered = text.lower()
+    if any(word in lowered for word in ERROR_WORDS):
+        return ERROR, text
+    if any(word in lowered for word in WARNING_WORDS):
+        return WARNING, text
+    return INFO, text
+
+
+def parse_cpu_list(text):
+    """Parse a list of CPUs such as "0-3,6"
+
+    Args:
+        text: Comma separated CPU numbers and ranges, may be empty
+
+    Returns:
+        set: The CPU numbers
+
+    Raises:
+        ValueError: If the list is malformed
+    """
+    cpus = set()
+    for part in text.replace(' ', '').split(','):
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        first = int(first)
+        last = int(last) if last else first
+        if first < 0 or last < first:
+            raise ValueError(f"Invalid CPU range: {part}")
+        cpus.update(range(first, last + 1))
+    return cpus
+
+
+def available_cpus():
+    """Get the CPUs this process may run on, or an empty set if unknown"""
+    if not hasattr(os, 'sched_getaffinity'):
+        return set()
+    return os.sched_getaffinity(0)
+
+
+def _flock(path, operation):
+    """Open a lock file and flock it without waiting
+
+    Returns:
+        int: The locked descriptor, or None if the lock is held elsewhere
+    """
+    import fcntl
+
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, operation | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    except BaseException:
+        os.close(fd)
+        raise
+    return fd
+
+
+class CpuLocks:
+    """The lock files marking the CPUs pinned instances run on
+
+    Locks are shared, as several instances may be pinned to one CPU; a CPU
+    is free when its lock can be taken exclusively. Does nothing where
+    flock is unavailable.
+
+    Args:
+        directory: Directory of the lock files
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        try:
+            import fcntl  # noqa: F401
+            self.supported = True
+        except ImportError:
+            self.supported = False
+
+    def _path(self, cpu):
+        return self.directory / f"{cpu}.lock"
+
+    def allocation(self):
+        """Lock out other managers picking CPUs at the same time
+
+        Returns:
+            int: Descriptor to close once the picked CPUs are held, or None
+        """
+        if not self.supported:
+            return None
+        import fcntl
+
+        self.directory.mkdir(mode=0o700, exist_ok=True)
+        fd = os.open(self.directory / ".allocate", os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return fd
+
+    def in_use(self, cpu):
+        """Check if an instance of any manager is pinned to a CPU"""
+        if not self.supported:
+            return False
+        import fcntl
+
+        self.directory.mkdir(mode=0o700, exist_ok=True)
+        fd = _flock(self._path(cpu), fcntl.LOCK_EX)
+        if fd is None:
+            return True
+        os.close(fd)
+        return False
+
+    def hold(self, cpus):
+        """Take the shared locks of CPUs for a new instance
+
+        Returns:
+            list: The locked descriptors, for the instance to inherit
+        """
+        if not self.supported:
+            return []
+        import fcntl
+
+        self.directory.mkdir(mode=0o700, exist_ok=True)
+        fds = []
+        for cpu in sorted(cpus):
+            # Only an allocation check holds it exclusively, and briefly
+            fd = None
+            while fd is None:
+                fd = _flock(self._path(cpu), fcntl.LOCK_SH)
+                if fd is None:
+                    time.sleep(0.01)
+            fds.append(fd)
+        return fds
+
+
+class Placement:
+    """CPU pinning and scheduling priority of an instance
+
+    Args:
+        cpus: CPU numbers to pin the instance to, empty for no pinning
+        nice: Niceness to add, 0 to keep that of the manager
+        ionice: I/O scheduling class: idle, best-effort or realtime,
+            optionally followed by :level (0-7); empty to keep the default
+        cpu_locks: Descriptors of the CPU locks held for the instance (see
+            CpuLocks), passed on to it and closed by release
+
+    Raises:
+        ValueError: If a setting is invalid
+    """
+
+    def __init__(self, cpus=(), nice=0, ionice='', cpu_locks=()):
+        self.cpus = set(cpus)
+        self.nice = nice
+        self.cpu_locks = list(cpu_locks)
+        if self.cpus and not self.cpus <= available_cpus():
+            raise ValueError(f"CPUs not available: {sorted(self.cpus - available_cpus())}")
+
+        io_class, _, io_level = ionice.partition(':')
+        if io_class and io_class not in IO_CLASSES:
+            raise ValueError(f"Unknown ionice class: {io_class}")
+        if io_level and not (io_class != 'idle' and io_level.isdigit() and int(io_level) <= 7):
+            raise ValueError(f"Invalid ionice level: {io_level}")
+        self.io_class = io_class
+        self.io_level = io_level
+        self.warnings = []
+
+    def wrap(self, command):
+        """Prefix a command with what it takes to apply the placement
+
+        Pinning, niceness and I/O priority are applied by running the command
+        through taskset, nice and ionice (util-linux and coreutils), which
+        set them on themselves before they exec it, so every thread the
+        emulator starts inherits them. A preexec_fn would do the same from
+        Python, but isn't safe in the manager, which always runs threads.
+
+        A tool that isn't installed is left out, and what it would have
+        applied is listed in warnings instead.
+        """
+        steps = []
+        if self.cpus:
+            steps.append(("taskset", ["-c", ",".join(str(cpu) for cpu in sorted(self.cpus))], "CPU pinning"))
+        if self.nice:
+            steps.append(("nice", ["-n", str(self.nice)], "niceness"))
+        if self.io_class:
+            steps.append(("ionice", ["-c", str(IO_CLASSES[self.io_class])]
+                          + (["-n", self.io_level] if self.io_level else []), "I/O priority"))
+
+        prefix, self.warnings = [], []
+        for tool, args, what in steps:
+            if shutil.which(tool) is None:
+                self.warnings.append(f"{tool} not found, {what} is not applied; "
+                                     f"install {PLACEMENT_TOOLS[tool]} to apply it")
+                continue
+            prefix += [tool] + args
+        return prefix + list(command)
+
+    def release(self):
+        """Give up this process's hold on the CPU locks
+
+        As with image locks, an instance that inherited them keeps them
+        until it exits.
+        """
+        for fd in self.cpu_locks:
+            os.close(fd)
+        self.cpu_locks = []
+
+
+class EmulatorProcess:
+    """A DOSBox-X instance and its output
+
+    Args:
+        title: Human readable description, e.g. the Windows version
+        command: Command line to run
+        notify: Called with the process on every state change, from any thread
+        placement: Optional Placement of the process on the host
+        pass_fds: Descriptors the process inherits, such as image locks;
+            those of the placement's CPU locks are added
+    """
+
+    def __init__(self, title, command, notify=None, placement=None, pass_fds=()):
+        self.id = next(_process_ids)
+        self.title = title
+        self.placement = placement or Placement()
+        self.command = [str(arg) for arg in self.placement.wrap(command)]
+        self.pass_fds = tuple(pass_fds) + tuple(self.placement.cpu_locks)
+        self.state = STARTING
+        self.returncode = None
+        self.error = None
+        self.started = None
+        self.finished = None
+        # Placement tools that are missing are reported first
+        self.log = collections.deque(((WARNING, warning) for warning in self.placement.warnings),
+                                     maxlen=LOG_LINES)
+        self.line_count = len(self.log)
+        self._notify = notify
+        self._cleanups = []
+        self._process = None
+        self._lock = threading.Lock()
+        self._finished = threading.Event()
+
+    def add_cleanup(self, func):
+        """Register a function to run once the process has ended"""
+        self._cleanups.append(func)
+
+    def start(self):
+        """Launch the process and start watching it
+
+        A failure to launch is recorded in the FAILED state, not raised.
+        """
+        self.started = time.monotonic()
+        try:
+            self._process = subprocess.Popen(self.command, stdin=subprocess.DEVNULL,
+                                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                             text=True, errors='replace', bufsize=1,
+                                             pass_fds=self.pass_fds)
+        except (OSError, subprocess.SubprocessError) as e:
+            self.error = e
+            self._finish(FAILED)
+            return
+
+        self.state = RUNNING
+        self._changed()
+        threading.Thread(target=self._watch, name=f"win9xman-emulator-{self.id}", daemon=True).start()
+
+    def _watch(self):
+        """Collect the output until the process exits"""
+        for line in self._process.stdout:
+            entry = parse_line(line)
+            with self._lock:
+                self.log.append(entry)
+                self.line_count += 1
+        self._process.stdout.close()
+        self.returncode = self._process.wait()
+        self._finish(EXITED)
+
+    def _finish(self, state):
+        """Record the end of the process and run the cleanups"""
+        self.finished = time.monotonic()
+        self.placement.release()
+        for cleanup in reversed(self._cleanups):
+            try:
+                cleanup()
+            except Exception:
+                pass
+        self.state = state
+        self._finished.set()
+        self._changed()
+
+    def wait(self, timeout=None):
+        """Wait for the process to end
+
+        Args:
+            timeout: Seconds to wait at most, None to wait for ever
+
+        Returns:
+            bool: True if the process has ended
+        """
+        return self._finished.wait(timeout)
+
+    def _changed(self):
+        """Announce a state change"""
+        if self._notify:
+            self._notify(self)
+
+    @property
+    def finished_ok(self):
+        """Check if the process ran and exited with status 0"""
+        return self.state == EXITED and self.returncode == 0
+
+    def lines_since(self, count):
+        """Get the output lines after the first count lines
+
+        Args:
+            count: Number of lines already seen, from line_count
+
+        Returns:
+            tuple: (list of (level, text) lines still in the log, new line_count)
+        """
+        with self._lock:
+            new = min(self.line_count - count, len(self.log))
+            lines = list(itertools.islice(self.log, len(self.log) - new, None))
+            return lines, self.line_count
+
+    def elapsed(self):
+        """Get the run time of the process in seconds"""
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.monotonic()) - self.started
+
+    def terminate(self):
+        """Ask the process to exit"""
+        if self._process is not None and self.state == RUNNING:
+            self._process.terminate()
+
+
+class Supervisor:
+    """Launch and track DOSBox-X processes
+
+    Args:
+        cpu_locks_dir: Directory of the CPU lock files, shared by every
+            manager of the user; in the runtime directory by default
+    """
+
+    def __init__(self, cpu_locks_dir=None):
+        self.events = queue.Queue()
+        self.processes = []
+        self._cpu_locks_dir = cpu_locks_dir
+
+    def launch(self, title, command, cleanup=None, placement=None, pass_fds=()):
+        """Start a process without waiting for it
+
+        Args:
+            title: Human readable description of the instance
+            command: Command line to run
+            cleanup: Optional function to run once the process has ended
+            placement: Optional Placement of the process on the host
+            pass_fds: Descriptors the process inherits
+
+        Returns:
+            EmulatorProcess: The process, RUNNING or already FAILED
+        """
+        process = EmulatorProcess(title, command, notify=self.events.put,
+                                  placement=placement, pass_fds=pass_fds)
+        if cleanup:
+            process.add_cleanup(cleanup)
+        self.processes.append(process)
+        process.start()
+        return process
+
+    def running(self):
+        """List the processes that have not ended yet"""
+        self.processes = [p for p in self.processes if p.state not in FINISHED_STATES]
+        return list(self.processes)
+
+    def placement(self, cpu_affinity='', cpus_per_instance=1, nice=0, ionice=''):
+        """Build the Placement of a new instance from the [instances] settings
+
+        The CPUs of a pinned instance are locked until it exits (see
+        CpuLocks); the Placement holds the locks until it is passed to a
+        process, or released.
+
+        Args:
+            cpu_affinity: CPU list, empty for no pinning, or auto to pick the
+                CPUs the fewest running instances of any manager are pinned to
+            cpus_per_instance: Number of CPUs picked with auto
+            nice: Niceness to add
+            ionice: I/O scheduling class and level, see Placement
+
+        Raises:
+            ValueError: If a setting is invalid
+        """
+        cpu_affinity = cpu_affinity.strip()
+        locks = self.cpu_locks()
+        allocation = locks.allocation() if cpu_affinity == 'auto' else None
+        try:
+            if cpu_affinity == 'auto':
+                cpus = self.allocate_cpus(cpus_per_instance, locks)
+            else:
+                cpus = parse_cpu_list(cpu_affinity)
+            held = locks.hold(cpus & available_cpus())
+        finally:
+            if allocation is not None:
+                os.close(allocation)
+        try:
+            return Placement(cpus, nice, ionice.strip(), cpu_locks=held)
+        except BaseException:
+            for fd in held:
+                os.close(fd)
+            raise
+
+    def cpu_locks(self):
+        """Get the CPU lock files shared with the other managers"""
+        return CpuLocks(self._cpu_locks_dir or runtime_directory() / CPU_LOCKS_DIR)
+
+    def allocate_cpus(self, count, locks=None):
+        """Pick CPUs for a new instance, preferring those no instance is pinned to
+
+        Instances of this supervisor are counted per CPU; those of other
+        managers, seen through the CPU locks, count once for each CPU.
+
+        Args:
+            count: Number of CPUs wanted
+            locks: CpuLocks to check, those of cpu_locks by default
+
+        Returns:
+            set: The CPUs, empty if CPU pinning isn't supported
+        """
+        locks = locks or self.cpu_locks()
+        used = collections.Counter(cpu for process in self.running() for cpu in process.placement.cpus)
+        for cpu in available_cpus():
+            if not used[cpu] and locks.in_use(cpu):
+                used[cpu] = 1
+        # Stable sort: the least used CPUs first, lower numbers first among equals
+        return set(sorted(available_cpus(), key=lambda cpu: used[cpu])[:count])
+
+    def drain_events(self):
+        """Get the processes that changed since the last call, without blocking"""
+        changed = {}
+        while True:
+            try:
+                process = self.events.get_nowait()
+            except queue.Empty:
+                break
+            changed[process.id] = process
+        return list(changed.values())
@@ -0,0 +1,281 @@
+"""
+FAT32 hard disk image layout
+
+Builds blank, partitioned FAT32 hard disk images the way DOS FDISK and FORMAT
+would: an MBR with one active partition, the FAT32 boot sector with its
+FSInfo sector and backup copies, and two empty FATs. Only these metadata
+sectors are written; the rest of the image is a hole, so even a 4 GB image is
+created instantly and takes a few kilobytes on the host.
+"""
+
+import os
+import struct
+import time
+from pathlib import Path
+
+from win9xman.core.vhd import VhdImage, create_vhd, is_vhd, usable_size
+
+SECTOR_SIZE = 512
+
+# The partition starts on the second track, like FDISK lays it out
+PARTITION_START = 63
+SECTORS_PER_TRACK = 63
+
+RESERVED_SECTORS = 32
+NUM_FATS = 2
+ROOT_CLUSTER = 2
+FSINFO_SECTOR = 1
+BACKUP_BOOT_SECTOR = 6
+MEDIA_DESCRIPTOR = 0xF8
+
+# FAT32 needs at least this many clusters, or it would be read as FAT16
+MIN_FAT32_CLUSTERS = 65525
+
+FAT32_EOC = 0x0FFFFFFF
+FAT32_MASK = 0x0FFFFFFF
+
+# Partition types
+PARTITION_FAT32_CHS = 0x0B
+PARTITION_FAT32_LBA = 0x0C
+
+# Master boot code: relocates itself to 0x0600, finds the active partition
+# and chain loads its boot sector through the BIOS
+MBR_CODE = bytes.fromhex(
+    "fa31c08ed0bc007c8ed88ec0fbfcbe007cbf0006b90001f3a5ea1e060000bebe07"
+    "b90400803c80740783c610e2f6cd18bb007c8a74018b4c02b80102cd13720d813e"
+    "fe7d55aa7505ea007c0000be6106ac08c07409b40ebb0700cd10ebf2f4ebfd4d69"
+    "7373696e67206f7065726174696e672073797374656d00"
+)
+
+# Volume boot code until an OS is installed: asks for a system disk and
+# reboots, like the boot sector FORMAT writes without /S
+BOOT_CODE = bytes.fromhex(
+    "fa31c08ed88ed0bc007cfbbe7c7cac08c07409b40ebb0700cd10ebf231c0cd16cd19"
+    "0d0a4e6f6e2d73797374656d206469736b206f72206469736b206572726f720d0a"
+    "5265706c61636520616e6420707265737320616e79206b6579207768656e207265"
+    "6164790d0a00"
+)
+
+# The boot code starts right after the FAT32 BPB
+BOOT_CODE_OFFSET = 0x5A
+
+
+def sectors_per_cluster(volume_sectors):
+    """Pick the cluster size Windows uses for a FAT32 volume of this size
+
+    Args:
+        volume_sectors: Size of the volume in 512-byte sectors
+
+    Returns:
+        int: Sectors per cluster
+    """
+    if volume_sectors <= 532480:       # up to 260 MB
+        return 1
+    if volume_sectors <= 16777216:     # up to 8 GB
+        return 8
+    if volume_sectors <= 33554432:     # up to 16 GB
+        return 16
+    if volume_sectors <= 67108864:     # up to 32 GB
+        return 32
+    return 64
+
+
+def disk_geometry(total_sectors):
+    """Get the BIOS translated (cylinders, heads, sectors per track) of a disk"""
+    heads = 16
+    # Double the heads until the cylinders fit in the 1024 the BIOS allows
+    while heads < 255 and total_sectors // (heads * SECTORS_PER_TRACK) > 1024:
+        heads = 255 if heads == 128 else heads * 2
+    cylinders = total_sectors // (heads * SECTORS_PER_TRACK)
+    return cylinders, heads, SECTORS_PER_TRACK
+
+
+def _chs(lba, heads, sectors):
+    """Encode an LBA sector number as the 3-byte CHS of a partition entry"""
+    cylinder = lba // (heads * sectors)
+    if cylinder > 1023:
+        # Past the CHS limit, only the LBA fields of the entry are meaningful
+        return bytes([254, 0xFF, 0xFF])
+    head = (lba // sectors) % heads
+    sector = lba % sectors + 1
+    return bytes([head, ((cylinder >> 2) & 0xC0) | sector, cylinder & 0xFF])
+
+
+class Fat32Layout:
+    """Sizes and positions of the structures of a FAT32 partition
+
+    Args:
+        total_sectors: Size of the whole disk in sectors
+    """
+
+    def __init__(self, total_sectors):
+        self.total_sectors = total_sectors
+        self.cylinders, self.heads, self.sectors_per_track = disk_geometry(total_sectors)
+        self.partition_start = PARTITION_START
+        self.partition_sectors = total_sectors - PARTITION_START
+        self.sectors_per_cluster = sectors_per_cluster(self.partition_sectors)
+
+        # FAT size from the formula in Microsoft's FAT specification
+        tmp1 = self.partition_sectors - RESERVED_SECTORS
+        tmp2 = (256 * self.sectors_per_cluster + NUM_FATS) // 2
+        self.fat_sectors = (tmp1 + tmp2 - 1) // tmp2
+
+        self.data_start = RESERVED_SECTORS + NUM_FATS * self.fat_sectors
+        self.cluster_count = (self.partition_sectors - self.data_start) // self.sectors_per_cluster
+
+        if self.cluster_count < MIN_FAT32_CLUSTERS:
+            raise ValueError(f"A disk of {total_sectors * SECTOR_SIZE // (1024 * 1024)}MB "
+                             f"is too small for FAT32")
+
+    @property
+    def cluster_size(self):
+        """Size of a cluster in bytes"""
+        return self.sectors_per_cluster * SECTOR_SIZE
+
+    def partition_offset(self, sector=0):
+        """Get the image offset of a sector of the partition"""
+        return (self.partition_start + sector) * SECTOR_SIZE
+
+    def fat_offset(self, copy=0):
+        """Get the image offset of one of the FAT copies"""
+        return self.partition_offset(RESERVED_SECTORS + copy * self.fat_sectors)
+
+    def cluster_offset(self, cluster):
+        """Get the image offset of a data cluster"""
+        return self.partition_offset(self.data_start + (cluster - 2) * self.sectors_per_cluster)
+
+
+def build_mbr(layout):
+    """Build the master boot record with one active FAT32 partition"""
+    mbr = bytearray(SECTOR_SIZE)
+    mbr[:len(MBR_CODE)] = MBR_CODE
+
+    first = layout.partition_start
+    last = layout.partition_start + layout.partition_sectors - 1
+    heads, sectors = layout.heads, layout.sectors_per_track
+    lba = last // (heads * sectors) > 1023
+    entry = (bytes([0x80]) + _chs(first, heads, sectors)
+             + bytes([PARTITION_FAT32_LBA if lba else PARTITION_FAT32_CHS])
+             + _chs(last, heads, sectors)
+             + struct.pack('<II', first, layout.partition_sectors))
+    mbr[0x1BE:0x1BE + 16] = entry
+    mbr[510:512] = b'\x55\xAA'
+    return bytes(mbr)
+
+
+def build_boot_sector(layout, label="NO NAME", serial=None):
+    """Build the FAT32 boot sector (BPB, extended BPB and boot code)"""
+    if serial is None:
+        serial = int(time.time()) & 0xFFFFFFFF
+
+    boot = bytearray(SECTOR_SIZE)
+    boot[0:3] = b'\xEB\x58\x90'
+    boot[3:11] = b'MSWIN4.1'
+    struct.pack_into('<HBHBHHBHHHII', boot, 11,
+                     SECTOR_SIZE,
+                     layout.sectors_per_cluster,
+                     RESERVED_SECTORS,
+                     NUM_FATS,
+                     0,                       # root entries, always 0 on FAT32
+                     0,                       # 16-bit total sectors
+                     MEDIA_DESCRIPTOR,
+                     0,                       # 16-bit FAT size
+                     layout.sectors_per_track,
+                     layout.heads,
+                     layout.partition_start,  # hidden sectors
+                     layout.partition_sectors)
+    struct.pack_into('<IHHIHH', boot, 36,
+                     layout.fat_sectors,
+                     0,                       # FAT mirroring on, active FAT 0
+                     0,                       # filesystem version 0.0
+                     ROOT_CLUSTER,
+                     FSINFO_SECTOR,
+                     BACKUP_BOOT_SECTOR)
+    struct.pack_into('<BBBI', boot, 64, 0x80, 0, 0x29, serial)
+    boot[71:82] = label.upper().encode('ascii')[:11].ljust(11)
+    boot[82:90] = b'FAT32   '
+    boot[BOOT_CODE_OFFSET:BOOT_CODE_OFFSET + len(BOOT_CODE)] = BOOT_CODE
+    boot[510:512] = b'\x55\xAA'
+    return bytes(boot)
+
+
+def build_fsinfo(free_clusters, next_free):
+    """Build the FSInfo sector recording the free cluster count"""
+    fsinfo = bytearray(SECTOR_SIZE)
+    struct.pack_into('<I', fsinfo, 0, 0x41615252)
+    struct.pack_into('<III', fsinfo, 484, 0x61417272, free_clusters, next_free)
+    struct.pack_into('<I', fsinfo, 508, 0xAA550000)
+    return bytes(fsinfo)
+
+
+def _label_entry(label):
+    """Build the root directory entry holding the volume label"""
+    entry = bytearray(32)
+    entry[0:11] = label.upper().encode('ascii')[:11].ljust(11)
+    entry[11] = 0x08  # volume label attribute
+    return bytes(entry)
+
+
+def format_fat32(image_path, size, label="NO NAME", progress=None):
+    """Create a blank, partitioned and FAT32 formatted hard disk image
+
+    The image is a sparse file; only the partition table, boot sectors and
+    the first sector of each FAT are written. A path ending in .vhd gets a
+    dynamic VHD instead, sized to a whole number of cylinders.
+
+    Args:
+        image_path: Path of the image file to create
+        size: Size of the image in bytes, rounded down to whole sectors
+        label: Volume label, up to 11 characters
+        progress: Optional callable receiving the number of bytes done
+
+    Returns:
+        Fat32Layout: The layout of the new filesystem
+
+    Raises:
+        ValueError: If the size is too small for a FAT32 volume
+    """
+    image_path = Path(image_path)
+    if is_vhd(image_path):
+        size = usable_size(size)
+    layout = Fat32Layout(size // SECTOR_SIZE)
+
+    boot = build_boot_sector(layout, label)
+    fsinfo = build_fsinfo(layout.cluster_count - 1, ROOT_CLUSTER + 1)
+    # The third boot sector is empty apart from its signature
+    boot_extra = bytes(510) + b'\x55\xAA'
+    # Media descriptor, clean shutdown flags and the root directory's chain
+    fat_start = struct.pack('<III', 0x0FFFFF00 | MEDIA_DESCRIPTOR, FAT32_EOC, FAT32_EOC)
+
+    sectors = [(0, build_mbr(layout))]
+    for base in (0, BACKUP_BOOT_SECTOR):
+        sectors += [(layout.partition_offset(base), boot),
+                    (layout.partition_offset(base + FSINFO_SECTOR), fsinfo),
+                    (layout.partition_offset(base + 2), boot_extra)]
+    for copy in range(NUM_FATS):
+        sectors.append((layout.fat_offset(copy), fat_start))
+    if label.upper() != "NO NAME":
+        sectors.append((layout.cluster_offset(ROOT_CLUSTER), _label_entry(label)))
+
+    try:
+        if is_vhd(image_path):
+            create_vhd(image_path, layout.total_sectors * SECTOR_SIZE)
+            with VhdImage(image_path, writable=True) as image:
+                for offset, data in sectors:
+                    image.write(offset, data)
+                os.fsync(image.fileno())
+        else:
+            with open(image_path, 'wb') as f:
+                f.truncate(layout.total_sectors * SECTOR_SIZE)
+                for offset, data in sectors:
+                    os.pwrite(f.fileno(), data, offset)
+                f.flush()
+                os.fsync(f.fileno())
+    except BaseException:
+        if image_path.exists():
+            image_path.unlink()
+        raise
+
+    if progress:
+        progress(layout.total_sectors * SECTOR_SIZE)
+    return layout
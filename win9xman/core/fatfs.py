@@ -0,0 +1,618 @@
+"""
+Read-only FAT12/16/32 filesystem access to disk images
+
+Lets files be listed and copied out of a guest disk image or snapshot
+without booting it. The partition table, FAT and directories are parsed
+lazily: only the FAT entries and directory clusters actually visited are
+read, and each directory is indexed once, so browsing a multi-gigabyte image
+touches a few kilobytes. File contents are streamed to the host one
+contiguous cluster run at a time.
+"""
+
+import array
+import os
+import struct
+import sys
+from datetime import datetime
+from pathlib import Path, PurePosixPath
+
+from win9xman.core.image import open_image
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+SECTOR_SIZE = 512
+DIR_ENTRY_SIZE = 32
+
+# Directory entry attributes
+ATTR_READ_ONLY = 0x01
+ATTR_HIDDEN = 0x02
+ATTR_SYSTEM = 0x04
+ATTR_VOLUME_ID = 0x08
+ATTR_DIRECTORY = 0x10
+ATTR_ARCHIVE = 0x20
+ATTR_LONG_NAME = 0x0F
+
+DELETED_MARKER = 0xE5
+LFN_LAST_ENTRY = 0x40
+
+# Partition types holding a FAT filesystem
+FAT_PARTITION_TYPES = {0x01, 0x04, 0x06, 0x0B, 0x0C, 0x0E}
+
+# Largest piece of a file read from the image at once
+EXTRACT_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+class FatError(Exception):
+    """Raised when an image holds no readable FAT filesystem"""
+
+
+def list_partitions(image):
+    """List the primary partitions of an MBR partitioned image
+
+    Args:
+        image: An image opened with win9xman.core.image.open_image
+
+    Returns:
+        list: Dicts with the partition 'index', 'type', 'offset' and 'size'
+        in bytes, empty if the image has no partition table
+    """
+    mbr = image.read(0, SECTOR_SIZE)
+    if len(mbr) < SECTOR_SIZE or mbr[510:512] != b'\x55\xAA':
+        return []
+
+    partitions = []
+    for index in range(4):
+        entry = mbr[0x1BE + index * 16:0x1CE + index * 16]
+        part_type = entry[4]
+        start, sectors = struct.unpack_from('<II', entry, 8)
+        if part_type and sectors:
+            partitions.append({
+                'index': index,
+                'type': part_type,
+                'offset': start * SECTOR_SIZE,
+                'size': sectors * SECTOR_SIZE,
+            })
+    return partitions
+
+
+def _is_boot_sector(sector):
+    """Check whether a sector looks like a FAT boot sector"""
+    if len(sector) < SECTOR_SIZE or sector[0] not in (0xEB, 0xE9):
+        return False
+    bytes_per_sector, sectors_per_cluster = struct.unpack_from('<HB', sector, 11)
+    return (bytes_per_sector in (512, 1024, 2048, 4096)
+            and sectors_per_cluster and not sectors_per_cluster & (sectors_per_cluster - 1))
+
+
+def find_fat_partition(image, partition=None):
+    """Find the byte offset of a FAT filesystem in an image
+
+    Args:
+        image: An image opened with win9xman.core.image.open_image
+        partition: Index of the partition to use, the first FAT partition
+            by default
+
+    Returns:
+        int: Offset of the filesystem's boot sector
+
+    Raises:
+        FatError: If no FAT filesystem is found
+    """
+    partitions = list_partitions(image)
+    for entry in partitions:
+        if partition is None and entry['type'] in FAT_PARTITION_TYPES or entry['index'] == partition:
+            return entry['offset']
+
+    # Unpartitioned images (floppies) start with the boot sector
+    if partition is None and _is_boot_sector(image.read(0, SECTOR_SIZE)) and not partitions:
+        return 0
+    raise FatError("No FAT partition found in the disk image")
+
+
+def _decode_timestamp(date, time=0):
+    """Convert a FAT date and time to a datetime, None if unset or invalid"""
+    if not date:
+        return None
+    try:
+        return datetime(1980 + (date >> 9), (date >> 5) & 0x0F, date & 0x1F,
+                        time >> 11, (time >> 5) & 0x3F, (time & 0x1F) * 2)
+    except ValueError:
+        return None
+
+
+def lfn_checksum(short_name):
+    """Checksum of an 11-byte short name, stored in its long name entries"""
+    checksum = 0
+    for byte in short_name:
+        checksum = (((checksum & 1) << 7) + (checksum >> 1) + byte) & 0xFF
+    return checksum
+
+
+def _decode_short_name(raw, case_flags):
+    """Turn an 11-byte 8.3 directory name into its display form"""
+    raw = bytearray(raw)
+    if raw[0] == 0x05:
+        # 0xE5 is a valid first character, stored as 0x05
+        raw[0] = DELETED_MARKER
+    base = raw[:8].decode('cp437').rstrip()
+    ext = raw[8:].decode('cp437').rstrip()
+    # Windows NT stores all-lowercase names as uppercase plus these flags
+    if case_flags & 0x08:
+        base = base.lower()
+    if case_flags & 0x10:
+        ext = ext.lower()
+    return f"{base}.{ext}" if ext else base
+
+
+def free_runs(fat, fat_type=32):
+    """Find the runs of free clusters in a FAT
+
+    Uses a vectorized scan when NumPy is installed, which takes a few
+    milliseconds even for the million entries of a 4 GB volume.
+
+    Args:
+        fat: FAT entries as returned by FatVolume.read_fat
+        fat_type: 16 or 32
+
+    Returns:
+        list: (first cluster, cluster count) of each run, in disk order
+    """
+    mask = 0x0FFFFFFF if fat_type == 32 else 0xFFFF
+    if numpy is not None:
+        free = (numpy.frombuffer(fat, dtype=fat.typecode)[2:] & mask) == 0
+        # Run boundaries are where the free flag flips
+        edges = numpy.flatnonzero(numpy.diff(numpy.concatenate(([0], free.view(numpy.int8), [0]))))
+        return [(int(start) + 2, int(end - start)) for start, end in zip(edges[::2], edges[1::2])]
+
+    runs = []
+    start = None
+    for cluster in range(2, len(fat)):
+        if fat[cluster] & mask == 0:
+            if start is None:
+                start = cluster
+        elif start is not None:
+            runs.append((start, cluster - start))
+            start = None
+    if start is not None:
+        runs.append((start, len(fat) - start))
+    return runs
+
+
+class DirEntry:
+    """A file or directory in a FAT filesystem
+
+    Attributes:
+        name: Long file name, or the short name if there is none
+        short_name: The 8.3 name
+        attributes: Attribute bits (ATTR_*)
+        size: File size in bytes, 0 for directories
+        cluster: First cluster of the contents, 0 if empty
+        modified: Last modification time, or None
+        offset: Image offset of the 8.3 directory entry
+        lfn_offsets: Image offsets of the long name entries
+    """
+
+    __slots__ = ('name', 'short_name', 'attributes', 'size', 'cluster', 'modified',
+                 'offset', 'lfn_offsets')
+
+    def __init__(self, name, short_name, attributes, size, cluster, modified, offset, lfn_offsets=()):
+        self.name = name
+        self.short_name = short_name
+        self.attributes = attributes
+        self.size = size
+        self.cluster = cluster
+        self.modified = modified
+        self.offset = offset
+        self.lfn_offsets = tuple(lfn_offsets)
+
+    @property
+    def is_dir(self):
+        """Whether the entry is a directory"""
+        return bool(self.attributes & ATTR_DIRECTORY)
+
+    def __repr__(self):
+        return f"DirEntry({self.name!r}, size={self.size}, cluster={self.cluster})"
+
+
+def parse_directory(chunks, fat_type):
+    """Parse raw directory entries
+
+    Args:
+        chunks: Iterable of (offset, data) pieces of the directory, in order;
+            entry offsets are reported relative to the same origin
+        fat_type: 12, 16 or 32
+
+    Returns:
+        list: DirEntry objects, without volume labels and dot entries
+    """
+    entries = []
+    lfn_parts = []
+    lfn_offsets = []
+    lfn_checksum_value = None
+
+    for offset, data in chunks:
+        for pos in range(0, len(data) - DIR_ENTRY_SIZE + 1, DIR_ENTRY_SIZE):
+            raw = data[pos:pos + DIR_ENTRY_SIZE]
+            first = raw[0]
+            if first == 0:
+                # End of directory
+                return entries
+            if first == DELETED_MARKER:
+                lfn_parts, lfn_offsets = [], []
+                continue
+
+            attributes = raw[11]
+            if attributes & 0x3F == ATTR_LONG_NAME:
+                if first & LFN_LAST_ENTRY:
+                    lfn_parts, lfn_offsets = [], []
+                    lfn_checksum_value = raw[13]
+                lfn_parts.append(raw[1:11] + raw[14:26] + raw[28:32])
+                lfn_offsets.append(offset + pos)
+                continue
+
+            name = short_name = _decode_short_name(raw[0:11], raw[12])
+            if lfn_parts and lfn_checksum_value == lfn_checksum(raw[0:11]):
+                long_name = b''.join(reversed(lfn_parts)).decode('utf-16-le', 'replace')
+                name = long_name.split('\0', 1)[0]
+            else:
+                lfn_offsets = []
+            lfn_parts = []
+
+            if attributes & ATTR_VOLUME_ID or short_name in ('.', '..'):
+                lfn_offsets = []
+                continue
+
+            cluster_high, mtime, mdate, cluster_low, size = struct.unpack_from('<HHHHI', raw, 20)
+            entries.append(DirEntry(
+                name, short_name, attributes,
+                0 if attributes & ATTR_DIRECTORY else size,
+                (cluster_high << 16 | cluster_low) if fat_type == 32 else cluster_low,
+                _decode_timestamp(mdate, mtime), offset + pos, lfn_offsets))
+            lfn_offsets = []
+
+    return entries
+
+
+class FatVolume:
+    """Read-only view of a FAT12, FAT16 or FAT32 filesystem
+
+    Args:
+        image: An image opened with win9xman.core.image.open_image
+        offset: Byte offset of the boot sector, found from the partition
+            table by default
+        owns_image: Close the image when the volume is closed
+    """
+
+    def __init__(self, image, offset=None, owns_image=False):
+        self.image = image
+        self.offset = find_fat_partition(image) if offset is None else offset
+        self._owns_image = owns_image
+
+        boot = image.read(self.offset, SECTOR_SIZE)
+        if not _is_boot_sector(boot):
+            raise FatError("The partition does not hold a FAT filesystem")
+
+        (self.bytes_per_sector, self.sectors_per_cluster, reserved, self.num_fats,
+         root_entries, total16, _media, fat_size16) = struct.unpack_from('<HBHBHHBH', boot, 11)
+        total32, = struct.unpack_from('<I', boot, 32)
+        total_sectors = total16 or total32
+        fat_size = fat_size16 or struct.unpack_from('<I', boot, 36)[0]
+
+        root_dir_sectors = (root_entries * DIR_ENTRY_SIZE + self.bytes_per_sector - 1) // self.bytes_per_sector
+        first_data_sector = reserved + self.num_fats * fat_size + root_dir_sectors
+
+        self.cluster_size = self.sectors_per_cluster * self.bytes_per_sector
+        self.cluster_count = (total_sectors - first_data_sector) // self.sectors_per_cluster
+        self.fat_size = fat_size * self.bytes_per_sector
+        self.fat_offset = self.offset + reserved * self.bytes_per_sector
+        self.root_dir_offset = self.fat_offset + self.num_fats * self.fat_size
+        self.root_dir_size = root_dir_sectors * self.bytes_per_sector
+        self.data_offset = self.offset + first_data_sector * self.bytes_per_sector
+
+        # The FAT type is defined by the cluster count alone
+        if self.cluster_count < 4085:
+            self.fat_type = 12
+        elif self.cluster_count < 65525:
+            self.fat_type = 16
+        else:
+            self.fat_type = 32
+
+        if self.fat_type == 32:
+            self.root_cluster, = struct.unpack_from('<I', boot, 44)
+            self.eoc = 0x0FFFFFF8
+        else:
+            self.root_cluster = 0
+            self.eoc = 0xFF8 if self.fat_type == 12 else 0xFFF8
+        self.label = bytes(boot[71 if self.fat_type == 32 else 43:][:11]).decode('cp437').rstrip()
+
+        self._runs_cache = {}
+        self._dir_cache = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Close the volume, and its image if it owns it"""
+        self._runs_cache.clear()
+        self._dir_cache.clear()
+        if self._owns_image:
+            self.image.close()
+
+    def cluster_offset(self, cluster):
+        """Get the image offset of a data cluster"""
+        return self.data_offset + (cluster - 2) * self.cluster_size
+
+    def fat_entry(self, cluster):
+        """Read the FAT entry of a cluster (from the first FAT)"""
+        if self.fat_type == 32:
+            data = self.image.read(self.fat_offset + cluster * 4, 4)
+            return struct.unpack('<I', data)[0] & 0x0FFFFFFF
+        if self.fat_type == 16:
+            return struct.unpack('<H', self.image.read(self.fat_offset + cluster * 2, 2))[0]
+        # FAT12 packs two entries into three bytes
+        value, = struct.unpack('<H', self.image.read(self.fat_offset + cluster * 3 // 2, 2))
+        return value >> 4 if cluster & 1 else value & 0x0FFF
+
+    def read_fat(self):
+        """Read the entries of all clusters from the first FAT in one go
+
+        Returns:
+            array: The FAT entries indexed by cluster number, including the
+            two reserved entries
+
+        Raises:
+            FatError: For FAT12, whose packed entries aren't supported here
+        """
+        if self.fat_type == 12:
+            raise FatError("FAT12 tables cannot be loaded as a whole")
+        fat = array.array('I' if self.fat_type == 32 else 'H')
+        entry_count = self.cluster_count + 2
+        fat.frombytes(self.image.read(self.fat_offset, entry_count * fat.itemsize))
+        if sys.byteorder != 'little':
+            fat.byteswap()
+        return fat
+
+    def cluster_runs(self, cluster):
+        """Get the contiguous runs of a cluster chain
+
+        Returns:
+            list: (first cluster, cluster count) of each run, in chain order
+
+        Raises:
+            FatError: If the chain is broken or loops
+        """
+        if cluster in self._runs_cache:
+            return self._runs_cache[cluster]
+
+        start = cluster
+        runs = []
+        visited = 0
+        while 2 <= cluster < self.eoc:
+            if cluster >= self.cluster_count + 2:
+                raise FatError(f"Cluster chain at {start} points past the end of the volume")
+            visited += 1
+            if visited > self.cluster_count:
+                raise FatError(f"Cluster chain at {start} loops")
+            if runs and runs[-1][0] + runs[-1][1] == cluster:
+                runs[-1] = (runs[-1][0], runs[-1][1] + 1)
+            else:
+                runs.append((cluster, 1))
+            cluster = self.fat_entry(cluster)
+
+        self._runs_cache[start] = runs
+        return runs
+
+    def _chain_extents(self, cluster, size=None):
+        """Get the (offset, length) image extents of a cluster chain
+
+        Args:
+            cluster: First cluster of the chain
+            size: Number of bytes wanted, the whole chain by default
+        """
+        remaining = size
+        for first, count in self.cluster_runs(cluster):
+            length = count * self.cluster_size
+            if remaining is not None:
+                length = min(length, remaining)
+                remaining -= length
+            if length:
+                yield self.cluster_offset(first), length
+            if remaining == 0:
+                break
+
+    def _directory(self, cluster):
+        """Get the cached (entries, index by upper-cased name) of a directory"""
+        if cluster not in self._dir_cache:
+            if cluster == 0:
+                # The FAT12/16 root directory has a fixed region
+                extents = [(self.root_dir_offset, self.root_dir_size)]
+            else:
+                extents = self._chain_extents(cluster)
+            entries = parse_directory(((offset, self.image.read(offset, length))
+                                       for offset, length in extents), self.fat_type)
+            index = {}
+            for entry in entries:
+                index[entry.short_name.upper()] = entry
+                index[entry.name.upper()] = entry
+            self._dir_cache[cluster] = (entries, index)
+        return self._dir_cache[cluster]
+
+    def invalidate(self):
+        """Forget cached chains and directories after the image changed"""
+        self._runs_cache.clear()
+        self._dir_cache.clear()
+
+    def _dir_cluster(self, entry):
+        """Get the directory cluster of an entry, None standing for the root"""
+        if entry is None:
+            return self.root_cluster
+        if not entry.is_dir:
+            raise NotADirectoryError(entry.name)
+        # '..' entries pointing at the root store cluster 0 on FAT32 too
+        return entry.cluster or self.root_cluster
+
+    def _resolve(self, path):
+        """Accept a path or an already looked up entry (None being the root)"""
+        if path is None or isinstance(path, DirEntry):
+            return path
+        return self.lookup(path)
+
+    def lookup(self, path):
+        """Find the entry of a path, case-insensitively
+
+        Args:
+            path: '/'-separated path from the root of the volume
+
+        Returns:
+            DirEntry: The entry, or None for the root directory
+
+        Raises:
+            FileNotFoundError: If the path doesn't exist
+        """
+        entry = None
+        for part in PurePosixPath('/', str(path).replace('\\', '/')).parts[1:]:
+            _, index = self._directory(self._dir_cluster(entry))
+            entry = index.get(part.upper())
+            if entry is None:
+                raise FileNotFoundError(f"{path} not found in the disk image")
+        return entry
+
+    def listdir(self, path='/'):
+        """List the entries of a directory
+
+        Args:
+            path: Path of the directory, or its DirEntry
+
+        Returns:
+            list: DirEntry objects, in directory order
+        """
+        entry = self._resolve(path)
+        entries, _ = self._directory(self._dir_cluster(entry))
+        return list(entries)
+
+    def walk(self, path='/'):
+        """Walk a directory tree like os.walk
+
+        Yields:
+            tuple: (path, directory entries, file entries)
+        """
+        path = str(PurePosixPath('/', path))
+        entries = self.listdir(path)
+        dirs = [e for e in entries if e.is_dir]
+        yield path, dirs, [e for e in entries if not e.is_dir]
+        for entry in dirs:
+            yield from self.walk(str(PurePosixPath(path, entry.name)))
+
+    def tree_size(self, path='/'):
+        """Get the total size of the files under a path"""
+        entry = self._resolve(path)
+        if entry is not None and not entry.is_dir:
+            return entry.size
+        return sum(e.size if not e.is_dir else self.tree_size(e) for e in self.listdir(entry))
+
+    def iter_file(self, entry, chunk_size=EXTRACT_CHUNK_SIZE):
+        """Stream the contents of a file
+
+        Args:
+            entry: The DirEntry of the file
+
+        Yields:
+            bytes: Consecutive pieces of the file, one cluster run (or
+            chunk_size) at a time
+        """
+        if not entry.cluster:
+            return
+        for offset, length in self._chain_extents(entry.cluster, entry.size):
+            for start in range(0, length, chunk_size):
+                yield self.image.read(offset + start, min(chunk_size, length - start))
+
+    def read_file(self, path):
+        """Read a whole file into memory"""
+        entry = self.lookup(path)
+        if entry is None or entry.is_dir:
+            raise IsADirectoryError(path)
+        return b''.join(self.iter_file(entry))
+
+    def extract(self, path, dest, progress=None):
+        """Copy a file or directory tree out of the image
+
+        Args:
+            path: Path in the image, or a DirEntry
+            dest: Host path to create; for a directory, its contents go below it
+            progress: Optional callable receiving the number of bytes copied
+
+        Raises:
+            FatError: If a name in the image isn't a plain file name, e.g.
+                a crafted long name such as ../x, which would leave dest, or
+                a directory contains itself
+        """
+        self._extract(self._resolve(path), Path(dest), Path(dest).resolve(), set(), progress)
+
+    def _extract(self, entry, dest, root, visited, progress=None):
+        """Copy an entry to dest, which must stay below root, see extract
+
+        Args:
+            visited: First clusters of the directories being extracted
+                above this entry
+
+        Raises:
+            FatError: If a name in the image would leave root, or a
+                directory is its own ancestor
+        """
+        if entry is None or entry.is_dir:
+            cluster = self._dir_cluster(entry)
+            if cluster in visited:
+                raise FatError(f"{dest.name!r} in the image loops back to a directory that contains it")
+            dest.mkdir(parents=True, exist_ok=True)
+            for child in self.listdir(entry):
+                # Names come from the guest and may be crafted
+                check_host_name(child.name)
+                target = dest / child.name
+                if os.path.commonpath([root, target.resolve()]) != str(root):
+                    raise FatError(f"{child.name!r} in the image points outside {root}")
+                self._extract(child, target, root, visited | {cluster}, progress)
+        else:
+            with open(dest, 'wb') as f:
+                for data in self.iter_file(entry):
+                    f.write(data)
+                    if progress:
+                        progress(len(data))
+
+        if entry is not None and entry.modified:
+            timestamp = entry.modified.timestamp()
+            os.utime(dest, (timestamp, timestamp))
+
+
+def check_host_name(name):
+    """Make sure a file name from the image is a single host path component
+
+    Raises:
+        FatError: If the name is empty, . or .., or holds a separator or NUL
+    """
+    if name in ('', '.', '..') or any(char in name for char in '/\\\0'):
+        raise FatError(f"Unsafe file name in the image: {name!r}")
+
+
+def open_volume(path, partition=None):
+    """Open the FAT filesystem of a disk image or snapshot
+
+    Args:
+        path: Path of a raw image or manifest snapshot
+        partition: Index of the partition, the first FAT partition by default
+
+    Returns:
+        FatVolume: The volume, owning the opened image
+    """
+    image = open_image(path)
+    try:
+        offset = find_fat_partition(image, partition)
+        return FatVolume(image, offset, owns_image=True)
+    except BaseException:
+        image.close()
+        raise
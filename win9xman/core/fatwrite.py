@@ -0,0 +1,584 @@
+"""
+Offline writing to FAT32 disk images
+
+Copies host files and directory trees straight into a guest disk image, so
+installing software doesn't mean copying everything twice through a shared
+drive at emulated speed. The whole FAT is loaded once and clusters are
+allocated from its free runs, each file in one contiguous run where
+possible. File data is copied into the image first (with copy_file_range
+where available); the FATs, directories and FSInfo sector are only written
+when everything has been copied. An interrupted copy therefore leaves the
+filesystem as it was, and a crash during that final write at worst leaves
+lost clusters for ScanDisk to reclaim.
+
+The image must not be in use by DOSBox-X while it is written.
+"""
+
+import errno
+import os
+import struct
+import sys
+from datetime import datetime
+from pathlib import Path
+
+from win9xman.core.fatfs import (ATTR_ARCHIVE, ATTR_DIRECTORY, ATTR_LONG_NAME, DELETED_MARKER,
+                                 DIR_ENTRY_SIZE, FatError, FatVolume, free_runs, lfn_checksum,
+                                 parse_directory)
+from win9xman.core.image import RawImage
+from win9xman.core.vhd import is_vhd
+from win9xman.utils.fileops import copy_range
+
+FAT32_EOC = 0x0FFFFFFF
+FAT32_MASK = 0x0FFFFFFF
+
+# Characters not allowed in long names, replaced by '_'
+INVALID_LONG_CHARS = set('\\/:*?"<>|')
+# Characters additionally not allowed in short names
+INVALID_SHORT_CHARS = INVALID_LONG_CHARS | set('+,;=[] .')
+
+LFN_CHARS_PER_ENTRY = 13
+MAX_LONG_NAME = 255
+
+DOT_NAME = b'.          '
+DOTDOT_NAME = b'..         '
+
+
+def encode_timestamp(timestamp):
+    """Convert a POSIX timestamp to FAT (date, time), clamped to 1980-2107"""
+    when = datetime.fromtimestamp(timestamp)
+    if when.year < 1980:
+        return (1 << 5) | 1, 0
+    if when.year > 2107:
+        when = datetime(2107, 12, 31, 23, 59, 58)
+    date = ((when.year - 1980) << 9) | (when.month << 5) | when.day
+    time = (when.hour << 11) | (when.minute << 5) | (when.second // 2)
+    return date, time
+
+
+def guest_name(name):
+    """Turn a host file name into a valid long file name"""
+    name = ''.join('_' if c in INVALID_LONG_CHARS or ord(c) < 0x20 else c for c in name)
+    # Windows drops trailing dots and spaces
+    name = name.rstrip('. ')
+    if not name:
+        raise ValueError("File name is empty once made valid for FAT")
+    if len(name) > MAX_LONG_NAME:
+        raise ValueError(f"File name {name} is longer than {MAX_LONG_NAME} characters")
+    return name
+
+
+def _short_char(c):
+    """Map a character to one allowed in short names"""
+    c = c.upper()
+    if c in INVALID_SHORT_CHARS or not ' ' < c <= '~':
+        return '_'
+    return c
+
+
+def _is_short_name(name):
+    """Check whether a name already is a valid upper-case 8.3 name"""
+    base, dot, ext = name.partition('.')
+    return (0 < len(base) <= 8 and len(ext) <= 3 and not (dot and not ext)
+            and all(_short_char(c) == c for c in base + ext))
+
+
+def raw_short_name(display_name):
+    """Convert a displayed 8.3 name back to its 11-byte directory form"""
+    base, _, ext = display_name.upper().partition('.')
+    raw = bytearray(base.ljust(8)[:8].encode('cp437', 'replace') + ext.ljust(3)[:3].encode('cp437', 'replace'))
+    if raw[0] == DELETED_MARKER:
+        raw[0] = 0x05
+    return bytes(raw)
+
+
+def make_short_name(name, taken):
+    """Generate the 8.3 name of a long name, like Windows 95 does
+
+    Args:
+        name: The long file name
+        taken: Set of 11-byte short names already used in the directory
+
+    Returns:
+        tuple: (11-byte short name, whether long name entries are needed)
+    """
+    if _is_short_name(name.upper()):
+        raw = raw_short_name(name)
+        if raw not in taken:
+            # Lower or mixed case names keep their case in a long name
+            return raw, name != name.upper()
+
+    stripped = name.lstrip('.')
+    base, _, ext = stripped.rpartition('.') if '.' in stripped else (stripped, '', '')
+    base = ''.join(_short_char(c) for c in base if c not in ' .') or '_'
+    ext = ''.join(_short_char(c) for c in ext if c != ' ')[:3]
+
+    for number in range(1, 1000000):
+        tail = f"~{number}"
+        raw = (base[:8 - len(tail)] + tail).ljust(8).encode('ascii') + ext.ljust(3).encode('ascii')
+        if raw not in taken:
+            return raw, True
+    raise FatError(f"No free short name for {name}")
+
+
+def long_name_slots(name):
+    """Number of long name entries a name needs"""
+    return (len(name.encode('utf-16-le')) // 2 + LFN_CHARS_PER_ENTRY - 1) // LFN_CHARS_PER_ENTRY
+
+
+def build_lfn_entries(name, short_name):
+    """Build the long name directory entries of a name, in on-disk order"""
+    units = name.encode('utf-16-le')
+    chars = [units[i:i + 2] for i in range(0, len(units), 2)]
+    count = long_name_slots(name)
+    if len(chars) % LFN_CHARS_PER_ENTRY:
+        chars.append(b'\0\0')
+    chars.extend([b'\xff\xff'] * (count * LFN_CHARS_PER_ENTRY - len(chars)))
+    checksum = lfn_checksum(short_name)
+
+    entries = []
+    for index in range(count):
+        part = chars[index * LFN_CHARS_PER_ENTRY:(index + 1) * LFN_CHARS_PER_ENTRY]
+        entry = bytearray(DIR_ENTRY_SIZE)
+        entry[0] = (index + 1) | (0x40 if index == count - 1 else 0)
+        entry[1:11] = b''.join(part[0:5])
+        entry[11] = ATTR_LONG_NAME
+        entry[13] = checksum
+        entry[14:26] = b''.join(part[5:11])
+        entry[28:32] = b''.join(part[11:13])
+        entries.append(bytes(entry))
+    # The last part comes first on disk
+    return list(reversed(entries))
+
+
+def build_short_entry(short_name, attributes, cluster, size, mtime):
+    """Build an 8.3 directory entry"""
+    entry = bytearray(DIR_ENTRY_SIZE)
+    entry[0:11] = short_name
+    entry[11] = attributes
+    date, time = encode_timestamp(mtime)
+    struct.pack_into('<BHHHHHHHI', entry, 13, 0, time, date, date, cluster >> 16,
+                     time, date, cluster & 0xFFFF, size)
+    return bytes(entry)
+
+
+class _Directory:
+    """In-memory copy of a directory being modified
+
+    Args:
+        clusters: The clusters of the directory, in chain order
+        data: Its current contents
+    """
+
+    def __init__(self, clusters, data):
+        self.clusters = clusters
+        self.data = bytearray(data)
+        self.dirty = False
+
+        entries = parse_directory([(0, self.data)], 32)
+        end = self._end_of_directory()
+        # Anything past the end marker is garbage from older entries
+        self.data[end:] = bytes(len(self.data) - end)
+
+        self.index = {}
+        self.taken = {DOT_NAME, DOTDOT_NAME}
+        for entry in entries:
+            self._index(entry)
+
+    @property
+    def cluster(self):
+        """First cluster of the directory"""
+        return self.clusters[0]
+
+    def _end_of_directory(self):
+        """Get the position of the end-of-directory marker"""
+        for pos in range(0, len(self.data), DIR_ENTRY_SIZE):
+            if self.data[pos] == 0:
+                return pos
+        return len(self.data)
+
+    def _index(self, entry):
+        """Add an entry to the name index"""
+        self.index[entry.name.upper()] = entry
+        self.index[entry.short_name.upper()] = entry
+        self.taken.add(raw_short_name(entry.short_name))
+
+    def find(self, name):
+        """Find an entry by long or short name, case-insensitively"""
+        return self.index.get(name.upper())
+
+    def find_slots(self, count):
+        """Find a position for count consecutive entries, or None if full"""
+        run = 0
+        for pos in range(0, len(self.data), DIR_ENTRY_SIZE):
+            if self.data[pos] in (0, DELETED_MARKER):
+                run += 1
+                if run == count:
+                    return pos - (count - 1) * DIR_ENTRY_SIZE
+            else:
+                run = 0
+        return None
+
+    def put(self, pos, entries):
+        """Write raw entries at a position"""
+        for entry in entries:
+            self.data[pos:pos + DIR_ENTRY_SIZE] = entry
+            pos += DIR_ENTRY_SIZE
+        self.dirty = True
+
+    def remove(self, entry):
+        """Mark an entry and its long name entries as deleted"""
+        for pos in (entry.offset,) + entry.lfn_offsets:
+            self.data[pos] = DELETED_MARKER
+        self.index = {name: e for name, e in self.index.items() if e is not entry}
+        self.taken.discard(raw_short_name(entry.short_name))
+        self.dirty = True
+
+
+class FatWriter:
+    """Writes files and directories into a FAT32 image
+
+    Changes to the FATs, directories and FSInfo are kept in memory until
+    flush(); only file data is written to the image right away, into
+    clusters that are still free on disk.
+
+    Args:
+        image_path: Path of the raw disk image
+    """
+
+    def __init__(self, image_path):
+        if is_vhd(image_path):
+            raise FatError("Files can only be copied into raw disk images; convert the VHD to raw first")
+        self.image = RawImage(image_path, writable=True)
+        try:
+            self.volume = FatVolume(self.image)
+            if self.volume.fat_type != 32:
+                raise FatError(f"Only FAT32 volumes can be written, not FAT{self.volume.fat_type}")
+        except BaseException:
+            self.image.close()
+            raise
+
+        self.cluster_size = self.volume.cluster_size
+        self.fat = self.volume.read_fat()
+        self._free = [list(run) for run in free_runs(self.fat)]
+        # Clusters freed now only become reusable once the change is on disk
+        self._released = []
+        self._dirty_fat = set()
+        self._dirs = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Close the image, dropping anything not flushed"""
+        self.volume.close()
+        self.image.close()
+
+    def free_clusters(self):
+        """Number of clusters available for allocation"""
+        return sum(count for _, count in self._free)
+
+    def _set_fat(self, cluster, value):
+        """Change a FAT entry in memory"""
+        self.fat[cluster] = (self.fat[cluster] & ~FAT32_MASK) | value
+        self._dirty_fat.add(cluster * 4 // self.volume.bytes_per_sector)
+
+    def allocate(self, count):
+        """Allocate and chain clusters, contiguously if at all possible
+
+        Args:
+            count: Number of clusters
+
+        Returns:
+            list: (first cluster, count) runs of the new chain, in order
+
+        Raises:
+            OSError: ENOSPC if the volume is full
+        """
+        if count > self.free_clusters():
+            raise OSError(errno.ENOSPC, "Not enough free space in the disk image")
+
+        runs = []
+        # First fit keeps consecutive allocations next to each other
+        for run in self._free:
+            if run[1] >= count:
+                runs.append((run[0], count))
+                break
+        else:
+            # No single gap is big enough, fill the largest ones
+            remaining = count
+            for run in sorted(self._free, key=lambda r: -r[1]):
+                take = min(run[1], remaining)
+                runs.append((run[0], take))
+                remaining -= take
+                if not remaining:
+                    break
+            runs.sort()
+
+        for start, length in runs:
+            for run in self._free:
+                if run[0] == start:
+                    run[0] += length
+                    run[1] -= length
+                    break
+        self._free = [run for run in self._free if run[1]]
+
+        clusters = [c for start, length in runs for c in range(start, start + length)]
+        for cluster, next_cluster in zip(clusters, clusters[1:]):
+            self._set_fat(cluster, next_cluster)
+        self._set_fat(clusters[-1], FAT32_EOC)
+        return runs
+
+    def _chain(self, cluster):
+        """Follow a cluster chain in the in-memory FAT"""
+        clusters = []
+        while 2 <= cluster < 0x0FFFFFF8 and len(clusters) <= len(self.fat):
+            clusters.append(cluster)
+            cluster = self.fat[cluster] & FAT32_MASK
+        return clusters
+
+    def release(self, cluster):
+        """Free the cluster chain starting at a cluster"""
+        for c in self._chain(cluster):
+            self._set_fat(c, 0)
+            self._released.append([c, 1])
+
+    def _directory(self, cluster):
+        """Get the in-memory copy of a directory"""
+        cluster = cluster or self.volume.root_cluster
+        if cluster not in self._dirs:
+            clusters = self._chain(cluster)
+            data = b''.join(self.image.read(self.volume.cluster_offset(c), self.cluster_size)
+                            for c in clusters)
+            self._dirs[cluster] = _Directory(clusters, data)
+        return self._dirs[cluster]
+
+    def open_dir(self, path):
+        """Get the in-memory copy of the directory at a path"""
+        entry = self.volume.lookup(path)
+        if entry is not None and not entry.is_dir:
+            raise NotADirectoryError(path)
+        return self._directory(entry.cluster if entry else self.volume.root_cluster)
+
+    def _add_entry(self, directory, name, attributes, cluster, size, mtime):
+        """Add a named entry to a directory, growing it if needed"""
+        short_name, needs_lfn = make_short_name(name, directory.taken)
+        entries = build_lfn_entries(name, short_name) if needs_lfn else []
+        entries.append(build_short_entry(short_name, attributes, cluster, size, mtime))
+
+        pos = directory.find_slots(len(entries))
+        while pos is None:
+            # Grow by one cluster; the new one must start out zeroed
+            (new_cluster, _), = self.allocate(1)
+            self._set_fat(directory.clusters[-1], new_cluster)
+            directory.clusters.append(new_cluster)
+            directory.data.extend(bytes(self.cluster_size))
+            pos = directory.find_slots(len(entries))
+        directory.put(pos, entries)
+
+        entry = parse_directory([(pos, directory.data[pos:pos + len(entries) * DIR_ENTRY_SIZE])], 32)[0]
+        directory._index(entry)
+        return entry
+
+    def make_dir(self, parent, name, mtime, slots=0):
+        """Create a subdirectory
+
+        Args:
+            parent: The parent _Directory
+            name: Name of the new directory
+            mtime: Modification time, as a POSIX timestamp
+            slots: Number of entries to reserve room for
+
+        Returns:
+            _Directory: The new directory
+        """
+        entries_per_cluster = self.cluster_size // DIR_ENTRY_SIZE
+        count = max(1, (slots + 2 + entries_per_cluster - 1) // entries_per_cluster)
+        runs = self.allocate(count)
+        clusters = [c for start, length in runs for c in range(start, start + length)]
+
+        directory = _Directory(clusters, bytes(count * self.cluster_size))
+        # '..' refers to the root as cluster 0
+        parent_cluster = 0 if parent.cluster == self.volume.root_cluster else parent.cluster
+        directory.put(0, [build_short_entry(DOT_NAME, ATTR_DIRECTORY, directory.cluster, 0, mtime),
+                          build_short_entry(DOTDOT_NAME, ATTR_DIRECTORY, parent_cluster, 0, mtime)])
+        self._dirs[directory.cluster] = directory
+
+        self._add_entry(parent, name, ATTR_DIRECTORY, directory.cluster, 0, mtime)
+        return directory
+
+    def write_file(self, parent, name, source, progress=None):
+        """Copy a host file into a directory
+
+        Args:
+            parent: The _Directory to add the file to
+            name: Name of the file in the image
+            source: Path of the host file
+            progress: Optional callable receiving the number of bytes copied
+        """
+        with open(source, 'rb') as f:
+            st = os.fstat(f.fileno())
+            size = st.st_size
+            cluster = 0
+            if size:
+                runs = self.allocate((size + self.cluster_size - 1) // self.cluster_size)
+                cluster = runs[0][0]
+                offset = 0
+                for start, length in runs:
+                    length = min(length * self.cluster_size, size - offset)
+                    copy_range(f.fileno(), self.image.fileno(), offset, length, progress,
+                               out_offset=self.volume.cluster_offset(start))
+                    offset += length
+        self._add_entry(parent, name, ATTR_ARCHIVE, cluster, size, st.st_mtime)
+
+    def remove(self, parent, entry):
+        """Delete an entry (and for directories, everything below it)"""
+        if entry.is_dir:
+            directory = self._directory(entry.cluster)
+            for child in list(parse_directory([(0, directory.data)], 32)):
+                self.remove(directory, child)
+            del self._dirs[directory.cluster]
+        if entry.cluster:
+            self.release(entry.cluster)
+        parent.remove(entry)
+
+    def _write_runs(self, offset, data, dirty_units, unit_size):
+        """Write the dirty units of a buffer, coalescing consecutive ones"""
+        units = sorted(dirty_units)
+        start = 0
+        while start < len(units):
+            end = start
+            while end + 1 < len(units) and units[end + 1] == units[end] + 1:
+                end += 1
+            first = units[start] * unit_size
+            self.image.write(offset + first, data[first:(units[end] + 1) * unit_size])
+            start = end + 1
+
+    def flush(self):
+        """Write the FATs, the changed directories and the FSInfo sector"""
+        # File data is already in place; make it durable before anything
+        # points at it
+        os.fsync(self.image.fileno())
+
+        fat = self.fat
+        if sys.byteorder != 'little':
+            fat = fat[:]
+            fat.byteswap()
+        fat_bytes = fat.tobytes()
+        for copy in range(self.volume.num_fats):
+            self._write_runs(self.volume.fat_offset + copy * self.volume.fat_size, fat_bytes,
+                             self._dirty_fat, self.volume.bytes_per_sector)
+
+        for directory in self._dirs.values():
+            if directory.dirty:
+                for index, cluster in enumerate(directory.clusters):
+                    data = directory.data[index * self.cluster_size:(index + 1) * self.cluster_size]
+                    self.image.write(self.volume.cluster_offset(cluster), data)
+                directory.dirty = False
+
+        self._free = _merge_runs(self._free + self._released)
+        self._released = []
+        self._update_fsinfo()
+        os.fsync(self.image.fileno())
+        self._dirty_fat.clear()
+        self.volume.invalidate()
+
+    def _update_fsinfo(self):
+        """Record the new free cluster count in the FSInfo sector"""
+        boot = self.image.read(self.volume.offset, 512)
+        fsinfo_sector, = struct.unpack_from('<H', boot, 48)
+        if not fsinfo_sector or fsinfo_sector == 0xFFFF:
+            return
+        offset = self.volume.offset + fsinfo_sector * self.volume.bytes_per_sector
+        if self.image.read(offset, 4) != b'RRaA':
+            return
+        next_free = self._free[0][0] if self._free else 0xFFFFFFFF
+        self.image.write(offset + 488, struct.pack('<II', self.free_clusters(), next_free))
+
+
+def _merge_runs(runs):
+    """Sort [first, count] cluster runs and merge the adjacent ones"""
+    merged = []
+    for start, count in sorted(runs):
+        if merged and merged[-1][0] + merged[-1][1] == start:
+            merged[-1][1] += count
+        else:
+            merged.append([start, count])
+    return merged
+
+
+def _clusters_needed(path, cluster_size):
+    """Estimate the clusters needed to store a host path"""
+    if not path.is_dir():
+        return (path.stat().st_size + cluster_size - 1) // cluster_size
+    return 1 + sum(_clusters_needed(child, cluster_size) for child in path.iterdir())
+
+
+def tree_size(sources):
+    """Get the number of bytes of file data in host files and directories"""
+    total = 0
+    for source in sources:
+        source = Path(source)
+        if source.is_dir():
+            total += sum(path.stat().st_size for path in source.rglob('*') if path.is_file())
+        else:
+            total += source.stat().st_size
+    return total
+
+
+def _add_path(writer, parent, source, overwrite, progress):
+    """Recursively copy a host path into a directory of the image"""
+    name = guest_name(source.name)
+    existing = parent.find(name)
+
+    if source.is_dir():
+        children = sorted(source.iterdir())
+        if existing is not None and existing.is_dir:
+            directory = writer._directory(existing.cluster)
+        else:
+            if existing is not None:
+                if not overwrite:
+                    raise FileExistsError(f"{name} already exists in the disk image")
+                writer.remove(parent, existing)
+            slots = sum(1 + long_name_slots(guest_name(child.name)) for child in children)
+            directory = writer.make_dir(parent, name, source.stat().st_mtime, slots)
+        for child in children:
+            _add_path(writer, directory, child, overwrite, progress)
+        return
+
+    if existing is not None:
+        if existing.is_dir or not overwrite:
+            raise FileExistsError(f"{name} already exists in the disk image")
+        writer.remove(parent, existing)
+    writer.write_file(parent, name, source, progress)
+
+
+def inject_files(hdd_image, sources, dest='/', overwrite=False, progress=None):
+    """Copy host files and directory trees into a FAT32 disk image
+
+    Directories that already exist in the image are merged into.
+
+    Args:
+        hdd_image: Path of the raw disk image
+        sources: Host files and directories to copy
+        dest: Directory of the image to copy them to
+        overwrite: Replace files that already exist instead of failing
+        progress: Optional callable receiving the number of bytes copied
+
+    Raises:
+        OSError: ENOSPC if the files don't fit, before anything is written
+        FileExistsError: If a file exists and overwrite is not set
+    """
+    sources = [Path(source) for source in sources]
+    with FatWriter(hdd_image) as writer:
+        target = writer.open_dir(dest)
+
+        needed = sum(_clusters_needed(source, writer.cluster_size) for source in sources)
+        if needed > writer.free_clusters():
+            raise OSError(errno.ENOSPC, "Not enough free space in the disk image")
+
+        for source in sources:
+            _add_path(writer, target, source, overwrite, progress)
+        writer.flush()
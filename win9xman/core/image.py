@@ -0,0 +1,169 @@
+"""
+Random access to the contents of disk images and snapshots
+
+Raw images (live disks and reflinked ``.img`` snapshots) are memory mapped,
+so reads are slices of the page cache. Manifest snapshots are read block by
+block from their chunk store, keeping the most recently used blocks
+decompressed. Dynamic VHDs are read through their block allocation table
+(see win9xman.core.vhd). All of them expose the same small read-only
+interface, which is what the filesystem reader (win9xman.core.fatfs) works
+on.
+"""
+
+import contextlib
+import mmap
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+from win9xman.core import snapshot
+from win9xman.core.vhd import VhdImage, is_vhd
+from win9xman.utils.fileops import iter_data_ranges
+
+# Decompressed manifest blocks kept in memory
+BLOCK_CACHE_SIZE = 32
+
+
+class RawImage:
+    """Memory map of a raw disk image file
+
+    Args:
+        path: Path of the image
+        writable: Open the image for writing too. Writes go through pwrite,
+            reads still through the (shared) map.
+    """
+
+    def __init__(self, path, writable=False):
+        self.path = Path(path)
+        self._file = open(self.path, 'rb+' if writable else 'rb')
+        self.size = os.fstat(self._file.fileno()).st_size
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def read(self, offset, length):
+        """Read up to length bytes at an offset"""
+        if self._mmap is None:
+            return b''
+        return self._mmap[offset:offset + length]
+
+    def write(self, offset, data):
+        """Write data at an offset of an image opened writable"""
+        os.pwrite(self._file.fileno(), data, offset)
+
+    def data_ranges(self):
+        """Iterate over the (offset, length) ranges of the image that hold data"""
+        return iter_data_ranges(self._file.fileno(), self.size)
+
+    def fileno(self):
+        """Get the file descriptor of the image file"""
+        return self._file.fileno()
+
+    def close(self):
+        """Unmap and close the image"""
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        self._file.close()
+
+
+class ManifestImage:
+    """Read-only view of the image stored in a manifest snapshot
+
+    Holds a shared lock on the snapshot directory while open, so garbage
+    collection cannot remove the chunks being read.
+    """
+
+    def __init__(self, manifest_path):
+        self.path = Path(manifest_path)
+        self._exit_stack = contextlib.ExitStack()
+        self._exit_stack.enter_context(snapshot.snapshot_lock(self.path.parent))
+        try:
+            manifest, self._blocks = snapshot.resolve_blocks(self.path)
+        except BaseException:
+            self._exit_stack.close()
+            raise
+        self._store = snapshot.get_chunk_store(self.path.parent)
+        self.size = manifest['image_size']
+        self.block_size = manifest['block_size']
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _block(self, index):
+        """Get the contents of one block, from the cache if possible"""
+        with self._cache_lock:
+            if index in self._cache:
+                self._cache.move_to_end(index)
+                return self._cache[index]
+
+        digest = self._blocks[index]
+        if digest is None:
+            data = bytes(min(self.block_size, self.size - index * self.block_size))
+        else:
+            data = self._store.get(digest)
+
+        with self._cache_lock:
+            self._cache[index] = data
+            if len(self._cache) > BLOCK_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return data
+
+    def read(self, offset, length):
+        """Read up to length bytes at an offset"""
+        end = min(offset + length, self.size)
+        parts = []
+        while offset < end:
+            index, start = divmod(offset, self.block_size)
+            data = self._block(index)[start:start + end - offset]
+            parts.append(data)
+            offset += len(data)
+        return parts[0] if len(parts) == 1 else b''.join(parts)
+
+    def close(self):
+        """Release the snapshot directory lock"""
+        self._cache.clear()
+        self._exit_stack.close()
+
+
+def open_image(path):
+    """Open a disk image or snapshot for reading
+
+    Args:
+        path: Path of a raw image or VHD, or of a manifest snapshot
+
+    Returns:
+        RawImage, VhdImage or ManifestImage: The opened image, to be closed
+        by the caller
+    """
+    path = Path(path)
+    if path.suffix == snapshot.MANIFEST_SUFFIX:
+        return ManifestImage(path)
+    if is_vhd(path):
+        return VhdImage(path)
+    return RawImage(path)
+
+
+def open_disk(path, writable=False):
+    """Open a live disk image, raw or VHD
+
+    Args:
+        path: Path of the raw image or VHD
+        writable: Open the image for writing too
+
+    Returns:
+        RawImage or VhdImage: The opened image, to be closed by the caller
+    """
+    if is_vhd(path):
+        return VhdImage(path, writable)
+    return RawImage(path, writable)
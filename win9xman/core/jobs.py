@@ -0,0 +1,191 @@
+"""
+Background job engine for long running disk operations
+
+Jobs run on worker threads and report their progress in bytes. Every state
+or progress change is announced on a thread-safe queue, which the UI drains
+from the Tk main loop, so the window stays responsive during multi-GB copies.
+"""
+
+import itertools
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+FINISHED_STATES = (DONE, FAILED, CANCELLED)
+
+# Minimum delay between two progress notifications of the same job
+NOTIFY_INTERVAL = 0.1
+
+_job_ids = itertools.count(1)
+
+
+class JobCancelled(Exception):
+    """Raised inside a job when it has been cancelled"""
+
+
+class Job:
+    """A unit of background work with byte-accurate progress
+
+    The work function receives the job and passes ``job.progress`` as the
+    progress callback of the core functions it calls. The callback raises
+    JobCancelled once the job is cancelled, which unwinds the work function;
+    cleanup functions registered with add_cleanup then remove partial files.
+    """
+
+    def __init__(self, title, func, total=0, notify=None):
+        self.id = next(_job_ids)
+        self.title = title
+        self.func = func
+        self.total = total
+        self.done = 0
+        self.state = PENDING
+        self.result = None
+        self.error = None
+        self.started = None
+        self.finished = None
+        self._notify = notify
+        self._last_notify = 0
+        self._cancel_event = threading.Event()
+        self._cleanups = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        """Check if cancellation was requested"""
+        return self._cancel_event.is_set()
+
+    def cancel(self):
+        """Request cancellation, the job stops at its next progress report"""
+        self._cancel_event.set()
+
+    def check_cancelled(self):
+        """Raise JobCancelled if cancellation was requested"""
+        if self._cancel_event.is_set():
+            raise JobCancelled(self.title)
+
+    def add_cleanup(self, func):
+        """Register a function to run if the job fails or is cancelled"""
+        self._cleanups.append(func)
+
+    def set_total(self, total):
+        """Set the number of bytes the job is expected to process"""
+        self.total = total
+        self._changed(force=True)
+
+    def progress(self, nbytes):
+        """Advance the job by a number of processed bytes
+
+        Safe to call from several worker threads at once.
+        """
+        with self._lock:
+            self.done += nbytes
+        self._changed()
+        self.check_cancelled()
+
+    def elapsed(self):
+        """Get the run time of the job in seconds"""
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.monotonic()) - self.started
+
+    def throughput(self):
+        """Get the average throughput in bytes per second"""
+        elapsed = self.elapsed()
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    def eta(self):
+        """Get the estimated remaining time in seconds, or None if unknown"""
+        rate = self.throughput()
+        if not self.total or rate <= 0:
+            return None
+        return max(self.total - self.done, 0) / rate
+
+    def _changed(self, force=False):
+        """Announce a change of the job, throttling progress updates"""
+        now = time.monotonic()
+        if not force and now - self._last_notify < NOTIFY_INTERVAL:
+            return
+        self._last_notify = now
+        if self._notify:
+            self._notify(self)
+
+    def _run(self):
+        """Run the work function and record its outcome"""
+        self.started = time.monotonic()
+        self.state = RUNNING
+        self._changed(force=True)
+
+        try:
+            self.check_cancelled()
+            self.result = self.func(self)
+            self.state = DONE
+        except JobCancelled:
+            self.state = CANCELLED
+        except Exception as e:
+            self.error = e
+            self.state = FAILED
+
+        if self.state != DONE:
+            for cleanup in reversed(self._cleanups):
+                try:
+                    cleanup()
+                except Exception:
+                    pass
+
+        self.finished = time.monotonic()
+        self._changed(force=True)
+
+
+class JobManager:
+    """Run jobs on a pool of worker threads"""
+
+    def __init__(self, max_workers=4):
+        self.events = queue.Queue()
+        self.jobs = []
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="win9xman-job")
+
+    def submit(self, title, func, total=0):
+        """Queue a job
+
+        Args:
+            title: Human readable description of the job
+            func: Work function, called with the Job as its only argument
+            total: Expected number of bytes to process, if known up front
+
+        Returns:
+            Job: The queued job
+        """
+        job = Job(title, func, total, notify=self.events.put)
+        self.jobs.append(job)
+        self._executor.submit(job._run)
+        return job
+
+    def active_jobs(self):
+        """List the jobs that have not finished yet"""
+        self.jobs = [job for job in self.jobs if job.state not in FINISHED_STATES]
+        return list(self.jobs)
+
+    def drain_events(self):
+        """Get the jobs that changed since the last call, without blocking"""
+        changed = {}
+        while True:
+            try:
+                job = self.events.get_nowait()
+            except queue.Empty:
+                break
+            changed[job.id] = job
+        return list(changed.values())
+
+    def shutdown(self, cancel=True):
+        """Stop accepting jobs, optionally cancelling the running ones"""
+        if cancel:
+            for job in self.active_jobs():
+                job.cancel()
+        self._executor.shutdown(wait=False)
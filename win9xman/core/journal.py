@@ -0,0 +1,256 @@
+"""
+Crash-safe replacement of disk images
+
+A new image is written to a temporary file next to the live one, flushed to
+disk and atomically renamed over it. A small journal file records the
+operation in progress, so an interrupted replacement is rolled back (temp
+file incomplete) or forward (temp file complete but not renamed yet) the next
+time the manager starts. The live image is never left half written.
+
+Changes to a few blocks are merged in place instead: the new blocks are
+first written to a redo file next to the image, and the journal lists where
+they go. A merge interrupted after that point is replayed on recovery, one
+interrupted before it never touched the image.
+"""
+
+import contextlib
+import json
+import os
+from pathlib import Path
+
+from win9xman.core.lock import ImageLockedError, run_locked
+from win9xman.core.vhd import VhdImage, is_vhd
+
+JOURNAL_SUFFIX = ".journal"
+REDO_SUFFIX = ".redo"
+
+# Journal states
+WRITING = "writing"    # the temporary file is being written
+COMPLETE = "complete"  # the temporary file is fully written and synced
+
+ROLLED_BACK = "rolled back"
+ROLLED_FORWARD = "rolled forward"
+
+
+def journal_path(hdd_image):
+    """Get the path of the journal of a disk image"""
+    hdd_image = Path(hdd_image)
+    return hdd_image.with_name(f".{hdd_image.name}{JOURNAL_SUFFIX}")
+
+
+def redo_path(hdd_image):
+    """Get the path of the file blocks to merge into an image are staged in"""
+    hdd_image = Path(hdd_image)
+    return hdd_image.with_name(f".{hdd_image.name}{REDO_SUFFIX}")
+
+
+def temp_image_path(hdd_image):
+    """Get the path of the temporary file a new image is written to"""
+    hdd_image = Path(hdd_image)
+    return hdd_image.with_name(f".{hdd_image.name}.new")
+
+
+def fsync_path(path):
+    """Flush a file's data to disk"""
+    with open(path, 'rb+') as f:
+        os.fsync(f.fileno())
+
+
+def fsync_dir(directory):
+    """Flush a directory entry change (create, rename, unlink) to disk"""
+    if os.name != 'posix':
+        return
+    fd = os.open(str(directory), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_journal(path, entry):
+    """Write a journal entry durably"""
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, 'w') as f:
+        json.dump(entry, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    fsync_dir(path.parent)
+
+
+def _remove(path):
+    """Remove a file if it exists"""
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def replace_image(hdd_image, write_func, operation="restore", source=None):
+    """Atomically replace a disk image with newly written contents
+
+    Args:
+        hdd_image: Path of the disk image to replace
+        write_func: Called with the temporary path to write the new image to
+        operation: Name of the operation, recorded in the journal
+        source: Optional description of where the new contents come from
+
+    Returns:
+        The return value of write_func
+    """
+    hdd_image = Path(hdd_image)
+    journal = journal_path(hdd_image)
+    tmp_path = temp_image_path(hdd_image)
+    entry = {
+        'operation': operation,
+        'target': hdd_image.name,
+        'temp': tmp_path.name,
+        'source': str(source) if source is not None else None,
+        'state': WRITING,
+    }
+
+    write_journal(journal, entry)
+    try:
+        result = write_func(tmp_path)
+        fsync_path(tmp_path)
+
+        # From here on an interrupted replace is completed on recovery
+        entry['state'] = COMPLETE
+        write_journal(journal, entry)
+
+        os.replace(tmp_path, hdd_image)
+        fsync_dir(hdd_image.parent)
+    except BaseException:
+        _remove(tmp_path)
+        _remove(journal)
+        raise
+
+    _remove(journal)
+    fsync_dir(hdd_image.parent)
+    return result
+
+
+def merge_blocks(hdd_image, offsets, block_size, progress=None):
+    """Write the blocks staged in the redo file into a disk image
+
+    The redo file (see redo_path) holds the new blocks back to back, in the
+    order of their offsets. Once it is synced the merge is recorded in the
+    journal, so a crash from then on is completed on recovery. Raw images
+    and VHDs are both written in place.
+
+    Args:
+        hdd_image: Path of the disk image to update
+        offsets: Ascending offsets in the image of the staged blocks
+        block_size: Size of the staged blocks; only the last block of the
+            image may be shorter
+        progress: Optional callable receiving the number of bytes written
+    """
+    hdd_image = Path(hdd_image)
+    journal = journal_path(hdd_image)
+    redo = redo_path(hdd_image)
+    entry = {
+        'operation': 'merge',
+        'target': hdd_image.name,
+        'redo': redo.name,
+        'block_size': block_size,
+        'offsets': list(offsets),
+        'state': COMPLETE,
+    }
+
+    fsync_path(redo)
+    write_journal(journal, entry)
+    _apply_merge(hdd_image, entry, progress)
+    _remove(journal)
+    _remove(redo)
+    fsync_dir(hdd_image.parent)
+
+
+def _apply_merge(hdd_image, entry, progress=None):
+    """Copy the blocks of a recorded merge from the redo file into the image"""
+    block_size = entry['block_size']
+
+    with contextlib.ExitStack() as stack:
+        fd_in = stack.enter_context(open(redo_path(hdd_image), 'rb')).fileno()
+        if is_vhd(hdd_image):
+            image = stack.enter_context(VhdImage(hdd_image, writable=True))
+            fd_out = image.fileno()
+            write = image.write
+        else:
+            fd_out = stack.enter_context(open(hdd_image, 'rb+')).fileno()
+            write = lambda offset, data: os.pwrite(fd_out, data, offset)
+
+        for position, offset in enumerate(entry['offsets']):
+            data = os.pread(fd_in, block_size, position * block_size)
+            write(offset, data)
+            if progress:
+                progress(len(data))
+        os.fsync(fd_out)
+
+
+def recover_image(hdd_image):
+    """Finish or undo an interrupted image replacement or merge
+
+    Must be called with the image locked (see win9xman.core.lock), or it
+    could undo a replacement another process is in the middle of.
+
+    Returns:
+        str: ROLLED_BACK or ROLLED_FORWARD, or None if nothing was pending
+    """
+    hdd_image = Path(hdd_image)
+    journal = journal_path(hdd_image)
+    if not journal.exists():
+        return None
+
+    try:
+        with open(journal, 'r') as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        # A torn journal write means the temp file wasn't complete either
+        entry = {'state': WRITING}
+
+    tmp_path = temp_image_path(hdd_image)
+    if entry.get('operation') == 'merge':
+        # The journal is only written once the redo file is complete
+        _apply_merge(hdd_image, entry)
+        _remove(redo_path(hdd_image))
+        action = ROLLED_FORWARD
+    elif entry.get('state') == COMPLETE and tmp_path.exists():
+        os.replace(tmp_path, hdd_image)
+        action = ROLLED_FORWARD
+    else:
+        _remove(tmp_path)
+        action = ROLLED_BACK
+
+    _remove(journal)
+    fsync_dir(hdd_image.parent)
+    return action
+
+
+def recover_directory(directory):
+    """Recover every interrupted image replacement in a directory
+
+    Images locked by another process are skipped: their journal and redo
+    files belong to an operation that is still running.
+
+    Returns:
+        dict: The action taken for each recovered image name
+    """
+    directory = Path(directory)
+    recovered = {}
+    for journal in directory.glob(f".*{JOURNAL_SUFFIX}"):
+        hdd_image = directory / journal.name[1:-len(JOURNAL_SUFFIX)]
+        try:
+            action = run_locked(hdd_image, recover_image, hdd_image)
+        except ImageLockedError:
+            continue
+        if action:
+            recovered[hdd_image.name] = action
+
+    # Redo files left without a journal were never merged
+    for redo in directory.glob(f".*{REDO_SUFFIX}"):
+        hdd_image = directory / redo.name[1:-len(REDO_SUFFIX)]
+        try:
+            run_locked(hdd_image, _remove, redo)
+        except ImageLockedError:
+            pass
+    return recovered
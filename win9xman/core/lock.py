@@ -0,0 +1,94 @@
+"""
+Locks that keep two DOSBox-X instances or disk jobs off the same disk image
+
+The lock is an flock on a hidden file next to the image. DOSBox-X inherits
+the locked descriptor, so the image stays locked for as long as the emulator
+runs, even if the manager that started it exits first. Locks are advisory:
+they only keep out other users of this module.
+"""
+
+import os
+from pathlib import Path
+
+LOCK_SUFFIX = ".lock"
+
+
+class ImageLockedError(OSError):
+    """The disk image is in use by another instance or job"""
+
+
+def lock_path(hdd_image):
+    """Get the path of the lock file of a disk image"""
+    hdd_image = Path(hdd_image)
+    return hdd_image.with_name(f".{hdd_image.name}{LOCK_SUFFIX}")
+
+
+class ImageLock:
+    """An exclusive lock on a disk image
+
+    Args:
+        hdd_image: Path of the raw image or VHD
+    """
+
+    def __init__(self, hdd_image):
+        self.hdd_image = Path(hdd_image)
+        self._fd = None
+
+    def acquire(self):
+        """Take the lock without waiting
+
+        Does nothing where flock is unavailable.
+
+        Raises:
+            ImageLockedError: If the image is locked already
+        """
+        try:
+            import fcntl
+        except ImportError:
+            return
+
+        fd = os.open(lock_path(self.hdd_image), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            raise ImageLockedError(f"{self.hdd_image.name} is in use by another DOSBox-X "
+                                   "instance or disk operation")
+        except BaseException:
+            os.close(fd)
+            raise
+        self._fd = fd
+
+    def fileno(self):
+        """Get the locked descriptor, for child processes to inherit, or None"""
+        return self._fd
+
+    def release(self):
+        """Give up this process's hold on the lock
+
+        The descriptor is closed rather than unlocked, so child processes
+        that inherited it keep the image locked until they exit.
+        """
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def run_locked(hdd_image, func, *args, **kwargs):
+    """Call a function that reads or changes a disk image with the image locked
+
+    Readers need the lock too: a running DOSBox-X would change the image
+    under them and leave them with a torn copy.
+
+    Raises:
+        ImageLockedError: If the image is in use
+    """
+    with ImageLock(hdd_image):
+        return func(*args, **kwargs)
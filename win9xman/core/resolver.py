@@ -0,0 +1,202 @@
+"""
+Discovery of the DOSBox-X installation to run
+
+DOSBox-X may be a configured binary, a native binary on the PATH or the
+flatpak. Probing it means starting it, which is slow with flatpak, so the
+result of a probe - the command to run, the version and the command line
+options it supports - is kept in a cache file and reused for as long as the
+binary's modification time stays the same. Resolving DOSBox-X at startup
+and for every launch then only takes a stat call.
+"""
+
+import json
+import os
+import re
+import shutil
+import subprocess
+from pathlib import Path
+
+from win9xman.utils.config import cache_directory
+
+NATIVE = "native"
+FLATPAK = "flatpak"
+CONFIGURED = "configured"
+
+NATIVE_NAME = "dosbox-x"
+FLATPAK_APP = "com.dosbox_x.DOSBox-X"
+FLATPAK_DIRS = (Path.home() / ".local" / "share" / "flatpak", Path("/var/lib/flatpak"))
+
+CACHE_NAME = "emulator.json"
+PROBE_TIMEOUT = 30  # seconds; a first flatpak start can be slow
+
+_VERSION_RE = re.compile(r"version\s+(\S+)", re.IGNORECASE)
+_OPTION_RE = re.compile(r"^\s*--?([A-Za-z][\w-]*)", re.MULTILINE)
+
+
+class Emulator:
+    """A DOSBox-X installation found on the host
+
+    Args:
+        kind: NATIVE, FLATPAK or CONFIGURED
+        command: Command line that starts DOSBox-X, without arguments
+        path: File whose modification time tells if the installation changed
+        mtime: Modification time of path when it was probed
+        version: Version reported by DOSBox-X, empty if unknown
+        options: Command line options DOSBox-X lists in its help, without dashes
+    """
+
+    def __init__(self, kind, command, path, mtime, version='', options=()):
+        self.kind = kind
+        self.command = list(command)
+        self.path = str(path)
+        self.mtime = mtime
+        self.version = version
+        self.options = sorted(options)
+
+    def command_line(self, *args):
+        """Get the command line that runs DOSBox-X with the given arguments"""
+        return self.command + [str(arg) for arg in args]
+
+    def supports(self, option):
+        """Check if DOSBox-X accepts a command line option, e.g. "-set"
+
+        Options are only known if DOSBox-X listed them when probed; unknown
+        means unsupported.
+        """
+        return option.lstrip('-') in self.options
+
+    def is_current(self):
+        """Check if the installation is unchanged since it was probed"""
+        return _mtime(self.path) == self.mtime
+
+    def to_dict(self):
+        return {'kind': self.kind, 'command': self.command, 'path': self.path,
+                'mtime': self.mtime, 'version': self.version, 'options': self.options}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['kind'], data['command'], data['path'], data['mtime'],
+                   data.get('version', ''), data.get('options', ()))
+
+
+def _mtime(path):
+    """Get the modification time of a file, following links, or None"""
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def _flatpak_app_dir():
+    """Get the deployed commit of the DOSBox-X flatpak, or None"""
+    if not shutil.which("flatpak"):
+        return None
+    for flatpak_dir in FLATPAK_DIRS:
+        # "active" links to the deployed commit, which is replaced on update
+        app_dir = flatpak_dir / "app" / FLATPAK_APP / "current" / "active"
+        if app_dir.exists():
+            return app_dir
+    return None
+
+
+def find_candidates(configured=''):
+    """List the installations to try, best first, without starting any
+
+    Args:
+        configured: Path or command name from the settings; when given, no
+            other installation is considered
+
+    Returns:
+        list: (kind, command, path) tuples
+    """
+    if configured:
+        path = shutil.which(configured)
+        return [(CONFIGURED, [path], path)] if path else []
+
+    candidates = []
+    path = shutil.which(NATIVE_NAME)
+    if path:
+        candidates.append((NATIVE, [path], path))
+    app_dir = _flatpak_app_dir()
+    if app_dir:
+        candidates.append((FLATPAK, ["flatpak", "run", FLATPAK_APP], app_dir))
+    return candidates
+
+
+def probe(kind, command, path):
+    """Start DOSBox-X to learn its version and options
+
+    Returns:
+        Emulator: The installation; version and options are empty if it
+        didn't answer
+    """
+    mtime = _mtime(path)
+
+    def output(option):
+        try:
+            result = subprocess.run(command + [option], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT, text=True, errors='replace',
+                                    timeout=PROBE_TIMEOUT, check=False)
+        except (OSError, subprocess.SubprocessError):
+            return ''
+        return result.stdout
+
+    match = _VERSION_RE.search(output("-version"))
+    options = set(_OPTION_RE.findall(output("-help")))
+    return Emulator(kind, command, path, mtime, match.group(1) if match else '', options)
+
+
+def _read_cache(cache_path):
+    """Load the cached installation, or None"""
+    try:
+        with open(cache_path, 'r') as f:
+            data = json.load(f)
+        return data.get('configured', ''), Emulator.from_dict(data['emulator'])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def _write_cache(cache_path, configured, emulator):
+    """Store the resolved installation atomically"""
+    cache_path = Path(cache_path)
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_path.with_name(f".{cache_path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, 'w') as f:
+        json.dump({'configured': configured, 'emulator': emulator.to_dict()}, f)
+    os.replace(tmp_path, cache_path)
+
+
+def resolve_emulator(configured='', cache_path=None, refresh=False):
+    """Find the DOSBox-X installation to run
+
+    The installation found last time is reused while its binary is
+    unchanged and still the best candidate; otherwise the best candidate is
+    probed and cached.
+
+    Args:
+        configured: Path or command name from the settings, empty to look
+            for a native binary, then the flatpak
+        cache_path: Cache file, in the user's cache directory by default
+        refresh: Probe again even if the cache is current
+
+    Returns:
+        Emulator: The installation, or None if DOSBox-X can't be found
+    """
+    if cache_path is None:
+        cache_path = cache_directory() / CACHE_NAME
+
+    candidates = find_candidates(configured)
+    if not candidates:
+        return None
+    kind, command, path = candidates[0]
+
+    cached = None if refresh else _read_cache(cache_path)
+    if cached and cached[0] == configured and cached[1].command == command and cached[1].is_current():
+        return cached[1]
+
+    emulator = probe(kind, command, path)
+    try:
+        _write_cache(cache_path, configured, emulator)
+    except OSError:
+        pass  # A read-only cache only costs a probe next time
+    return emulator
@@ -0,0 +1,228 @@
+"""
+Snapshot retention policies and garbage collection
+
+A retention policy decides which snapshots of a directory to keep: the last
+N, the newest snapshot of each of the last D days and W weeks, and optionally
+no more than a total size. Pruning deletes the other snapshots (merging
+chained manifests into their children) and garbage collection then removes
+the chunks no surviving manifest references.
+"""
+
+import time
+from datetime import datetime
+from pathlib import Path
+
+from win9xman.core import snapshot
+from win9xman.core.snapshot import MANIFEST_SUFFIX
+from win9xman.core.verify import tree_path
+
+# Temporary chunk files older than this are leftovers of crashed writes
+STALE_TMP_AGE = 3600
+
+
+class RetentionPolicy:
+    """Which snapshots to keep; a value of 0 disables that rule
+
+    Args:
+        keep_last: Keep the N most recent snapshots
+        keep_daily: Keep the newest snapshot of each of the last N days
+            that have snapshots
+        keep_weekly: Keep the newest snapshot of each of the last N weeks
+            that have snapshots
+        max_total_size: Prune the oldest kept snapshots until the total
+            stored size is below this many bytes
+    """
+
+    def __init__(self, keep_last=10, keep_daily=7, keep_weekly=4, max_total_size=0):
+        self.keep_last = keep_last
+        self.keep_daily = keep_daily
+        self.keep_weekly = keep_weekly
+        self.max_total_size = max_total_size
+
+    @classmethod
+    def from_settings(cls, settings):
+        """Build a policy from the [retention] section of the manager settings"""
+        section = settings['retention']
+        return cls(
+            keep_last=section.getint('keep_last'),
+            keep_daily=section.getint('keep_daily'),
+            keep_weekly=section.getint('keep_weekly'),
+            max_total_size=section.getint('max_total_size') * 1024 * 1024,
+        )
+
+
+def _created(record):
+    """Get the creation time of a catalog record"""
+    try:
+        return datetime.strptime(record['created'], "%Y-%m-%dT%H:%M:%S")
+    except (TypeError, ValueError):
+        return datetime.min
+
+
+def plan_retention(records, policy):
+    """Decide which snapshots to keep and which to prune
+
+    Args:
+        records: Catalog records of the snapshots of one directory
+        policy: The RetentionPolicy to apply
+
+    Returns:
+        tuple: (keep, prune) lists of records, newest first
+    """
+    records = sorted(records, key=lambda r: (_created(r), r['name']), reverse=True)
+    kept = set()
+
+    kept.update(r['name'] for r in records[:policy.keep_last])
+
+    for count, bucket_of in ((policy.keep_daily, lambda d: d.date()),
+                             (policy.keep_weekly, lambda d: d.isocalendar()[:2])):
+        buckets = []
+        for record in records:
+            bucket = bucket_of(_created(record))
+            if bucket not in buckets:
+                # Records are newest first, so this is the bucket's newest
+                buckets.append(bucket)
+                if len(buckets) > count:
+                    break
+                kept.add(record['name'])
+
+    keep = [r for r in records if r['name'] in kept]
+
+    if policy.max_total_size:
+        # Drop the oldest snapshots until the cap is met, but never the newest
+        total = sum(r['stored_size'] or 0 for r in keep)
+        while len(keep) > 1 and total > policy.max_total_size:
+            total -= keep.pop()['stored_size'] or 0
+        kept = {r['name'] for r in keep}
+
+    prune = [r for r in records if r['name'] not in kept]
+    return keep, prune
+
+
+def _referenced_digests(snapshot_dir, names):
+    """Collect the chunk digests used by the given manifest snapshots"""
+    referenced = set()
+    for name in names:
+        path = Path(snapshot_dir) / f"{name}{MANIFEST_SUFFIX}"
+        if path.exists():
+            _, blocks = snapshot.resolve_blocks(path)
+            referenced.update(digest for digest in blocks if digest)
+    return referenced
+
+
+def _snapshot_files_size(snapshot_dir, record):
+    """Get the size of the files making up a snapshot, chunks excluded"""
+    path = Path(snapshot_dir) / record['file']
+    size = 0
+    if path.exists():
+        st = path.stat()
+        # Count allocated space, holes don't free anything
+        size = st.st_blocks * 512 if hasattr(st, 'st_blocks') else st.st_size
+    tree = tree_path(path)
+    if tree.exists():
+        size += tree.stat().st_size
+    return size
+
+
+def collect_garbage(snapshot_dir, keep_names=None, dry_run=False):
+    """Remove the chunks no manifest references anymore
+
+    Must run with the snapshot directory locked exclusively.
+
+    Args:
+        snapshot_dir: The snapshot directory
+        keep_names: Names of the manifests that will survive, all current
+            manifests by default
+        dry_run: Only count what would be removed
+
+    Returns:
+        tuple: (chunk count, bytes) removed or to be removed
+    """
+    snapshot_dir = Path(snapshot_dir)
+    if keep_names is None:
+        keep_names = [path.stem for path in snapshot_dir.glob(f"*{MANIFEST_SUFFIX}")]
+    referenced = _referenced_digests(snapshot_dir, keep_names)
+
+    store = snapshot.get_chunk_store(snapshot_dir)
+    now = time.time()
+    count = 0
+    freed = 0
+    for digest, path in store.iter_objects():
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            continue
+        if digest is None and now - st.st_mtime < STALE_TMP_AGE:
+            # Possibly a write in progress in another process
+            continue
+        if digest in referenced:
+            continue
+        count += 1
+        freed += st.st_size
+        if not dry_run:
+            path.unlink()
+
+    return count, freed
+
+
+def reclaim_space(snapshot_dir, dry_run=False):
+    """Lock a snapshot directory and remove its unreferenced chunks
+
+    Returns:
+        tuple: (chunk count, bytes) removed or to be removed
+    """
+    with snapshot.snapshot_lock(snapshot_dir, exclusive=True):
+        return collect_garbage(snapshot_dir, dry_run=dry_run)
+
+
+def prune_snapshot(snapshot_path):
+    """Delete one snapshot and reclaim the space only it used
+
+    Both happen under the exclusive lock of the snapshot directory, so a
+    snapshot being created meanwhile can't record its changes against the
+    deleted one.
+
+    Returns:
+        tuple: (chunk count, bytes) removed from the chunk store
+    """
+    snapshot_dir = Path(snapshot_path).parent
+    with snapshot.snapshot_lock(snapshot_dir, exclusive=True):
+        # Later snapshots in the chain absorb the deleted changes
+        snapshot.delete_snapshot(snapshot_path)
+        return collect_garbage(snapshot_dir)
+
+
+def apply_retention(snapshot_dir, policy, dry_run=False):
+    """Prune snapshots according to a policy and reclaim their space
+
+    Args:
+        snapshot_dir: The snapshot directory
+        policy: The RetentionPolicy to apply
+        dry_run: Only report what would be pruned and freed
+
+    Returns:
+        dict: Report with the pruned snapshot names ('pruned'), the number
+        of chunks removed ('chunks') and the bytes freed ('bytes_freed')
+    """
+    snapshot_dir = Path(snapshot_dir)
+
+    with snapshot.snapshot_lock(snapshot_dir, exclusive=True):
+        with snapshot.open_catalog(snapshot_dir) as catalog:
+            records = catalog.list()
+        keep, prune = plan_retention(records, policy)
+
+        bytes_freed = sum(_snapshot_files_size(snapshot_dir, r) for r in prune)
+
+        if not dry_run:
+            # Oldest first, so each deletion merges into a surviving child
+            for record in reversed(prune):
+                snapshot.delete_snapshot(snapshot_dir / record['file'])
+
+        keep_names = [r['name'] for r in keep if r['format'] == 'manifest']
+        chunks, chunk_bytes = collect_garbage(snapshot_dir, keep_names, dry_run)
+
+    return {
+        'pruned': [r['name'] for r in prune],
+        'chunks': chunks,
+        'bytes_freed': bytes_freed + chunk_bytes,
+    }
@@ -0,0 +1,195 @@
+"""
+DOSBox-X save states for starting Windows at the desktop
+
+Cold-booting Windows 9x takes most of a minute of emulated time. A save state
+taken at the desktop brings it back in seconds, but only for as long as the
+disk image holds exactly what it held when the state was saved: Windows keeps
+parts of the disk cached in memory, and resuming on different disk contents
+corrupts the file system.
+
+A state is therefore kept next to its disk image, one per image (and so per
+OS), with a record of the image it belongs to: the Merkle root of its
+contents (see win9xman.core.verify), and its size and modification time,
+which tell cheaply whether it changed since. A state whose image changed - a
+session, a restore, a compaction - is stale and removed the next time it is
+looked up, and restoring a snapshot removes it straight away.
+
+Capturing runs a normal boot with the save file pointed at a capture file;
+once DOSBox-X exits, a state saved into it is recorded for the image as it
+is then. The state must be saved right before quitting DOSBox-X, anything
+Windows writes after that makes it stale. Resuming mounts the drives without
+booting, so nothing touches the disk before the state is loaded.
+"""
+
+import json
+import os
+import time
+from datetime import datetime
+from pathlib import Path
+
+from win9xman.core.verify import build_tree
+
+STATE_SUFFIX = ".sav"
+INFO_SUFFIX = ".json"
+CAPTURE_INFIX = ".capture"
+
+# DOSBox-X builds that can load the save file at startup list this option
+LOAD_STATE_OPTION = "-loadstate"
+
+
+def state_path(hdd_image):
+    """Get the path of the save state of a disk image"""
+    hdd_image = Path(hdd_image)
+    return hdd_image.with_name(hdd_image.name + STATE_SUFFIX)
+
+
+def _info_path(hdd_image):
+    """Get the path of the record of the save state of a disk image"""
+    hdd_image = Path(hdd_image)
+    return hdd_image.with_name(hdd_image.name + STATE_SUFFIX + INFO_SUFFIX)
+
+
+def capture_path(hdd_image):
+    """Get the file DOSBox-X saves a state into while one is captured"""
+    hdd_image = Path(hdd_image)
+    return hdd_image.with_name(f".{hdd_image.name}{CAPTURE_INFIX}{STATE_SUFFIX}")
+
+
+def _file_key(path):
+    """Get the size and modification time of a file, which change when it is written"""
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def read_info(hdd_image):
+    """Load the record of the save state of a disk image
+
+    Returns:
+        dict: The record, or None if the image has no state
+    """
+    try:
+        with open(_info_path(hdd_image), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def drop_state(hdd_image):
+    """Remove the save state of a disk image, if any"""
+    for path in (_info_path(hdd_image), state_path(hdd_image)):
+        if path.exists():
+            path.unlink()
+
+
+def current_state(hdd_image, os_name, rehash=False, workers=0, progress=None):
+    """Get the save state to resume a disk image from
+
+    A state is current while neither it nor the image changed since it was
+    recorded. Stale states are removed.
+
+    Args:
+        hdd_image: Path of the disk image
+        os_name: OS the state must have been captured for
+        rehash: When the image file changed, hash its contents and keep the
+            state if they are still the same, e.g. after the file was copied
+        workers: Number of worker threads for rehashing, 0 for one per core
+        progress: Optional callable receiving the number of bytes hashed
+
+    Returns:
+        Path: The state file, or None if there is no current state
+    """
+    info = read_info(hdd_image)
+    path = state_path(hdd_image)
+    if info is None or info.get('os') != os_name:
+        return None
+
+    try:
+        current = info['state'] == _file_key(path)
+        if current and info['image'] != _file_key(hdd_image):
+            current = rehash and build_tree(hdd_image, workers=workers, progress=progress)['root'] == info['root']
+            if current:
+                info['image'] = _file_key(hdd_image)
+                _write_info(hdd_image, info)
+    except (OSError, KeyError):
+        current = False
+
+    if not current:
+        drop_state(hdd_image)
+        return None
+    return path
+
+
+def _write_info(hdd_image, info):
+    """Store the record of a save state atomically"""
+    info_path = _info_path(hdd_image)
+    tmp_path = info_path.with_name(f".{info_path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, 'w') as f:
+        json.dump(info, f, indent=2)
+    os.replace(tmp_path, info_path)
+
+
+def begin_capture(hdd_image):
+    """Prepare capturing a save state of a disk image
+
+    Returns:
+        tuple: (capture file to give DOSBox-X as its save file, start time
+        to pass to finish_capture)
+    """
+    path = capture_path(hdd_image)
+    if path.exists():
+        path.unlink()
+    return path, time.time()
+
+
+def finish_capture(hdd_image, os_name, started, workers=0, progress=None):
+    """Record the state saved during a capture for the disk image as it is now
+
+    Must be called once DOSBox-X has exited, with the image still locked.
+
+    Args:
+        hdd_image: Path of the disk image
+        os_name: OS the state was captured for
+        started: Start time returned by begin_capture
+        workers: Number of worker threads, 0 for one per core
+        progress: Optional callable receiving the number of bytes hashed
+
+    Returns:
+        Path: The state file, or None if no state was saved
+    """
+    path = capture_path(hdd_image)
+    if not path.exists() or path.stat().st_mtime < started:
+        return None
+
+    drop_state(hdd_image)
+    tree = build_tree(hdd_image, workers=workers, progress=progress)
+    os.replace(path, state_path(hdd_image))
+    _write_info(hdd_image, {
+        'os': os_name,
+        'captured': datetime.now().isoformat(timespec='seconds'),
+        'root': tree['root'],
+        'image': _file_key(hdd_image),
+        'state': _file_key(state_path(hdd_image)),
+    })
+    return state_path(hdd_image)
+
+
+def savefile_overrides(path):
+    """Get the config overrides that make DOSBox-X save and load states in a file"""
+    return {'dosbox': {'savefile': str(path)}}
+
+
+def resume_options(emulator, state):
+    """Get what makes DOSBox-X use a save state
+
+    Args:
+        emulator: The Emulator that will run
+        state: The state file
+
+    Returns:
+        tuple: (config overrides for create_temp_config, extra command line
+        arguments, True if the state is loaded without user action)
+    """
+    overrides = savefile_overrides(state)
+    if emulator.supports(LOAD_STATE_OPTION):
+        return overrides, [LOAD_STATE_OPTION], True
+    return overrides, [], False
@@ -0,0 +1,233 @@
+"""
+Disposable and RAM-backed sessions on a disk image
+
+A session runs DOSBox-X on a working copy of the disk image instead of the
+image itself. The copy is a reflink clone where the file system supports it,
+so starting a session takes constant time, and a sparse copy otherwise.
+RAM sessions put the copy on a tmpfs instead, so guest disk I/O runs at
+memory speed; the blocks of the copy are hashed as it is made, and only the
+copy needs reading again to find what changed.
+When the session ends the copy is either thrown away, leaving the disk
+image exactly as it was, or committed: only the blocks that differ are
+written back, through a redo file and the journal (see
+win9xman.core.journal.merge_blocks), so a crash during the commit is
+completed the next time the manager starts.
+
+The disk image is locked from the start of a session until it ends (see
+win9xman.core.lock), so it can't be changed meanwhile and two sessions can't
+share it.
+"""
+
+import os
+import shutil
+from pathlib import Path
+
+from win9xman.core.chunkstore import DEFAULT_BLOCK_SIZE
+from win9xman.core.compact import allocated_size
+from win9xman.core.image import open_disk
+from win9xman.core.journal import merge_blocks, redo_path
+from win9xman.core.lock import ImageLock
+from win9xman.core.verify import ZERO_LEAF, leaf_digest
+from win9xman.utils.fileops import clone_file, range_blocks
+from win9xman.utils.parallel import parallel_map
+
+SESSION_INFIX = ".session"
+
+# Memory-backed file system present on most Linux systems
+DEFAULT_RAM_DIR = Path("/dev/shm")
+RAM_DIR_NAME = "win9xman"
+
+
+class Session:
+    """A working copy of a disk image that can be committed or discarded
+
+    Args:
+        hdd_image: Path of the raw image or VHD the session is based on
+        work_dir: Directory of the working copy, next to the image by default
+        block_size: Granularity of the changes written back on commit
+    """
+
+    def __init__(self, hdd_image, work_dir=None, block_size=DEFAULT_BLOCK_SIZE):
+        self.hdd_image = Path(hdd_image)
+        work_dir = Path(work_dir) if work_dir else self.hdd_image.parent
+        # Same suffix as the image, DOSBox-X tells VHDs by their name
+        self.work_image = work_dir / f".{self.hdd_image.stem}{SESSION_INFIX}{self.hdd_image.suffix}"
+        self.block_size = block_size
+        self.baseline = None
+        self.lock = ImageLock(self.hdd_image)
+
+    def start(self, hash_baseline=False, workers=0, progress=None):
+        """Lock the disk image and make the working copy
+
+        Args:
+            hash_baseline: Also hash the blocks of the copy, so the changes
+                can be found on commit without reading the disk image again
+            workers: Number of worker threads, 0 for one per core
+            progress: Optional callable receiving the number of bytes copied
+
+        Returns:
+            bool: True if the copy was made with a reflink
+
+        Raises:
+            ImageLockedError: If the disk image is in use
+        """
+        self.lock.acquire()
+        try:
+            reflinked = clone_file(self.hdd_image, self.work_image, progress)
+            if hash_baseline:
+                self.baseline = self._hash_blocks(workers)
+        except BaseException:
+            self.discard()
+            raise
+        return reflinked
+
+    def _hash_blocks(self, workers=0):
+        """Hash the blocks of the working copy that hold data
+
+        Returns:
+            dict: Leaf digest of each block index; other blocks are zero
+        """
+        block_size = self.block_size
+        with open_disk(self.work_image) as work:
+            def hash_block(index):
+                return index, leaf_digest(work.read(index * block_size, block_size))
+
+            indexes = range_blocks(work.data_ranges(), block_size)
+            return dict(parallel_map(hash_block, indexes, workers))
+
+    def changed_blocks(self, workers=0, progress=None):
+        """Find the blocks of the working copy that differ from the disk image
+
+        Blocks are compared with the baseline hashes when the session has
+        them, and byte by byte with the disk image otherwise. Blocks that
+        are holes in both are never read.
+
+        Args:
+            workers: Number of worker threads, 0 for one per core
+            progress: Optional callable receiving the number of bytes compared
+
+        Returns:
+            list: Ascending indexes of the changed blocks
+        """
+        block_size = self.block_size
+
+        with open_disk(self.work_image) as work, open_disk(self.hdd_image) as base:
+            indexes = set(range_blocks(work.data_ranges(), block_size))
+            if self.baseline is not None:
+                indexes.update(self.baseline)
+
+                def compare(index):
+                    data = work.read(index * block_size, block_size)
+                    return index, leaf_digest(data) != self.baseline.get(index, ZERO_LEAF), len(data)
+            else:
+                indexes.update(range_blocks(base.data_ranges(), block_size))
+
+                def compare(index):
+                    data = work.read(index * block_size, block_size)
+                    return index, data != base.read(index * block_size, block_size), len(data)
+
+            changed = []
+            compared = 0
+            for index, differs, length in parallel_map(compare, sorted(indexes), workers):
+                if differs:
+                    changed.append(index)
+                compared += length
+                if progress:
+                    progress(length)
+            size = work.size
+
+        if progress:
+            # Blocks that are holes on both sides count as compared
+            progress(size - compared)
+        return changed
+
+    def commit(self, changed=None, workers=0, progress=None):
+        """Write the changes of the session back to the disk image
+
+        The changed blocks are staged in a redo file next to the disk image,
+        then merged into it; the working copy is removed afterwards. The
+        disk image is unlocked either way.
+
+        Args:
+            changed: Indexes of the changed blocks as returned by
+                changed_blocks, which is called if not given
+            workers: Number of worker threads, 0 for one per core
+            progress: Optional callable receiving the number of bytes
+                processed: twice the changed data, plus the image size if
+                the changes have to be found first
+
+        Returns:
+            int: The number of bytes written back
+        """
+        try:
+            if changed is None:
+                changed = self.changed_blocks(workers, progress)
+            block_size = self.block_size
+            written = 0
+
+            if changed:
+                redo = redo_path(self.hdd_image)
+                with open_disk(self.work_image) as work, open(redo, 'wb') as f:
+                    for position, index in enumerate(changed):
+                        data = work.read(index * block_size, block_size)
+                        os.pwrite(f.fileno(), data, position * block_size)
+                        written += len(data)
+                        if progress:
+                            progress(len(data))
+                merge_blocks(self.hdd_image, [index * block_size for index in changed], block_size, progress)
+        finally:
+            # The working copy is kept if the commit failed
+            self.lock.release()
+
+        self.discard()
+        return written
+
+    def discard(self):
+        """Throw the working copy and its changes away and unlock the disk image"""
+        try:
+            os.unlink(self.work_image)
+        except FileNotFoundError:
+            pass
+        self.lock.release()
+
+
+def ram_directory(configured=''):
+    """Get the directory RAM sessions keep their working copy in
+
+    Args:
+        configured: Directory from the settings, empty to use /dev/shm
+
+    Returns:
+        Path: The directory, created if needed, or None if there is no
+        tmpfs to use
+    """
+    if configured:
+        base = Path(configured)
+    elif DEFAULT_RAM_DIR.is_dir():
+        base = DEFAULT_RAM_DIR
+    else:
+        return None
+    ram_dir = base / RAM_DIR_NAME
+    ram_dir.mkdir(mode=0o700, exist_ok=True)
+    return ram_dir
+
+
+def ram_session(hdd_image, ram_dir):
+    """Create a session whose working copy lives in memory
+
+    Args:
+        hdd_image: Path of the raw image or VHD
+        ram_dir: Directory on a tmpfs, as returned by ram_directory
+
+    Returns:
+        Session: The session, not started yet
+
+    Raises:
+        OSError: If the tmpfs hasn't got room for the used part of the image
+    """
+    needed = allocated_size(hdd_image)
+    free = shutil.disk_usage(ram_dir).free
+    if needed > free:
+        raise OSError(f"{ram_dir} has {free // (1024 * 1024)} MB free, the disk image "
+                      f"needs {needed // (1024 * 1024)} MB")
+    return Session(hdd_image, ram_dir)
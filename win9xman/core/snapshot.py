@@ -0,0 +1,629 @@
+"""
+Disk image snapshot functions
+
+Snapshots are stored as small JSON manifests that list the hash of every
+block of the disk image. The block contents themselves live once in a
+shared chunk store inside the snapshot directory, so taking a snapshot only
+writes the blocks that are not already stored.
+
+Manifests form per-directory chains: a snapshot taken after another one
+only records the blocks that differ from its parent, so its manifest grows
+with the amount of changed data instead of with the image size. Restoring a
+snapshot resolves the chain back to the first full manifest.
+
+Blocks can be stored compressed (zlib, lzma or zstd). Hashing, compression
+and decompression run on a thread pool, one block per task, so snapshot and
+restore throughput scale with the number of cores.
+
+When the snapshot directory is on a file system with reflink support
+(btrfs, XFS) snapshots are instead plain ``.img`` files cloned copy-on-write
+from the disk image, which takes constant time. Clones share data with the
+image rather than with each other, so compression and delta chains don't
+apply to them; the reflink setting turns them off. Plain ``.img`` copies made
+by older versions are listed and restored the same way.
+
+Snapshots record the contents of the virtual disk, not its container: a
+dynamic VHD is snapshotted as a manifest of its allocated blocks, and any
+snapshot can be restored into either a raw image or a VHD.
+
+Each snapshot directory also has a catalog (see win9xman.core.catalog)
+which is updated together with the snapshot files.
+"""
+
+import contextlib
+import json
+import os
+from datetime import datetime
+from pathlib import Path
+
+from win9xman.core import vhd
+from win9xman.core.catalog import SnapshotCatalog
+from win9xman.core.journal import replace_image
+from win9xman.core.savestate import drop_state
+from win9xman.core.chunkstore import ChunkStore, DEFAULT_BLOCK_SIZE, hash_block, is_zero_block
+from win9xman.core.verify import (IntegrityError, ZERO_LEAF, merkle_root, read_tree, seal_image,
+                                  tree_path, verify_chunks, verify_image, write_tree)
+from win9xman.utils.fileops import clone_file, iter_data_ranges, range_blocks, reflink_file
+from win9xman.utils.parallel import parallel_map
+
+MANIFEST_SUFFIX = ".manifest"
+IMAGE_SUFFIX = ".img"
+CHUNKS_DIR_NAME = ".chunks"
+LOCK_NAME = ".lock"
+MANIFEST_VERSION = 2
+
+
+@contextlib.contextmanager
+def snapshot_lock(snapshot_dir, exclusive=False):
+    """Lock a snapshot directory against concurrent garbage collection
+
+    Snapshot creation and restore take a shared lock; garbage collection
+    takes an exclusive one, so it never deletes a chunk that a snapshot being
+    written is about to reference. Does nothing where flock is unavailable.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+
+    with open(Path(snapshot_dir) / LOCK_NAME, 'a') as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def get_chunk_store(snapshot_dir, compression='none'):
+    """Get the chunk store shared by all snapshots in a directory"""
+    return ChunkStore(Path(snapshot_dir) / CHUNKS_DIR_NAME, compression)
+
+
+def read_manifest(manifest_path):
+    """Load a snapshot manifest"""
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def write_manifest(manifest_path, manifest):
+    """Write a snapshot manifest atomically"""
+    manifest_path = Path(manifest_path)
+    tmp_path = manifest_path.with_name(f".{manifest_path.name}.tmp")
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path)
+
+
+def snapshot_file_name(name, when=None):
+    """Make the file name of a new snapshot from the name the user typed
+
+    Args:
+        name: Snapshot name, any characters
+        when: Creation time, now by default
+
+    Returns:
+        str: Timestamp and name, safe to use as a file name, without suffix
+    """
+    safe_name = ''.join(c if c.isalnum() or c in '_-' else '_' for c in name)
+    timestamp = (when or datetime.now()).strftime("%Y%m%d_%H%M%S")
+    return f"{timestamp}_{safe_name}"
+
+
+def list_snapshots(snapshot_dir):
+    """List snapshot files in a directory, oldest first
+
+    Returns:
+        list: Paths of manifest and image snapshots
+    """
+    snapshot_dir = Path(snapshot_dir)
+    snapshots = list(snapshot_dir.glob(f"*{MANIFEST_SUFFIX}"))
+    snapshots.extend(snapshot_dir.glob(f"*{IMAGE_SUFFIX}"))
+    return sorted(snapshots, key=lambda p: p.name)
+
+
+def _hash_image_blocks(hdd_image, block_size, store, workers=0, progress=None):
+    """Hash every block of an image, storing the blocks that hold data
+
+    Holes in a sparse image, and unallocated blocks of a VHD, are recognised
+    without reading them. Blocks are read, hashed and compressed in
+    parallel; hashlib and the compressors release the GIL on large buffers.
+    """
+    bytes_read = 0
+    bytes_stored = 0
+
+    with contextlib.ExitStack() as stack:
+        if vhd.is_vhd(hdd_image):
+            image = stack.enter_context(vhd.VhdImage(hdd_image))
+            image_size = image.size
+            read = image.read
+            data_ranges = image.data_ranges()
+        else:
+            fd = stack.enter_context(open(hdd_image, 'rb')).fileno()
+            image_size = os.fstat(fd).st_size
+            read = lambda offset, length: os.pread(fd, length, offset)
+            data_ranges = iter_data_ranges(fd, image_size)
+        blocks = [None] * ((image_size + block_size - 1) // block_size)
+
+        def process_block(index):
+            data = read(index * block_size, block_size)
+
+            # Zero-filled blocks (free clusters) are not stored at all
+            if is_zero_block(data):
+                return index, None, len(data), 0
+
+            digest = hash_block(data)
+            stored = store.put(digest, data)
+            return index, digest, len(data), stored
+
+        indexes = range_blocks(data_ranges, block_size)
+        for index, digest, length, stored in parallel_map(process_block, indexes, workers):
+            blocks[index] = digest
+            bytes_read += length
+            bytes_stored += stored
+            if progress:
+                progress(length)
+
+    if progress:
+        # Holes count as processed too
+        progress(image_size - bytes_read)
+
+    return image_size, blocks, bytes_stored
+
+
+def manifest_leaves(blocks):
+    """Get the Merkle leaves of a resolved manifest block list"""
+    return [digest or ZERO_LEAF for digest in blocks]
+
+
+def content_hash(blocks):
+    """Hash of a disk image's contents, derived from its block digests
+
+    This is the Merkle root of the image, so two snapshots of identical
+    images have the same content hash whatever their format or position in a
+    chain.
+    """
+    return merkle_root(manifest_leaves(blocks))
+
+
+def latest_manifest(snapshot_dir):
+    """Get the path of the most recently created manifest snapshot, or None"""
+    with open_catalog(snapshot_dir) as catalog:
+        records = [r for r in catalog.list(order_by='created', descending=True)
+                   if r['format'] == 'manifest']
+    return Path(snapshot_dir) / records[0]['file'] if records else None
+
+
+def resolve_blocks(manifest_path):
+    """Resolve a manifest chain into the full block list of the image
+
+    Args:
+        manifest_path: Path to the manifest to resolve
+
+    Returns:
+        tuple: (manifest, blocks) where blocks lists the digest of every
+        block of the image, or None for zero blocks
+    """
+    manifest_path = Path(manifest_path)
+    manifest = read_manifest(manifest_path)
+
+    # Walk up to the full manifest, then apply the deltas on the way down
+    chain = [manifest]
+    while chain[-1].get('parent'):
+        parent_path = manifest_path.parent / f"{chain[-1]['parent']}{MANIFEST_SUFFIX}"
+        chain.append(read_manifest(parent_path))
+
+    blocks = list(chain[-1]['blocks'])
+    for delta in reversed(chain[:-1]):
+        block_count = (delta['image_size'] + delta['block_size'] - 1) // delta['block_size']
+        del blocks[block_count:]
+        blocks.extend([None] * (block_count - len(blocks)))
+        for index, digest in delta['changed'].items():
+            blocks[int(index)] = digest
+
+    return manifest, blocks
+
+
+def _full_manifest(manifest, blocks):
+    """Turn a manifest into a full one holding the given block list"""
+    manifest = dict(manifest)
+    manifest.pop('changed', None)
+    manifest['parent'] = None
+    manifest['blocks'] = blocks
+    return manifest
+
+
+def _delta_manifest(manifest, parent_name, parent_blocks, blocks):
+    """Turn a manifest into a delta against a parent's block list"""
+    manifest = dict(manifest)
+    manifest.pop('blocks', None)
+    manifest['parent'] = parent_name
+    manifest['changed'] = {
+        str(index): digest
+        for index, digest in enumerate(blocks)
+        if index >= len(parent_blocks) or parent_blocks[index] != digest
+    }
+    return manifest
+
+
+def describe_snapshot(snapshot_path):
+    """Build the catalog record of a snapshot file
+
+    Used to import snapshots that are missing from the catalog. Only the
+    manifests are read, never the image data.
+    """
+    snapshot_path = Path(snapshot_path)
+    stat = snapshot_path.stat()
+
+    if snapshot_path.suffix == IMAGE_SUFFIX:
+        return {
+            'name': snapshot_path.stem,
+            'file': snapshot_path.name,
+            'format': 'image',
+            'created': datetime.fromtimestamp(stat.st_mtime).isoformat(timespec='seconds'),
+            'image_size': stat.st_size,
+            'stored_size': stat.st_blocks * 512 if hasattr(stat, 'st_blocks') else stat.st_size,
+            'hash': _stored_root(snapshot_path),
+        }
+
+    manifest, blocks = resolve_blocks(snapshot_path)
+    return {
+        'name': snapshot_path.stem,
+        'file': snapshot_path.name,
+        'format': 'manifest',
+        'os': Path(manifest.get('source', '')).stem or None,
+        'note': manifest.get('note'),
+        'created': manifest.get('created'),
+        'image_size': manifest['image_size'],
+        'stored_size': manifest.get('stored_size', stat.st_size),
+        'hash': content_hash(blocks),
+        'parent': manifest.get('parent'),
+    }
+
+
+def _stored_root(image_path):
+    """Get the Merkle root stored for an image snapshot, if any"""
+    try:
+        return read_tree(tree_path(image_path))['root']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def open_catalog(snapshot_dir):
+    """Open the catalog of a snapshot directory, bringing it up to date
+
+    Snapshot files that appeared or disappeared without going through this
+    module (copied by hand, catalog deleted, ...) are imported or dropped.
+    Only the directory listing is compared, image files are not opened.
+
+    Returns:
+        SnapshotCatalog: The open catalog, to be closed by the caller
+    """
+    catalog = SnapshotCatalog(snapshot_dir)
+    files = {path.stem: path for path in list_snapshots(snapshot_dir)}
+    known = catalog.names()
+
+    if files.keys() != known:
+        with catalog.transaction():
+            for name in known - files.keys():
+                catalog.remove(name)
+            for name in sorted(files.keys() - known):
+                try:
+                    catalog.add(describe_snapshot(files[name]))
+                except (OSError, ValueError, KeyError):
+                    # Unreadable or broken manifest, leave it out of the list
+                    continue
+
+    return catalog
+
+
+def create_snapshot(hdd_image, snapshot_dir, snapshot_name, block_size=DEFAULT_BLOCK_SIZE, parent=None,
+                    compression='none', workers=0, progress=None, note=None, reflink=True):
+    """Create a snapshot of a disk image
+
+    A reflink clone of a raw image is used when the file system supports it
+    and reflink is true, otherwise the image is stored as a deduplicated
+    manifest. When a parent manifest is given only the blocks that differ
+    from it are recorded. Clones are whole images: parent and compression
+    only apply to manifests.
+
+    Args:
+        hdd_image: Path to the raw image or VHD to snapshot
+        snapshot_dir: Directory holding the snapshots for this OS
+        snapshot_name: File name of the snapshot, without suffix
+        block_size: Size of the blocks the image is split into
+        parent: Optional path of the manifest to record changes against
+        compression: Codec used for newly stored blocks
+        workers: Number of worker threads, 0 for one per core
+        progress: Optional callable receiving the number of bytes processed
+        note: Optional free text stored with the snapshot
+        reflink: Whether a reflink clone may be used instead of a manifest
+
+    Returns:
+        Path: The path of the snapshot file
+    """
+    snapshot_dir = Path(snapshot_dir)
+    created = datetime.now().isoformat(timespec='seconds')
+    os_name = Path(hdd_image).stem
+
+    clone_path = snapshot_dir / f"{snapshot_name}{IMAGE_SUFFIX}"
+    if reflink and not vhd.is_vhd(hdd_image) and reflink_file(hdd_image, clone_path):
+        # The clone is instant; hashing it gives the reference for verify
+        try:
+            tree = seal_image(clone_path, workers=workers, progress=progress)
+        except BaseException:
+            clone_path.unlink()
+            raise
+        record = describe_snapshot(clone_path)
+        record.update(os=os_name, note=note, created=created, hash=tree['root'])
+        _catalog_add(snapshot_dir, clone_path, record)
+        return clone_path
+
+    # Garbage collection must not remove chunks this snapshot reuses
+    with snapshot_lock(snapshot_dir):
+        store = get_chunk_store(snapshot_dir, compression)
+        image_size, blocks, stored_size = _hash_image_blocks(hdd_image, block_size, store, workers, progress)
+
+        manifest = {
+            'version': MANIFEST_VERSION,
+            'source': Path(hdd_image).name,
+            'created': created,
+            'note': note,
+            'image_size': image_size,
+            'block_size': block_size,
+            'stored_size': stored_size,
+        }
+
+        parent_blocks = None
+        if parent is not None and Path(parent).exists():
+            parent_manifest, parent_blocks = resolve_blocks(parent)
+            # A delta only makes sense against the same block layout
+            if parent_manifest['block_size'] != block_size:
+                parent_blocks = None
+
+        if parent_blocks is None:
+            manifest = _full_manifest(manifest, blocks)
+        else:
+            manifest = _delta_manifest(manifest, Path(parent).stem, parent_blocks, blocks)
+
+        manifest_path = snapshot_dir / f"{snapshot_name}{MANIFEST_SUFFIX}"
+        write_manifest(manifest_path, manifest)
+
+        _catalog_add(snapshot_dir, manifest_path, {
+            'name': snapshot_name,
+            'file': manifest_path.name,
+            'format': 'manifest',
+            'os': os_name,
+            'note': note,
+            'created': created,
+            'image_size': image_size,
+            'stored_size': stored_size,
+            'hash': content_hash(blocks),
+            'parent': manifest['parent'],
+        })
+        return manifest_path
+
+
+def _catalog_add(snapshot_dir, snapshot_path, record):
+    """Record a new snapshot, removing its file if the catalog can't be updated"""
+    try:
+        with SnapshotCatalog(snapshot_dir) as catalog, catalog.transaction():
+            catalog.add(record)
+    except Exception:
+        snapshot_path.unlink()
+        raise
+
+
+def verify_snapshot(snapshot_path, workers=0, progress=None):
+    """Check a snapshot for silent corruption
+
+    Manifest snapshots are checked by re-hashing every chunk they use. Image
+    snapshots are checked against the Merkle tree stored when they were
+    taken; an image snapshot without one (made by an older version) is
+    sealed now and reported intact.
+
+    Args:
+        snapshot_path: Path to a manifest or image snapshot
+        workers: Number of worker threads, 0 for one per core
+        progress: Optional callable receiving the number of bytes processed
+
+    Returns:
+        list: Indexes of the corrupt blocks, empty if the snapshot is intact
+    """
+    snapshot_path = Path(snapshot_path)
+
+    if snapshot_path.suffix == IMAGE_SUFFIX:
+        if not tree_path(snapshot_path).exists():
+            seal_image(snapshot_path, workers=workers, progress=progress)
+            return []
+        return verify_image(snapshot_path, workers=workers, progress=progress)
+
+    manifest, blocks = resolve_blocks(snapshot_path)
+    store = get_chunk_store(snapshot_path.parent)
+    bad = verify_chunks(store, blocks, workers, progress, manifest['block_size'])
+    if progress:
+        # Zero blocks need no checking
+        progress(max(manifest['image_size'] - sum(1 for d in blocks if d) * manifest['block_size'], 0))
+    return bad
+
+
+def restore_snapshot(snapshot_path, hdd_image, workers=0, progress=None, verify=False):
+    """Rebuild a disk image from a snapshot
+
+    The new image is written next to the live one and atomically swapped in
+    (see win9xman.core.journal), so an interruption never leaves a broken
+    disk image and no backup copy is needed. Blocks are decompressed in
+    parallel and written straight to their offset. The restored image is
+    sealed with the snapshot's Merkle tree, so it can be verified later with
+    win9xman.core.verify.verify_image. A VHD is written in VHD format and
+    left unsealed, its file doesn't hash like the disk it holds. The save
+    state of the image, if any, is removed (see win9xman.core.savestate).
+
+    Args:
+        snapshot_path: Path to a manifest or image snapshot
+        hdd_image: Path of the raw image or VHD to write
+        workers: Number of worker threads, 0 for one per core
+        progress: Optional callable receiving the number of bytes processed
+        verify: Check the snapshot before touching the disk image. Progress
+            then counts the image size twice.
+
+    Raises:
+        IntegrityError: If verify is set and the snapshot is corrupt
+    """
+    snapshot_path = Path(snapshot_path)
+
+    if verify:
+        bad_blocks = verify_snapshot(snapshot_path, workers, progress)
+        if bad_blocks:
+            raise IntegrityError(f"Snapshot {snapshot_path.name} is corrupt "
+                                 f"({len(bad_blocks)} bad blocks)", bad_blocks)
+
+    _restore(snapshot_path, hdd_image, workers, progress)
+
+    # Windows saved in a state would find a different disk
+    drop_state(hdd_image)
+
+
+def _restore(snapshot_path, hdd_image, workers=0, progress=None):
+    """Replace a disk image with a snapshot and seal it, see restore_snapshot"""
+    if snapshot_path.suffix == IMAGE_SUFFIX and vhd.is_vhd(hdd_image):
+        replace_image(hdd_image, lambda tmp_path: vhd.convert_to_vhd(snapshot_path, tmp_path, progress),
+                      source=snapshot_path)
+        _drop_seal(hdd_image)
+        return
+
+    if snapshot_path.suffix == IMAGE_SUFFIX:
+        replace_image(hdd_image, lambda tmp_path: clone_file(snapshot_path, tmp_path, progress),
+                      source=snapshot_path)
+        _seal_restored_image(hdd_image, tree_path(snapshot_path))
+        return
+
+    with snapshot_lock(snapshot_path.parent):
+        manifest, blocks = replace_image(
+            hdd_image, lambda tmp_path: _restore_manifest(snapshot_path, tmp_path, workers, progress,
+                                                       vhd.is_vhd(hdd_image)),
+            source=snapshot_path)
+
+    if vhd.is_vhd(hdd_image):
+        _drop_seal(hdd_image)
+        return
+
+    leaves = manifest_leaves(blocks)
+    _seal_restored_image(hdd_image, {
+        'leaf_size': manifest['block_size'],
+        'image_size': manifest['image_size'],
+        'leaves': leaves,
+        'root': merkle_root(leaves),
+    })
+
+
+def _restore_manifest(snapshot_path, hdd_image, workers=0, progress=None, as_vhd=False):
+    """Write the blocks of a manifest snapshot to a disk image
+
+    The image is written as a dynamic VHD if as_vhd is set, raw otherwise.
+
+    Returns:
+        tuple: (manifest, blocks) as returned by resolve_blocks
+    """
+    manifest, blocks = resolve_blocks(snapshot_path)
+    store = get_chunk_store(snapshot_path.parent)
+    block_size = manifest['block_size']
+
+    with contextlib.ExitStack() as stack:
+        if as_vhd:
+            vhd.create_vhd(hdd_image, manifest['image_size'])
+            write = stack.enter_context(vhd.VhdImage(hdd_image, writable=True)).write
+        else:
+            fd = stack.enter_context(open(hdd_image, 'wb')).fileno()
+            os.ftruncate(fd, manifest['image_size'])
+            write = lambda offset, data: os.pwrite(fd, data, offset)
+
+        def write_block(index):
+            return write(index * block_size, store.get(blocks[index]))
+
+        # Zero blocks are left as holes, or unallocated in a VHD
+        indexes = [index for index, digest in enumerate(blocks) if digest is not None]
+        written = 0
+        for length in parallel_map(write_block, indexes, workers):
+            written += length
+            if progress:
+                progress(length)
+
+    if progress:
+        progress(manifest['image_size'] - written)
+
+    return manifest, blocks
+
+
+def _seal_restored_image(hdd_image, tree):
+    """Store the Merkle tree of a freshly restored image
+
+    Args:
+        hdd_image: Path of the restored disk image
+        tree: The tree dict, or the path of a stored tree to copy
+    """
+    if not isinstance(tree, dict):
+        try:
+            tree = read_tree(tree)
+        except (OSError, ValueError):
+            # Nothing to seal with, verifying the image will need a new seal
+            _drop_seal(hdd_image)
+            return
+    tree = dict(tree, mtime=os.stat(hdd_image).st_mtime)
+    write_tree(tree_path(hdd_image), tree)
+
+
+def _drop_seal(hdd_image):
+    """Remove the Merkle tree stored for the previous contents of an image"""
+    if tree_path(hdd_image).exists():
+        tree_path(hdd_image).unlink()
+
+
+def flatten_snapshot(snapshot_path):
+    """Rewrite a manifest so it no longer depends on its parents
+
+    Args:
+        snapshot_path: Path to the manifest to flatten
+    """
+    snapshot_path = Path(snapshot_path)
+    manifest, blocks = resolve_blocks(snapshot_path)
+    if manifest.get('parent'):
+        with open_catalog(snapshot_path.parent) as catalog, catalog.transaction():
+            write_manifest(snapshot_path, _full_manifest(manifest, blocks))
+            catalog.update(snapshot_path.stem, parent=None)
+
+
+def delete_snapshot(snapshot_path):
+    """Delete a snapshot, merging its changes into its children
+
+    Each child is re-based onto the deleted snapshot's parent, so every other
+    point in the chain can still be restored. Blocks that are no longer
+    referenced are left in the chunk store for garbage collection.
+
+    Args:
+        snapshot_path: Path to the snapshot to delete
+    """
+    snapshot_path = Path(snapshot_path)
+
+    with open_catalog(snapshot_path.parent) as catalog, catalog.transaction():
+        if snapshot_path.suffix == MANIFEST_SUFFIX:
+            manifest = read_manifest(snapshot_path)
+            parent_name = manifest.get('parent')
+            parent_blocks = None
+            if parent_name:
+                _, parent_blocks = resolve_blocks(snapshot_path.parent / f"{parent_name}{MANIFEST_SUFFIX}")
+
+            for child_name in catalog.children(snapshot_path.stem):
+                child_path = snapshot_path.parent / f"{child_name}{MANIFEST_SUFFIX}"
+                child, child_blocks = resolve_blocks(child_path)
+                if parent_blocks is None:
+                    child = _full_manifest(child, child_blocks)
+                else:
+                    child = _delta_manifest(child, parent_name, parent_blocks, child_blocks)
+                write_manifest(child_path, child)
+                catalog.update(child_path.stem, parent=child['parent'])
+
+        catalog.remove(snapshot_path.stem)
+        snapshot_path.unlink()
+        if tree_path(snapshot_path).exists():
+            tree_path(snapshot_path).unlink()
@@ -0,0 +1,243 @@
+"""
+Merkle-tree integrity verification for disk images and snapshots
+
+An image is hashed in fixed-size leaves (the snapshot block size by default)
+and the leaf digests are combined pairwise into a Merkle tree. The leaves are
+stored next to the image in a ``.merkle`` file; verifying later re-hashes only
+the requested regions and reports exactly which leaves differ.
+
+Leaves are hashed in parallel over an mmap of the image, and leaves that
+fall into holes of a sparse image are not read at all. For manifest
+snapshots the block digests already are the leaves, so their tree comes for
+free and verifying them means re-hashing the stored chunks.
+"""
+
+import functools
+import hashlib
+import json
+import mmap
+import os
+from pathlib import Path
+
+from win9xman.core.chunkstore import DEFAULT_BLOCK_SIZE, hash_block
+from win9xman.utils.fileops import iter_data_blocks
+from win9xman.utils.parallel import parallel_map
+
+MERKLE_SUFFIX = ".merkle"
+
+# Leaf digest standing for an all-zero block, so holes need no hashing
+ZERO_LEAF = "0" * 64
+
+
+class IntegrityError(Exception):
+    """Raised when an image or snapshot doesn't match its recorded hashes"""
+
+    def __init__(self, message, bad_blocks):
+        super().__init__(message)
+        self.bad_blocks = bad_blocks
+
+
+@functools.lru_cache(maxsize=8)
+def _zero_digest(length):
+    """Get the digest of an all-zero block of the given length"""
+    return hash_block(bytes(length))
+
+
+def leaf_digest(data):
+    """Get the leaf digest of a block of image data (bytes or memoryview)"""
+    digest = hash_block(data)
+    return ZERO_LEAF if digest == _zero_digest(len(data)) else digest
+
+
+def merkle_root(leaves):
+    """Compute the root of the Merkle tree over a list of leaf digests"""
+    if not leaves:
+        return hashlib.sha256(b"").hexdigest()
+
+    level = [bytes.fromhex(leaf) for leaf in leaves]
+    while len(level) > 1:
+        # An odd node out is carried up unchanged
+        next_level = [hashlib.sha256(level[i] + level[i + 1]).digest()
+                      for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            next_level.append(level[-1])
+        level = next_level
+    return level[0].hex()
+
+
+def tree_path(image_path):
+    """Get the path of the stored Merkle tree of an image"""
+    image_path = Path(image_path)
+    return image_path.with_name(image_path.name + MERKLE_SUFFIX)
+
+
+def hash_image_leaves(image_path, leaf_size=DEFAULT_BLOCK_SIZE, indexes=None, workers=0, progress=None):
+    """Hash the leaves of an image in parallel
+
+    Args:
+        image_path: Path of the image to hash
+        leaf_size: Size of each leaf in bytes
+        indexes: Optional iterable of leaf indexes to hash, all by default
+        workers: Number of worker threads, 0 for one per core
+        progress: Optional callable receiving the number of bytes processed
+
+    Returns:
+        dict: Leaf digest for each hashed index
+    """
+    size = os.path.getsize(image_path)
+    leaf_count = (size + leaf_size - 1) // leaf_size
+    wanted = range(leaf_count) if indexes is None else sorted(set(indexes))
+    leaves = {}
+
+    if not size:
+        return leaves
+
+    with open(image_path, 'rb') as f:
+        # Leaves without any allocated data are zero, no need to read them
+        data_leaves = set(iter_data_blocks(f.fileno(), size, leaf_size))
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            view = memoryview(mm)
+
+            def hash_leaf(index):
+                start = index * leaf_size
+                end = min(start + leaf_size, size)
+                if index not in data_leaves:
+                    return index, ZERO_LEAF, end - start
+                return index, leaf_digest(view[start:end]), end - start
+
+            results = parallel_map(hash_leaf, wanted, workers)
+            try:
+                for index, digest, length in results:
+                    leaves[index] = digest
+                    if progress:
+                        progress(length)
+            finally:
+                # Wait for in-flight hashes before the mapping goes away
+                results.close()
+                view.release()
+
+    return leaves
+
+
+def build_tree(image_path, leaf_size=DEFAULT_BLOCK_SIZE, workers=0, progress=None):
+    """Hash a whole image and return its Merkle tree
+
+    Returns:
+        dict: The tree, with its leaves, leaf size, image size and root
+    """
+    leaves = hash_image_leaves(image_path, leaf_size, workers=workers, progress=progress)
+    leaves = [leaves[index] for index in range(len(leaves))]
+    stat = os.stat(image_path)
+    return {
+        'leaf_size': leaf_size,
+        'image_size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'leaves': leaves,
+        'root': merkle_root(leaves),
+    }
+
+
+def read_tree(path):
+    """Load a stored Merkle tree"""
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def write_tree(path, tree):
+    """Store a Merkle tree atomically"""
+    path = Path(path)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    with open(tmp_path, 'w') as f:
+        json.dump(tree, f)
+    os.replace(tmp_path, path)
+
+
+def seal_image(image_path, workers=0, progress=None):
+    """Hash an image and store its Merkle tree next to it
+
+    Returns:
+        dict: The stored tree
+    """
+    tree = build_tree(image_path, workers=workers, progress=progress)
+    write_tree(tree_path(image_path), tree)
+    return tree
+
+
+def regions_to_leaves(regions, leaf_size):
+    """Convert (offset, length) byte regions to the leaf indexes covering them"""
+    indexes = set()
+    for offset, length in regions:
+        if length > 0:
+            indexes.update(range(offset // leaf_size, (offset + length - 1) // leaf_size + 1))
+    return indexes
+
+
+def verify_image(image_path, tree=None, regions=None, workers=0, progress=None):
+    """Check an image against its stored Merkle tree
+
+    Args:
+        image_path: Path of the image to check
+        tree: Tree to check against, read from the .merkle file by default
+        regions: Optional list of (offset, length) byte regions to check,
+            the whole image by default
+        workers: Number of worker threads, 0 for one per core
+        progress: Optional callable receiving the number of bytes processed
+
+    Returns:
+        list: Indexes of the leaves that differ, empty if the image is intact
+    """
+    if tree is None:
+        tree = read_tree(tree_path(image_path))
+
+    leaf_size = tree['leaf_size']
+    expected = tree['leaves']
+    size = os.path.getsize(image_path)
+    leaf_count = (size + leaf_size - 1) // leaf_size
+
+    # A size change makes every leaf past the shorter end differ
+    bad = set(range(min(leaf_count, len(expected)), max(leaf_count, len(expected))))
+
+    indexes = range(min(leaf_count, len(expected)))
+    if regions is not None:
+        indexes = [i for i in regions_to_leaves(regions, leaf_size) if i < len(indexes)]
+
+    actual = hash_image_leaves(image_path, leaf_size, indexes, workers, progress)
+    bad.update(index for index, digest in actual.items() if digest != expected[index])
+    return sorted(bad)
+
+
+def verify_chunks(store, blocks, workers=0, progress=None, block_size=DEFAULT_BLOCK_SIZE):
+    """Check that the stored chunks of a manifest still match their digests
+
+    Args:
+        store: The ChunkStore holding the blocks
+        blocks: Resolved block digest list of the manifest, None for zero blocks
+        workers: Number of worker threads, 0 for one per core
+        progress: Optional callable receiving the number of bytes processed
+        block_size: Block size of the manifest, used for progress only
+
+    Returns:
+        list: Indexes of the blocks whose chunk is missing or corrupt
+    """
+    # Each distinct chunk only needs checking once
+    positions = {}
+    for index, digest in enumerate(blocks):
+        if digest is not None:
+            positions.setdefault(digest, []).append(index)
+
+    def check_chunk(digest):
+        try:
+            data = store.get(digest)
+        except Exception:
+            # Missing object, or zlib/lzma/zstd choking on corrupt data
+            return digest, False
+        return digest, hash_block(data) == digest
+
+    bad = []
+    for digest, ok in parallel_map(check_chunk, positions, workers):
+        if not ok:
+            bad.extend(positions[digest])
+        if progress:
+            progress(len(positions[digest]) * block_size)
+    return sorted(bad)
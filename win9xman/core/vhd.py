@@ -0,0 +1,375 @@
+"""
+Dynamic VHD disk images
+
+A dynamic VHD only stores the blocks of the disk that have been written to,
+listed in a block allocation table (BAT) at the start of the file. A fresh
+Windows install takes tens of megabytes instead of the full disk size on any
+host file system, sparse or not, and copying or moving the image only moves
+the data. DOSBox-X mounts them like raw images.
+
+Layout: a copy of the footer, the dynamic disk header, the BAT, then the data
+blocks, each preceded by its sector bitmap, and the footer at the very end.
+All fields are big-endian.
+"""
+
+import array
+import os
+import struct
+import sys
+import threading
+import time
+import uuid
+from pathlib import Path
+
+from win9xman.core.chunkstore import is_zero_block
+from win9xman.utils.fileops import iter_data_blocks
+
+VHD_SUFFIX = ".vhd"
+RAW_SUFFIX = ".img"
+
+SECTOR_SIZE = 512
+FOOTER_SIZE = 512
+HEADER_SIZE = 1024
+DEFAULT_BLOCK_SIZE = 2 * 1024 * 1024
+
+FOOTER_COOKIE = b'conectix'
+HEADER_COOKIE = b'cxsparse'
+FORMAT_VERSION = 0x00010000
+FEATURES_RESERVED = 0x00000002
+DISK_TYPE_DYNAMIC = 3
+CREATOR_APP = b'w9xm'
+CREATOR_HOST_OS = b'Wi2k'
+UNUSED_BLOCK = 0xFFFFFFFF
+NO_DATA_OFFSET = 0xFFFFFFFFFFFFFFFF
+
+# VHD timestamps count seconds from 2000-01-01 00:00:00 UTC
+VHD_EPOCH = 946684800
+
+# cookie, features, version, data offset, timestamp, creator application,
+# creator version, creator host OS, original size, current size, cylinders,
+# heads, sectors per track, disk type, checksum, unique id, saved state
+FOOTER_FORMAT = '>8sIIQI4sI4sQQHBBII16sB'
+# cookie, data offset, table offset, header version, max table entries,
+# block size, checksum
+HEADER_FORMAT = '>8sQQIIII'
+
+FOOTER_CHECKSUM_OFFSET = 64
+HEADER_CHECKSUM_OFFSET = 36
+
+
+class VhdError(Exception):
+    """Raised for files that aren't dynamic VHDs this module can handle"""
+
+
+def is_vhd(path):
+    """Check whether a disk image path names a VHD"""
+    return Path(path).suffix.lower() == VHD_SUFFIX
+
+
+def _checksum(data):
+    """One's complement of the byte sum, with the checksum field zeroed"""
+    return ~sum(data) & 0xFFFFFFFF
+
+
+def disk_geometry(total_sectors):
+    """Compute the CHS geometry the VHD specification assigns a disk size
+
+    Returns:
+        tuple: (cylinders, heads, sectors per track)
+    """
+    total_sectors = min(total_sectors, 65535 * 16 * 255)
+    if total_sectors >= 65535 * 16 * 63:
+        sectors, heads = 255, 16
+        cylinder_heads = total_sectors // sectors
+    else:
+        sectors = 17
+        cylinder_heads = total_sectors // sectors
+        heads = max((cylinder_heads + 1023) // 1024, 4)
+        if cylinder_heads >= heads * 1024 or heads > 16:
+            sectors, heads = 31, 16
+            cylinder_heads = total_sectors // sectors
+        if cylinder_heads >= heads * 1024:
+            sectors, heads = 63, 16
+            cylinder_heads = total_sectors // sectors
+    return cylinder_heads // heads, heads, sectors
+
+
+def usable_size(size):
+    """Round a disk size down to what its VHD geometry can address
+
+    Emulators addressing the disk by its CHS geometry don't see sectors past
+    cylinders * heads * sectors, so new disks are made exactly that size.
+    """
+    cylinders, heads, sectors = disk_geometry(size // SECTOR_SIZE)
+    return cylinders * heads * sectors * SECTOR_SIZE
+
+
+def build_footer(size, unique_id=None, timestamp=None):
+    """Build the footer of a dynamic disk of the given size"""
+    cylinders, heads, sectors = disk_geometry(size // SECTOR_SIZE)
+    # Converted images may not be a whole number of cylinders; one more
+    # keeps their last sectors addressable
+    if cylinders * heads * sectors * SECTOR_SIZE < size and cylinders < 65535:
+        cylinders += 1
+    if timestamp is None:
+        timestamp = int(time.time()) - VHD_EPOCH
+
+    footer = bytearray(FOOTER_SIZE)
+    struct.pack_into(FOOTER_FORMAT, footer, 0,
+                     FOOTER_COOKIE, FEATURES_RESERVED, FORMAT_VERSION, FOOTER_SIZE,
+                     timestamp & 0xFFFFFFFF, CREATOR_APP, FORMAT_VERSION, CREATOR_HOST_OS,
+                     size, size, cylinders, heads, sectors, DISK_TYPE_DYNAMIC, 0,
+                     unique_id or uuid.uuid4().bytes, 0)
+    struct.pack_into('>I', footer, FOOTER_CHECKSUM_OFFSET, _checksum(footer))
+    return bytes(footer)
+
+
+def build_header(table_entries, block_size=DEFAULT_BLOCK_SIZE):
+    """Build the dynamic disk header, with the BAT right after it"""
+    header = bytearray(HEADER_SIZE)
+    struct.pack_into(HEADER_FORMAT, header, 0,
+                     HEADER_COOKIE, NO_DATA_OFFSET, FOOTER_SIZE + HEADER_SIZE,
+                     FORMAT_VERSION, table_entries, block_size, 0)
+    struct.pack_into('>I', header, HEADER_CHECKSUM_OFFSET, _checksum(header))
+    return bytes(header)
+
+
+def _round_up(value, multiple):
+    """Round a value up to a multiple"""
+    return (value + multiple - 1) // multiple * multiple
+
+
+def create_vhd(path, size, block_size=DEFAULT_BLOCK_SIZE):
+    """Create an empty dynamic VHD, with no block allocated
+
+    Args:
+        path: Path of the file to create
+        size: Size of the virtual disk in bytes, a multiple of the sector size
+        block_size: Size of the allocation blocks
+    """
+    if size <= 0 or size % SECTOR_SIZE:
+        raise ValueError(f"A VHD must be a whole number of sectors, not {size} bytes")
+
+    table_entries = (size + block_size - 1) // block_size
+    table_size = _round_up(table_entries * 4, SECTOR_SIZE)
+    footer = build_footer(size)
+
+    with open(path, 'wb') as f:
+        f.write(footer)
+        f.write(build_header(table_entries, block_size))
+        f.write(b'\xff' * table_size)
+        f.write(footer)
+
+
+class VhdImage:
+    """Random access to the virtual disk of a dynamic VHD
+
+    Exposes the same interface as win9xman.core.image.RawImage, so the
+    filesystem reader works on VHDs unchanged. Unallocated blocks read as
+    zeros. Writing to one allocates it at the end of the file.
+
+    Args:
+        path: Path of the VHD
+        writable: Open the image for writing too
+    """
+
+    def __init__(self, path, writable=False):
+        self.path = Path(path)
+        self._file = open(self.path, 'rb+' if writable else 'rb')
+        try:
+            self._read_metadata()
+        except BaseException:
+            self._file.close()
+            raise
+        self._lock = threading.Lock()
+
+    def _read_metadata(self):
+        """Parse the footer, header and BAT"""
+        fd = self._file.fileno()
+        file_size = os.fstat(fd).st_size
+        footer = os.pread(fd, FOOTER_SIZE, file_size - FOOTER_SIZE) if file_size >= FOOTER_SIZE else b''
+        if footer[:8] != FOOTER_COOKIE:
+            # The end may be torn, the copy at the start never changes
+            footer = os.pread(fd, FOOTER_SIZE, 0)
+        if len(footer) < FOOTER_SIZE or footer[:8] != FOOTER_COOKIE:
+            raise VhdError(f"{self.path.name} is not a VHD")
+
+        (_, _, _, data_offset, _, _, _, _, _, self.size,
+         _, _, _, disk_type, _, _, _) = struct.unpack_from(FOOTER_FORMAT, footer)
+        if disk_type != DISK_TYPE_DYNAMIC:
+            raise VhdError(f"{self.path.name} is not a dynamic VHD (disk type {disk_type})")
+
+        header = os.pread(fd, HEADER_SIZE, data_offset)
+        cookie, _, table_offset, _, table_entries, self.block_size, _ = struct.unpack_from(
+            HEADER_FORMAT, header)
+        if cookie != HEADER_COOKIE:
+            raise VhdError(f"{self.path.name} has no dynamic disk header")
+
+        self._footer = footer
+        self._table_offset = table_offset
+        self._bitmap_size = _round_up(self.block_size // SECTOR_SIZE // 8, SECTOR_SIZE)
+        self._bat = array.array('I')
+        self._bat.frombytes(os.pread(fd, table_entries * 4, table_offset))
+        if sys.byteorder == 'little':
+            self._bat.byteswap()
+
+        # New blocks go where the footer is, past every allocated block
+        self._end = max([file_size - FOOTER_SIZE] +
+                        [entry * SECTOR_SIZE + self._bitmap_size + self.block_size
+                         for entry in self._bat if entry != UNUSED_BLOCK])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _block_offset(self, index):
+        """Get the file offset of the data of a block, or None if unallocated"""
+        entry = self._bat[index]
+        if entry == UNUSED_BLOCK:
+            return None
+        return entry * SECTOR_SIZE + self._bitmap_size
+
+    def _allocate(self, index):
+        """Allocate a block at the end of the file and return its data offset"""
+        with self._lock:
+            offset = self._block_offset(index)
+            if offset is not None:
+                return offset
+
+            fd = self._file.fileno()
+            start = _round_up(self._end, SECTOR_SIZE)
+            self._end = start + self._bitmap_size + self.block_size
+            # Every sector of a dynamic disk's block counts as present;
+            # the data area stays a hole until written
+            os.pwrite(fd, b'\xff' * self._bitmap_size, start)
+            os.pwrite(fd, self._footer, self._end)
+            self._bat[index] = start // SECTOR_SIZE
+            os.pwrite(fd, struct.pack('>I', self._bat[index]), self._table_offset + index * 4)
+            return start + self._bitmap_size
+
+    def read(self, offset, length):
+        """Read up to length bytes at an offset"""
+        end = min(offset + length, self.size)
+        parts = []
+        while offset < end:
+            index, start = divmod(offset, self.block_size)
+            count = min(self.block_size - start, end - offset)
+            block_offset = self._block_offset(index)
+            if block_offset is None:
+                parts.append(bytes(count))
+            else:
+                data = os.pread(self._file.fileno(), count, block_offset + start)
+                # A block cut short by a torn write reads as zeros past its end
+                parts.append(data + bytes(count - len(data)))
+            offset += count
+        if len(parts) == 1:
+            return parts[0]
+        return b''.join(parts)
+
+    def write(self, offset, data):
+        """Write data at an offset of an image opened writable
+
+        Returns:
+            int: The number of bytes written
+        """
+        data = memoryview(data)
+        position = 0
+        while position < len(data):
+            index, start = divmod(offset + position, self.block_size)
+            count = min(self.block_size - start, len(data) - position)
+            block_offset = self._block_offset(index)
+            if block_offset is None:
+                block_offset = self._allocate(index)
+            os.pwrite(self._file.fileno(), data[position:position + count], block_offset + start)
+            position += count
+        return position
+
+    def data_ranges(self):
+        """Iterate over the (offset, length) ranges of the disk that are allocated"""
+        run_start = None
+        for index, entry in enumerate(self._bat):
+            if entry != UNUSED_BLOCK:
+                if run_start is None:
+                    run_start = index
+                continue
+            if run_start is not None:
+                yield run_start * self.block_size, (index - run_start) * self.block_size
+                run_start = None
+        if run_start is not None:
+            start = run_start * self.block_size
+            yield start, min(len(self._bat) * self.block_size, self.size) - start
+
+    def fileno(self):
+        """Get the file descriptor of the VHD file"""
+        return self._file.fileno()
+
+    def close(self):
+        """Close the image"""
+        self._file.close()
+
+
+def disk_size(path):
+    """Get the size of the disk a raw image or VHD holds"""
+    if is_vhd(path):
+        with VhdImage(path) as image:
+            return image.size
+    return os.path.getsize(path)
+
+
+def convert_to_vhd(raw_path, vhd_path, progress=None):
+    """Write the contents of a raw image to a new dynamic VHD
+
+    Only allocated ranges of the raw image are read, and blocks that turn out
+    to be all zeros are left unallocated.
+
+    Args:
+        raw_path: Path of the raw image to convert
+        vhd_path: Path of the VHD to create
+        progress: Optional callable receiving the number of bytes processed
+    """
+    size = os.path.getsize(raw_path)
+    create_vhd(vhd_path, _round_up(size, SECTOR_SIZE))
+    done = 0
+
+    with open(raw_path, 'rb') as f, VhdImage(vhd_path, writable=True) as vhd:
+        fd = f.fileno()
+        block_size = vhd.block_size
+        for index in iter_data_blocks(fd, size, block_size):
+            data = os.pread(fd, block_size, index * block_size)
+            if not is_zero_block(data):
+                vhd.write(index * block_size, data)
+            if progress:
+                # Holes skipped before this block count as processed
+                progress(index * block_size + len(data) - done)
+            done = index * block_size + len(data)
+
+    if progress:
+        progress(size - done)
+
+
+def convert_to_raw(vhd_path, raw_path, progress=None):
+    """Write the virtual disk of a VHD to a new sparse raw image
+
+    Args:
+        vhd_path: Path of the VHD to convert
+        raw_path: Path of the raw image to create
+        progress: Optional callable receiving the number of bytes processed
+    """
+    done = 0
+    with VhdImage(vhd_path) as vhd, open(raw_path, 'wb') as f:
+        fd = f.fileno()
+        os.ftruncate(fd, vhd.size)
+        for start, length in vhd.data_ranges():
+            for offset in range(start, start + length, vhd.block_size):
+                data = vhd.read(offset, vhd.block_size)
+                if not is_zero_block(data):
+                    os.pwrite(fd, data, offset)
+                if progress:
+                    progress(offset + len(data) - done)
+                done = offset + len(data)
+        size = vhd.size
+
+    if progress:
+        progress(size - done)
@@ -0,0 +1,40 @@
+"""
+Startup of the Windows 9x Manager GUI
+"""
+
+import tkinter as tk
+from tkinter import ttk, messagebox
+
+from win9xman.ui.manager import Win9xManager
+from win9xman.utils.config import load_settings
+from win9xman.utils.paths import Layout, default_base_dir
+from win9xman.utils.system import check_requirements
+
+def main():
+    """Open the manager window and run the Tk main loop"""
+    # Check if required dependencies are installed
+    settings = load_settings(Layout().settings_conf)
+    if not check_requirements(report=lambda message: messagebox.showerror("Error", message),
+                              configured=settings.get('emulator', 'path')):
+        return
+        
+    root = tk.Tk()
+    root.title("Windows 9x Manager")
+    
+    # Use system theme
+    try:
+        ttk.Style().theme_use('clam')  # A decent cross-platform theme
+    except tk.TclError:
+        pass  # If theme not available, use default
+    
+    # Create the app
+    app = Win9xManager(root)
+    
+    # Add program icon if available
+    icon_path = default_base_dir() / "assets" / "icon.png"
+    if icon_path.exists():
+        img = tk.PhotoImage(file=icon_path)
+        root.tk.call('wm', 'iconphoto', root._w, img)
+    
+    # Start the main loop
+    root.mainloop()
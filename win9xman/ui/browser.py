@@ -0,0 +1,184 @@
+"""
+Browser for the files inside a disk image or snapshot
+"""
+
+import tkinter as tk
+from tkinter import ttk, filedialog, messagebox
+from pathlib import Path, PurePosixPath
+
+from win9xman.core import fatfs
+from win9xman.core import fatwrite
+from win9xman.core.lock import run_locked
+from win9xman.ui.jobs import format_size
+
+# Child item standing in for the contents of a directory not opened yet
+PLACEHOLDER = "placeholder"
+
+
+class DiskBrowser:
+    """Window listing the directory tree of a disk image, with extraction
+
+    Directories are read when they are first expanded. Extractions run as
+    background jobs on their own view of the image, so the window can be
+    closed while they run.
+
+    Args:
+        root: The Tkinter root window
+        image_path: Path of the raw image or manifest snapshot to browse
+        job_monitor: The JobMonitor running background jobs
+        title: Window title
+        writable: Offer to copy host files into the image
+    """
+
+    def __init__(self, root, image_path, job_monitor, title, writable=False):
+        self.image_path = Path(image_path)
+        self.job_monitor = job_monitor
+        self.volume = fatfs.open_volume(self.image_path)
+        self.entries = {}
+
+        self.window = tk.Toplevel(root)
+        self.window.title(title)
+        self.window.geometry("600x450")
+        self.window.transient(root)
+        self.window.protocol("WM_DELETE_WINDOW", self.close)
+
+        tree_frame = ttk.Frame(self.window)
+        tree_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+
+        scrollbar = ttk.Scrollbar(tree_frame)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+
+        self.tree = ttk.Treeview(tree_frame, columns=("size", "modified"), selectmode="extended")
+        self.tree.heading("#0", text="Name")
+        self.tree.heading("size", text="Size")
+        self.tree.heading("modified", text="Modified")
+        self.tree.column("#0", width=300)
+        self.tree.column("size", width=90, anchor=tk.E)
+        self.tree.column("modified", width=140)
+        self.tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.tree.config(yscrollcommand=scrollbar.set)
+        scrollbar.config(command=self.tree.yview)
+        self.tree.bind("<<TreeviewOpen>>", self._on_open)
+
+        button_frame = ttk.Frame(self.window)
+        button_frame.pack(fill=tk.X, pady=(0, 10))
+        ttk.Button(button_frame, text="Extract...", command=self.extract).pack(side=tk.LEFT, padx=10)
+        if writable:
+            ttk.Button(button_frame, text="Add Files...",
+                       command=self.add_files).pack(side=tk.LEFT, padx=(0, 10))
+            ttk.Button(button_frame, text="Add Folder...",
+                       command=self.add_folder).pack(side=tk.LEFT, padx=(0, 10))
+        ttk.Label(button_frame, text=f"Volume {self.volume.label or '(no label)'}, "
+                                     f"FAT{self.volume.fat_type}").pack(side=tk.LEFT, padx=10)
+        ttk.Button(button_frame, text="Close", command=self.close).pack(side=tk.RIGHT, padx=10)
+
+        self._populate("", "/")
+
+    def _populate(self, parent, path):
+        """Insert the entries of a directory under a tree item"""
+        try:
+            entries = self.volume.listdir(path)
+        except (OSError, fatfs.FatError) as e:
+            messagebox.showerror("Error", f"Failed to read {path}: {str(e)}", parent=self.window)
+            return
+
+        # Directories first, then files, each alphabetically
+        for entry in sorted(entries, key=lambda e: (not e.is_dir, e.name.upper())):
+            entry_path = str(PurePosixPath(path, entry.name))
+            self.entries[entry_path] = entry
+            modified = entry.modified.strftime("%Y-%m-%d %H:%M") if entry.modified else ""
+            size = "" if entry.is_dir else format_size(entry.size)
+            self.tree.insert(parent, tk.END, iid=entry_path, text=entry.name, values=(size, modified))
+            if entry.is_dir:
+                self.tree.insert(entry_path, tk.END, iid=f"{entry_path}/{PLACEHOLDER}")
+
+    def _on_open(self, event):
+        """Read a directory the first time it is expanded"""
+        path = self.tree.focus()
+        placeholder = f"{path}/{PLACEHOLDER}"
+        if self.tree.exists(placeholder):
+            self.tree.delete(placeholder)
+            self._populate(path, path)
+
+    def extract(self):
+        """Copy the selected files and directories to a host directory"""
+        paths = [path for path in self.tree.selection() if path in self.entries]
+        if not paths:
+            messagebox.showinfo("Extract", "Select the files or directories to extract.",
+                                parent=self.window)
+            return
+
+        dest_dir = filedialog.askdirectory(title="Extract To", parent=self.window)
+        if not dest_dir:
+            return
+        dest_dir = Path(dest_dir)
+
+        total = sum(self.volume.tree_size(self.entries[path]) for path in paths)
+        image_path = self.image_path
+
+        def extract_task(job):
+            # A view of its own, the browser may be closed meanwhile
+            with fatfs.open_volume(image_path) as volume:
+                for path in paths:
+                    job.check_cancelled()
+                    name = PurePosixPath(path).name
+                    fatfs.check_host_name(name)
+                    volume.extract(path, dest_dir / name, job.progress)
+
+        self.job_monitor.run(f"Extracting {len(paths)} items", extract_task, total=total,
+                             on_success=lambda _: messagebox.showinfo(
+                                 "Extract", f"Extracted to {dest_dir}."))
+
+    def _target_dir(self):
+        """Get the image directory the selection points at"""
+        focus = self.tree.focus()
+        if focus not in self.entries:
+            return "/"
+        if self.entries[focus].is_dir:
+            return focus
+        return str(PurePosixPath(focus).parent)
+
+    def add_files(self):
+        """Copy host files into the selected directory of the image"""
+        files = filedialog.askopenfilenames(title="Add Files", parent=self.window)
+        if files:
+            self._inject(list(files))
+
+    def add_folder(self):
+        """Copy a host directory tree into the selected directory of the image"""
+        folder = filedialog.askdirectory(title="Add Folder", parent=self.window)
+        if folder:
+            self._inject([folder])
+
+    def _inject(self, sources):
+        """Run a job copying host paths into the image, then refresh the tree"""
+        dest = self._target_dir()
+        image_path = self.image_path
+
+        def inject_task(job):
+            # Never under a running guest, which would overwrite the FAT again
+            run_locked(image_path, fatwrite.inject_files, image_path, sources, dest, progress=job.progress)
+
+        def on_success(_):
+            if self.window.winfo_exists():
+                self.refresh()
+
+        def on_error(e):
+            messagebox.showerror("Error", f"Failed to copy files into the disk image: {str(e)}\n\n"
+                                          "The disk image was left unchanged.")
+
+        self.job_monitor.run(f"Copying files to {dest}", inject_task,
+                             total=fatwrite.tree_size(sources),
+                             on_success=on_success, on_error=on_error)
+
+    def refresh(self):
+        """Re-read the image after it changed"""
+        self.volume.invalidate()
+        self.entries.clear()
+        self.tree.delete(*self.tree.get_children())
+        self._populate("", "/")
+
+    def close(self):
+        """Close the window and the image"""
+        self.volume.close()
+        self.window.destroy()
@@ -0,0 +1,48 @@
+"""
+Disk image dialogs
+"""
+
+from tkinter import messagebox
+
+from win9xman.core.disk import make_hdd_image
+
+
+def create_hdd_image(root, hdd_image, hdd_size, job_monitor):
+    """Create a new HDD image file
+
+    The image is created by a background job while the UI stays responsive.
+
+    Args:
+        root: The Tkinter root window
+        hdd_image: Path to the HDD image file to create
+        hdd_size: Size of the HDD in MB
+        job_monitor: The JobMonitor running background jobs
+
+    Returns:
+        bool: True if the image was created successfully, False otherwise
+    """
+    # Confirm creation
+    if not messagebox.askyesno("Confirm HDD Creation",
+                             f"Create new disk image of {hdd_size}MB?"):
+        return False
+
+    result = [False]  # Use list for result
+
+    def create_task(job):
+        make_hdd_image(hdd_image, hdd_size, job.progress)
+
+    def on_success(_):
+        result[0] = True
+        messagebox.showinfo("Success", f"Disk image of {hdd_size}MB created successfully.")
+
+    def on_error(error):
+        messagebox.showerror("Error", "Failed to create HDD image. Please check your permissions.")
+
+    job, dialog = job_monitor.run(f"Creating disk image of {hdd_size}MB", create_task,
+                                  total=hdd_size * 1024 * 1024,
+                                  on_success=on_success, on_error=on_error)
+
+    # Keep processing events until the job is finished and its dialog closed
+    root.wait_window(dialog.window)
+
+    return result[0]
@@ -0,0 +1,139 @@
+"""
+Log windows for running DOSBox-X instances
+"""
+
+import tkinter as tk
+from tkinter import ttk, messagebox
+
+from win9xman.core.emulator import ERROR, EXITED, FAILED, FINISHED_STATES, WARNING
+from win9xman.ui.jobs import POLL_INTERVAL, format_duration
+
+
+class EmulatorWindow:
+    """Window showing the output, state and run time of one DOSBox-X instance"""
+
+    def __init__(self, root, process):
+        self.process = process
+        self.shown = 0
+
+        self.window = tk.Toplevel(root)
+        self.window.title(f"DOSBox-X - {process.title}")
+        self.window.geometry("640x320")
+        self.window.protocol("WM_DELETE_WINDOW", self.close)
+
+        self.status = ttk.Label(self.window, text="Starting...")
+        self.status.pack(fill=tk.X, padx=10, pady=(10, 5))
+
+        log_frame = ttk.Frame(self.window)
+        log_frame.pack(fill=tk.BOTH, expand=True, padx=10)
+        scrollbar = ttk.Scrollbar(log_frame)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.text = tk.Text(log_frame, height=12, wrap=tk.NONE, state=tk.DISABLED,
+                            yscrollcommand=scrollbar.set)
+        self.text.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        scrollbar.config(command=self.text.yview)
+        self.text.tag_configure(ERROR, foreground="red")
+        self.text.tag_configure(WARNING, foreground="darkorange")
+
+        button_frame = ttk.Frame(self.window)
+        button_frame.pack(fill=tk.X, pady=10)
+        self.stop_button = ttk.Button(button_frame, text="Stop", command=self.stop)
+        self.stop_button.pack(side=tk.LEFT, padx=10)
+        ttk.Button(button_frame, text="Close", command=self.close).pack(side=tk.RIGHT, padx=10)
+
+    def update(self):
+        """Append new output and refresh the status line"""
+        lines, self.shown = self.process.lines_since(self.shown)
+        if lines:
+            # Only follow the output if the user hasn't scrolled up
+            at_end = self.text.yview()[1] >= 1.0
+            self.text.config(state=tk.NORMAL)
+            for level, text in lines:
+                self.text.insert(tk.END, text + "\n", level)
+            self.text.config(state=tk.DISABLED)
+            if at_end:
+                self.text.see(tk.END)
+
+        process = self.process
+        elapsed = format_duration(process.elapsed())
+        if process.state == FAILED:
+            text = f"Could not start DOSBox-X: {process.error}"
+        elif process.state == EXITED:
+            text = f"Exited with status {process.returncode} after {elapsed}"
+        else:
+            text = f"Running for {elapsed}"
+        self.status.config(text=text)
+        if process.state in FINISHED_STATES:
+            self.stop_button.config(state=tk.DISABLED)
+
+    def stop(self):
+        """Ask DOSBox-X to exit, after confirmation"""
+        if messagebox.askyesno("Stop DOSBox-X",
+                             "Stopping DOSBox-X is like switching the machine off; Windows loses "
+                             "unsaved work and may need ScanDisk.\n\nStop it anyway?",
+                             parent=self.window):
+            self.process.terminate()
+
+    def close(self):
+        """Close the window; DOSBox-X keeps running"""
+        self.window.destroy()
+        self.window = None
+
+
+class EmulatorMonitor:
+    """Bridge between the process supervisor and the Tk main loop
+
+    Opens a log window per instance, keeps the windows up to date and runs
+    exit callbacks on the main thread.
+    """
+
+    def __init__(self, root, supervisor):
+        self.root = root
+        self.supervisor = supervisor
+        self._tracked = {}
+        self.root.after(POLL_INTERVAL, self._poll)
+
+    def launch(self, title, command, on_exit=None, cleanup=None, placement=None, pass_fds=()):
+        """Start DOSBox-X and show its log window
+
+        Args:
+            title: Human readable description of the instance
+            command: Command line to run
+            on_exit: Called on the main thread with the process once it has
+                ended, whether it ran or could not be started. A process
+                that failed or exited with an error is reported with an
+                error box when not given.
+            cleanup: Optional function to run, on any thread, once the
+                process has ended
+            placement: Optional Placement of the process on the host
+            pass_fds: Descriptors the process inherits
+
+        Returns:
+            EmulatorProcess: The process
+        """
+        process = self.supervisor.launch(title, command, cleanup, placement, pass_fds)
+        self._tracked[process.id] = (process, EmulatorWindow(self.root, process), on_exit)
+        return process
+
+    def _poll(self):
+        """Refresh the log windows and handle ended processes"""
+        finished = [p for p in self.supervisor.drain_events() if p.state in FINISHED_STATES]
+
+        for process, window, _ in list(self._tracked.values()):
+            if window is not None and window.window is not None:
+                window.update()
+
+        for process in finished:
+            if process.id not in self._tracked:
+                continue
+            _, window, on_exit = self._tracked.pop(process.id)
+            if on_exit:
+                on_exit(process)
+            elif process.state == FAILED:
+                messagebox.showerror("Error", f"Could not start DOSBox-X: {str(process.error)}")
+            elif process.returncode != 0:
+                messagebox.showerror("DOSBox-X Failed",
+                                   f"DOSBox-X ({process.title}) exited with status "
+                                   f"{process.returncode}. See its log window for details.")
+
+        self.root.after(POLL_INTERVAL, self._poll)
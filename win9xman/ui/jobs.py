@@ -0,0 +1,143 @@
+"""
+Progress dialogs for background jobs
+"""
+
+import tkinter as tk
+from tkinter import ttk, messagebox
+
+from win9xman.core.jobs import DONE, FAILED, CANCELLED, FINISHED_STATES
+
+POLL_INTERVAL = 100  # ms between two checks of the job event queue
+
+
+def format_size(nbytes):
+    """Format a byte count in MB"""
+    return f"{nbytes / (1024 * 1024):.1f} MB"
+
+
+def format_duration(seconds):
+    """Format a duration as m:ss"""
+    seconds = int(seconds)
+    return f"{seconds // 60}:{seconds % 60:02d}"
+
+
+class JobDialog:
+    """Progress window for a single job, with throughput, ETA and cancel"""
+
+    def __init__(self, root, job):
+        self.job = job
+        self.window = tk.Toplevel(root)
+        self.window.title(job.title)
+        self.window.geometry("420x140")
+        self.window.transient(root)
+        self.window.protocol("WM_DELETE_WINDOW", self.cancel)
+
+        ttk.Label(self.window, text=f"{job.title}...").pack(pady=(10, 5))
+
+        self.progress = ttk.Progressbar(self.window, mode="determinate", length=360, maximum=100)
+        self.progress.pack(pady=5, padx=20)
+
+        self.status = ttk.Label(self.window, text="Waiting...")
+        self.status.pack(pady=5)
+
+        self.cancel_button = ttk.Button(self.window, text="Cancel", command=self.cancel)
+        self.cancel_button.pack(pady=5)
+
+        if not job.total:
+            self.progress.config(mode="indeterminate")
+            self.progress.start()
+
+    def cancel(self):
+        """Ask the job to stop"""
+        self.job.cancel()
+        self.cancel_button.config(state=tk.DISABLED)
+        self.status.config(text="Cancelling...")
+
+    def update(self):
+        """Refresh the dialog from the job state"""
+        job = self.job
+        if job.cancelled:
+            return
+
+        if job.total:
+            if str(self.progress.cget("mode")) != "determinate":
+                self.progress.stop()
+                self.progress.config(mode="determinate")
+            self.progress["value"] = min(100.0, 100.0 * job.done / job.total)
+            text = f"{format_size(job.done)} of {format_size(job.total)}"
+        else:
+            text = format_size(job.done)
+
+        text += f" - {format_size(job.throughput())}/s"
+        eta = job.eta()
+        if eta is not None:
+            text += f" - {format_duration(eta)} left"
+        self.status.config(text=text)
+
+    def close(self):
+        """Close the dialog"""
+        self.progress.stop()
+        self.window.destroy()
+
+
+class JobMonitor:
+    """Bridge between the job engine and the Tk main loop
+
+    Polls the job event queue from the main loop, refreshes the progress
+    dialogs and runs completion callbacks on the main thread, where it is
+    safe to touch Tk widgets.
+    """
+
+    def __init__(self, root, job_manager):
+        self.root = root
+        self.jobs = job_manager
+        self._tracked = {}
+        self.root.after(POLL_INTERVAL, self._poll)
+
+    def run(self, title, func, total=0, on_success=None, on_error=None, show_dialog=True):
+        """Submit a job and track it
+
+        Args:
+            title: Human readable description of the job
+            func: Work function, called with the Job on a worker thread
+            total: Expected number of bytes to process, if known up front
+            on_success: Called with the job result when the job completes
+            on_error: Called with the exception when the job fails. Failures
+                are reported with an error box when not given
+            show_dialog: Show a progress dialog for the job
+
+        Returns:
+            tuple: (job, dialog) where dialog is None if not shown
+        """
+        job = self.jobs.submit(title, func, total)
+        dialog = JobDialog(self.root, job) if show_dialog else None
+        self._tracked[job.id] = (job, dialog, on_success, on_error)
+        return job, dialog
+
+    def _poll(self):
+        """Process pending job events"""
+        for job in self.jobs.drain_events():
+            if job.id not in self._tracked:
+                continue
+            _, dialog, on_success, on_error = self._tracked[job.id]
+
+            if job.state not in FINISHED_STATES:
+                if dialog:
+                    dialog.update()
+                continue
+
+            del self._tracked[job.id]
+            if dialog:
+                dialog.close()
+
+            if job.state == DONE and on_success:
+                on_success(job.result)
+            elif job.state == FAILED:
+                if on_error:
+                    on_error(job.error)
+                else:
+                    messagebox.showerror("Error", f"{job.title} failed: {str(job.error)}")
+            elif job.state == CANCELLED:
+                messagebox.showinfo("Cancelled", f"{job.title} was cancelled.")
+
+        self.root.after(POLL_INTERVAL, self._poll)
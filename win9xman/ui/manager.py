@@ -2,73 +2,102 @@
 Main UI manager class for Windows 9x Manager
 """
 
-import os
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
 from tkinter.simpledialog import askstring
-from datetime import datetime
 from pathlib import Path
 import configparser
 import subprocess
-import shutil
 
-from win9xman.core.disk import create_hdd_image
-from win9xman.utils.config import create_temp_config, generate_config_from_template, create_default_template
+from win9xman.core.disk import convert_image
+from win9xman.core import snapshot
+from win9xman.core import verify
+from win9xman.core import retention
+from win9xman.core import journal
+from win9xman.core import fatfs
+from win9xman.core import compact
+from win9xman.core import defrag
+from win9xman.core import vhd
+from win9xman.core import session
+from win9xman.core import savestate
+from win9xman.core.calibrate import Calibrator
+from win9xman.core.emulator import FAILED, Supervisor
+from win9xman.core.jobs import JobManager
+from win9xman.core.lock import ImageLock, ImageLockedError, run_locked
+from win9xman.ui.browser import DiskBrowser
+from win9xman.ui.disk import create_hdd_image
+from win9xman.ui.emulator import EmulatorMonitor
+from win9xman.ui.jobs import JobMonitor, format_size
+from win9xman.utils.config import (DEFAULT_CONFIG_VARS, create_temp_config, generate_config_from_template,
+                                   create_default_template, load_settings, render_autoexec)
+from win9xman.utils.paths import OS_TITLES, Layout
+from win9xman.utils.profiles import NO_PROFILE, host_profile_name, save_profile
+from win9xman.utils.system import check_requirements
 
 class Win9xManager:
-    def __init__(self, root):
+    def __init__(self, root, base_dir=None):
         self.root = root
         self.root.title("Windows 9x Manager")
-        self.root.geometry("600x450")
-        self.root.minsize(600, 450)
-        
-        # Set up base paths
-        self.base_dir = Path(os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__)))))
-        self.templates_dir = self.base_dir / "templates"
-        self.dosbox_conf = self.base_dir / "config" / "dosbox.conf"
-        self.win98_drive = self.base_dir / "win98_drive"
-        self.win95_drive = self.base_dir / "win95_drive"
-        self.iso_dir = self.base_dir / "iso"
-        self.img_dir = self.base_dir / "disks"
-        self.win98_hdd = self.img_dir / "win98.img"
-        self.win95_hdd = self.img_dir / "win95.img"
-        self.snapshot_dir = self.base_dir / "snapshots"
-        self.snapshot_win95_dir = self.base_dir / "snapshots_win95"
+        self.root.geometry("600x820")
+        self.root.minsize(600, 500)
+        
+        # Set up base paths, shared with the command line interface; the
+        # directory of win9xman.py unless another one is given
+        self.layout = Layout(base_dir)
+        self.base_dir = self.layout.base_dir
+        self.templates_dir = self.layout.templates_dir
+        self.dosbox_conf = self.layout.dosbox_conf
+        self.settings_conf = self.layout.settings_conf
+        self.iso_dir = self.layout.iso_dir
+        self.img_dir = self.layout.img_dir
         
         # Default settings
         self.default_hdd_size = 2000  # Default size in MB for HDD image
         self.min_hdd_size = 500       # Minimum size in MB
         self.max_hdd_size = 4000      # Maximum size in MB
         
+        # Manager settings
+        self.settings = load_settings(self.settings_conf)
+        
         # Current OS selection
         self.current_os = tk.StringVar(value="win98")
         
+        # Background jobs for long disk operations
+        self.job_manager = JobManager()
+        self.job_monitor = JobMonitor(self.root, self.job_manager)
+        
+        # DOSBox-X runs without blocking the manager, with a log window
+        self.supervisor = Supervisor()
+        self.emulators = EmulatorMonitor(self.root, self.supervisor)
+        self.root.protocol("WM_DELETE_WINDOW", self.quit)
+        
         # Create necessary directories
         self._create_directories()
         
+        # Finish or undo disk image restores interrupted by a crash
+        self._recover_interrupted_restores()
+        
         # Create UI
         self._create_ui()
     
     def _create_directories(self):
         """Create necessary directories if they don't exist"""
-        directories = [
-            self.win98_drive,
-            self.win95_drive,
-            self.iso_dir,
-            self.img_dir,
-            self.snapshot_dir,
-            self.snapshot_win95_dir,
-            self.base_dir / "config",
-            self.templates_dir
-        ]
-        
-        for directory in directories:
+        for directory in self.layout.directories():
             directory.mkdir(exist_ok=True, parents=True)
             
         # Create default DOSBox-X config if it doesn't exist
         if not self.dosbox_conf.exists():
             self._create_default_config()
     
+    def _recover_interrupted_restores(self):
+        """Roll interrupted disk image replacements forward or back"""
+        recovered = journal.recover_directory(self.img_dir)
+        if recovered:
+            details = "\n".join(f"{name}: {action}" for name, action in sorted(recovered.items()))
+            messagebox.showwarning("Interrupted Restore Recovered",
+                                 "A disk image restore or commit was interrupted last time and "
+                                 f"has been recovered:\n\n{details}")
+    
     def _create_default_config(self):
         """Create a default DOSBox-X configuration file from template"""
         config_dir = self.base_dir / "config"
@@ -80,14 +109,8 @@ class Win9xManager:
             create_default_template(self.templates_dir)
         
         # Create config from template
-        template_vars = {
-            'memsize': '64',
-            'cycles': 'max 80% limit 33000',
-            'machine': 'svga_s3',
-            'windowresolution': '1024x768',
-            'output': 'opengl'
-        }
-        generate_config_from_template(self.templates_dir, 'dosbox_template.conf', self.dosbox_conf, template_vars)
+        generate_config_from_template(self.templates_dir, 'dosbox_template.conf', self.dosbox_conf,
+                                      DEFAULT_CONFIG_VARS)
     
     def _create_ui(self):
         """Create the UI elements"""
@@ -107,13 +130,23 @@ class Win9xManager:
         # Create buttons with descriptions
         button_data = [
             ("Start Windows", "Launch Windows if already installed", self.start_windows),
+            ("Save Desktop State", "Boot Windows once, then start it at the desktop", self.capture_state),
+            ("Disposable Session", "Run Windows, then keep or throw away the changes", self.start_disposable),
+            ("RAM Session", "Run Windows from memory, saving the changes on exit", self.start_ram_session),
             ("Mount ISO & Start Windows", "Mount ISO as CD-ROM drive and start Windows", self.mount_iso),
             ("Install Windows from ISO", "Boot from ISO to install Windows", self.boot_iso),
             ("Format Hard Disk", "Create or reset disk image", self.format_disk),
             ("Create Snapshot", "Save current system state", self.create_snapshot),
             ("Restore Snapshot", "Restore previous system state", self.restore_snapshot),
+            ("Verify Disk Image", "Check the disk image for corruption", self.verify_disk),
+            ("Browse Disk Image", "Copy files into or out of the disk image", self.browse_disk),
+            ("Compact Disk Image", "Give the space of deleted files back to the host", self.compact_disk),
+            ("Defragment Disk", "Store every file contiguously on the disk image", self.defragment_disk),
+            ("Convert Disk Image", "Switch the disk image between raw and dynamic VHD", self.convert_disk),
+            ("Calibrate Performance", "Find the fastest smooth CPU settings for this computer",
+             self.calibrate_performance),
             ("Settings", "Configure DOSBox-X settings", self.open_settings),
-            ("Exit", "Close the application", self.root.quit)
+            ("Exit", "Close the application", self.quit)
         ]
         
         for i, (text, desc, command) in enumerate(button_data):
@@ -125,17 +158,36 @@ class Win9xManager:
             
             ttk.Label(frame, text=desc).pack(side=tk.LEFT, padx=5)
     
+    def quit(self):
+        """Close the application, cancelling running jobs after confirmation"""
+        if self.supervisor.running():
+            if not messagebox.askyesno("DOSBox-X Running",
+                                     "DOSBox-X is still running. It keeps running after the manager "
+                                     "exits, but changes made in a session will be lost.\n"
+                                     "Exit anyway?"):
+                return
+        if self.job_manager.active_jobs():
+            if not messagebox.askyesno("Jobs Running",
+                                     "Disk operations are still running and will be cancelled.\n"
+                                     "Exit anyway?"):
+                return
+        self.job_manager.shutdown(cancel=True)
+        self.root.quit()
+    
     def get_current_hdd(self):
-        """Get current HDD path based on selected OS"""
-        return self.win98_hdd if self.current_os.get() == "win98" else self.win95_hdd
+        """Get current HDD path based on selected OS
+        
+        A dynamic VHD takes the place of the raw image when there is one.
+        """
+        return self.layout.hdd_image(self.current_os.get())
     
     def get_current_drive_dir(self):
         """Get current drive directory based on selected OS"""
-        return self.win98_drive if self.current_os.get() == "win98" else self.win95_drive
+        return self.layout.drive_dir(self.current_os.get())
     
     def get_snapshot_dir(self):
         """Get snapshot directory based on selected OS"""
-        return self.snapshot_dir if self.current_os.get() == "win98" else self.snapshot_win95_dir
+        return self.layout.snapshot_dir(self.current_os.get())
     
     def create_hdd_image(self):
         """Create HDD image if it doesn't exist"""
@@ -147,7 +199,7 @@ class Win9xManager:
         # Create slider dialog for HDD size
         size_dialog = tk.Toplevel(self.root)
         size_dialog.title("Select HDD Size")
-        size_dialog.geometry("400x150")
+        size_dialog.geometry("400x200")
         size_dialog.resizable(False, False)
         size_dialog.transient(self.root)
         size_dialog.grab_set()
@@ -167,6 +219,15 @@ class Win9xManager:
         
         slider.bind("<Motion>", update_label)
         
+        # Raw images are the most compatible, dynamic VHDs only grow as needed
+        format_var = tk.StringVar(value="raw")
+        format_frame = ttk.Frame(size_dialog)
+        format_frame.pack(pady=5)
+        ttk.Radiobutton(format_frame, text="Raw image", variable=format_var,
+                       value="raw").pack(side=tk.LEFT, padx=10)
+        ttk.Radiobutton(format_frame, text="Dynamic VHD", variable=format_var,
+                       value="vhd").pack(side=tk.LEFT, padx=10)
+        
         result = [False]  # Use list to store result (Python 3.x closure behavior)
         
         def on_ok():
@@ -187,9 +248,11 @@ class Win9xManager:
             return False
         
         hdd_size = size_var.get()
+        if format_var.get() == "vhd":
+            hdd_image = hdd_image.with_suffix(vhd.VHD_SUFFIX)
         
         # Call the core function to create the HDD image
-        return create_hdd_image(self.root, hdd_image, hdd_size)
+        return create_hdd_image(self.root, hdd_image, hdd_size, self.job_monitor)
     
     def start_windows(self):
         """Start Windows if installed"""
@@ -204,26 +267,270 @@ class Win9xManager:
             
             if not self.create_hdd_image():
                 return
+            hdd_image = self.get_current_hdd()
+        
+        # Resume at the desktop if a state was saved on the disk as it is
+        state = savestate.current_state(hdd_image, self.current_os.get())
         
         # Create autoexec content
-        autoexec = f"""
-# Mount the Windows HDD image as drive C
-imgmount c "{hdd_image}" -t hdd -fs fat
-# Mount the local directory as drive E
-mount e "{drive_dir}"
-boot c:
-"""
+        autoexec = render_autoexec(self.templates_dir, self.current_os.get(), hdd_image, drive_dir,
+                                   resume=state is not None)
+        
+        title = OS_TITLES[self.current_os.get()]
+        self._launch_dosbox(f"{title} (resumed)" if state else title, autoexec, hdd_image, state=state)
+    
+    def capture_state(self):
+        """Boot Windows to save a state that later starts resume from"""
+        hdd_image = self.get_current_hdd()
+        os_name = self.current_os.get()
+        
+        if not hdd_image.exists():
+            messagebox.showerror("Error", "HDD image not found.")
+            return
+        
+        if not messagebox.askokcancel("Save Desktop State",
+                                    "Windows will boot normally. Once the desktop is ready, choose "
+                                    "Save State in the DOSBox-X menu, then quit DOSBox-X straight "
+                                    "away without shutting Windows down.\n\n"
+                                    "Start Windows will then resume at the desktop until the disk "
+                                    "image changes."):
+            return
+        
+        # Held until the image is hashed, so the state matches what is recorded
+        lock = self._lock_image(hdd_image)
+        if lock is None:
+            return
+        
+        capture, started = savestate.begin_capture(hdd_image)
+        autoexec = render_autoexec(self.templates_dir, os_name, hdd_image, self.get_current_drive_dir())
+        process = self._launch_dosbox(f"{OS_TITLES[os_name]} (saving state)", autoexec, hdd_image,
+                                      on_exit=lambda process: self._finish_capture(hdd_image, os_name, started,
+                                                                                   lock, process),
+                                      lock=lock, overrides=savestate.savefile_overrides(capture))
+        if process is None:
+            lock.release()
+    
+    def _finish_capture(self, hdd_image, os_name, started, lock, process):
+        """Record the state saved while capturing, once DOSBox-X has exited"""
+        if process.state == FAILED:
+            lock.release()
+            messagebox.showerror("Error", f"DOSBox-X failed: {str(process.error)}")
+            return
+        
+        def capture_task(job):
+            try:
+                return savestate.finish_capture(hdd_image, os_name, started,
+                                                self.settings.getint('snapshots', 'workers'), job.progress)
+            finally:
+                lock.release()
+        
+        def on_success(state):
+            if state is None:
+                messagebox.showwarning("No State Saved",
+                                     "DOSBox-X exited without saving a state, Windows will boot as usual.")
+                return
+            messagebox.showinfo("Desktop State Saved", "Start Windows will now resume at the desktop.")
+        
+        def on_error(e):
+            messagebox.showerror("Error", f"Failed to record the saved state: {str(e)}")
+        
+        self.job_monitor.run("Recording saved state", capture_task, total=hdd_image.stat().st_size,
+                             on_success=on_success, on_error=on_error)
+    
+    def _lock_image(self, hdd_image):
+        """Lock a disk image for this manager, reporting if it is in use
+        
+        Returns:
+            ImageLock: The acquired lock, or None if the image is in use
+        """
+        lock = ImageLock(hdd_image)
+        try:
+            lock.acquire()
+        except ImageLockedError as e:
+            messagebox.showerror("Disk Image In Use", f"{str(e)}.\n\n"
+                                                      "Wait for it to finish, then try again.")
+            return None
+        return lock
+    
+    def _placement(self):
+        """Get the CPU pinning and priority of a new DOSBox-X instance from the settings
+        
+        Raises:
+            ValueError: If the [instances] settings are invalid
+        """
+        settings = self.settings['instances']
+        return self.supervisor.placement(settings.get('cpu_affinity'), settings.getint('cpus_per_instance'),
+                                         settings.getint('nice'), settings.get('ionice'))
+    
+    def _launch_dosbox(self, title, autoexec, hdd_image, on_exit=None, lock=None, overrides=None, state=None):
+        """Start DOSBox-X with a temporary config, without waiting for it
+        
+        The output of DOSBox-X is shown in a log window. The disk image is locked while
+        DOSBox-X runs, so no other instance or disk operation can use it.
+        
+        Args:
+            title: Description of the instance for its log window
+            autoexec: Content of the [autoexec] section
+            hdd_image: The disk image DOSBox-X runs on
+            on_exit: Optional function called with the EmulatorProcess once
+                DOSBox-X has exited or failed to start
+            lock: ImageLock the caller already holds on the disk image and
+                releases itself, instead of one held for the run only
+            overrides: Optional DOSBox-X options for this launch only, see
+                create_temp_config
+            state: Optional save state to resume from, with an autoexec
+                that doesn't boot
+        
+        Returns:
+            EmulatorProcess: The process, or None if it wasn't started
+        """
+        # Cached, so this only starts DOSBox-X if it changed since last time
+        emulator = check_requirements(report=lambda message: messagebox.showerror("Error", message),
+                                      configured=self.settings.get('emulator', 'path'))
+        if emulator is None:
+            return None
+        
+        try:
+            placement = self._placement()
+        except ValueError as e:
+            messagebox.showerror("Error", f"Invalid [instances] setting in {self.settings_conf}: {str(e)}")
+            return None
+        
+        own_lock = lock is None
+        if own_lock:
+            lock = self._lock_image(hdd_image)
+            if lock is None:
+                placement.release()
+                return None
+        
+        args = []
+        if state is not None:
+            state_overrides, args, _ = savestate.resume_options(emulator, state)
+            overrides = dict(overrides or {}, **state_overrides)
+        
+        # Rendered once, repeat launches reuse the cached config
+        try:
+            launch_conf = create_temp_config(self.dosbox_conf, autoexec, self.templates_dir, self.base_dir,
+                                             overrides, self.settings.get('performance', 'profile'))
+        except BaseException:
+            placement.release()
+            if own_lock:
+                lock.release()
+            raise
+        
+        # DOSBox-X inherits the lock, so the image stays locked until it exits
+        pass_fds = (lock.fileno(),) if lock.fileno() is not None else ()
+        return self.emulators.launch(title, emulator.command_line("-conf", launch_conf, *args),
+                                     on_exit=on_exit, cleanup=lock.release if own_lock else None,
+                                     placement=placement, pass_fds=pass_fds)
+    
+    def start_disposable(self):
+        """Start Windows on a throwaway copy of the disk image"""
+        hdd_image = self.get_current_hdd()
+        
+        if not hdd_image.exists():
+            messagebox.showerror("Error", "HDD image not found.")
+            return
+        
+        work_session = session.Session(hdd_image)
+        
+        self.job_monitor.run("Preparing disposable session",
+                             lambda job: work_session.start(progress=job.progress),
+                             total=hdd_image.stat().st_size,
+                             on_success=lambda _: self._run_session(work_session))
+    
+    def start_ram_session(self):
+        """Start Windows on a copy of the disk image in memory"""
+        hdd_image = self.get_current_hdd()
+        
+        if not hdd_image.exists():
+            messagebox.showerror("Error", "HDD image not found.")
+            return
         
-        # Create temporary config
-        temp_conf = create_temp_config(self.dosbox_conf, autoexec, self.templates_dir, self.base_dir)
+        ram_dir = session.ram_directory(self.settings.get('sessions', 'ram_dir'))
+        if ram_dir is None:
+            messagebox.showerror("Error", "No RAM disk found. Set ram_dir in the [sessions] section "
+                                          f"of {self.settings_conf} to a tmpfs directory.")
+            return
         
-        # Launch DOSBox-X with the config
         try:
-            subprocess.run(["dosbox-x", "-conf", temp_conf], check=True)
-        finally:
-            # Clean up temp config
-            if temp_conf.exists():
-                temp_conf.unlink()
+            work_session = session.ram_session(hdd_image, ram_dir)
+        except OSError as e:
+            messagebox.showerror("Error", f"Not enough memory for a RAM session: {str(e)}")
+            return
+        
+        workers = self.settings.getint('snapshots', 'workers')
+        
+        # The copy is hashed as it is made, so only it needs reading on exit
+        self.job_monitor.run("Copying disk image to memory",
+                             lambda job: work_session.start(hash_baseline=True, workers=workers,
+                                                            progress=job.progress),
+                             total=hdd_image.stat().st_size,
+                             on_success=lambda _: self._run_session(work_session, ask=False))
+    
+    def _run_session(self, work_session, ask=True):
+        """Start DOSBox-X on the working copy of a session, ending the session on exit
+        
+        Args:
+            work_session: The started session
+            ask: Ask whether to keep the changes, instead of always keeping them
+        """
+        drive_dir = self.get_current_drive_dir()
+        
+        # Create autoexec content
+        autoexec = render_autoexec(self.templates_dir, self.current_os.get(), work_session.work_image,
+                                   drive_dir)
+        
+        # The session holds the lock on the disk image until it ends
+        process = self._launch_dosbox("Disposable session" if ask else "RAM session", autoexec,
+                                      work_session.hdd_image,
+                                      on_exit=lambda process: self._end_session(work_session, process, ask),
+                                      lock=work_session.lock)
+        if process is None:
+            work_session.discard()
+    
+    def _end_session(self, work_session, process, ask):
+        """Commit or discard a session once DOSBox-X has exited
+        
+        Args:
+            work_session: The session
+            process: The EmulatorProcess that ran on the working copy
+            ask: Ask whether to keep the changes, instead of always keeping them
+        """
+        if process.state == FAILED:
+            work_session.discard()
+            messagebox.showerror("Error", f"DOSBox-X failed: {str(process.error)}\n\n"
+                                          "The disk image was left unchanged.")
+            return
+        
+        # The guest may have written to the disk whatever the exit status
+        if ask and not messagebox.askyesno("Session Ended",
+                                         "Keep the changes made in this session?\n\n"
+                                         "Choose No to throw them away and leave the disk image as "
+                                         "it was."):
+            work_session.discard()
+            return
+        
+        workers = self.settings.getint('snapshots', 'workers')
+        
+        def commit_task(job):
+            changed = work_session.changed_blocks(workers, job.progress)
+            job.set_total(job.total + 2 * len(changed) * work_session.block_size)
+            return work_session.commit(changed, workers, job.progress)
+        
+        def on_success(written):
+            # Writing back a RAM session is routine, only failures need attention
+            if ask:
+                messagebox.showinfo("Changes Kept",
+                                  f"{format_size(written)} of changed data written back to the disk image.")
+        
+        def on_error(e):
+            messagebox.showerror("Error", f"Failed to keep the changes: {str(e)}\n\n"
+                                          f"The session's copy is kept at {work_session.work_image}.")
+        
+        self.job_monitor.run("Keeping session changes" if ask else "Writing back session changes",
+                             commit_task, total=vhd.disk_size(work_session.work_image),
+                             on_success=on_success, on_error=on_error)
     
     def mount_iso(self):
         """Mount ISO and start Windows"""
@@ -236,6 +543,7 @@ boot c:
                                  "HDD image not found. Do you want to create one?"):
                 if not self.create_hdd_image():
                     return
+                hdd_image = self.get_current_hdd()
             else:
                 return
         
@@ -251,26 +559,9 @@ boot c:
             return
         
         # Create autoexec content
-        autoexec = f"""
-# Mount the Windows HDD image as drive C
-imgmount c "{hdd_image}" -t hdd -fs fat
-# Mount the ISO as drive D
-imgmount d "{iso_path}" -t iso
-# Mount the local directory as drive E
-mount e "{drive_dir}"
-boot c:
-"""
-        
-        # Create temporary config
-        temp_conf = create_temp_config(self.dosbox_conf, autoexec, self.templates_dir, self.base_dir)
+        autoexec = render_autoexec(self.templates_dir, self.current_os.get(), hdd_image, drive_dir, iso_path)
         
-        # Launch DOSBox-X with the config
-        try:
-            subprocess.run(["dosbox-x", "-conf", temp_conf], check=True)
-        finally:
-            # Clean up temp config
-            if temp_conf.exists():
-                temp_conf.unlink()
+        self._launch_dosbox(f"{Path(iso_path).name} mounted", autoexec, hdd_image)
     
     def boot_iso(self):
         """Boot from ISO to install Windows"""
@@ -282,6 +573,7 @@ boot c:
                                  "HDD image not found. Do you want to create one?"):
                 if not self.create_hdd_image():
                     return
+                hdd_image = self.get_current_hdd()
             else:
                 return
         
@@ -297,26 +589,10 @@ boot c:
             return
         
         # Create autoexec content for booting from ISO
-        autoexec = f"""
-# Mount the Windows HDD image as drive C
-imgmount c "{hdd_image}" -t hdd -fs fat
-# Mount the ISO as drive D
-imgmount d "{iso_path}" -t iso
-# Start the setup program
-d:
-setup.exe
-"""
-        
-        # Create temporary config
-        temp_conf = create_temp_config(self.dosbox_conf, autoexec, self.templates_dir, self.base_dir)
+        autoexec = render_autoexec(self.templates_dir, self.current_os.get(), hdd_image,
+                                   self.get_current_drive_dir(), iso_path, install=True)
         
-        # Launch DOSBox-X with the config
-        try:
-            subprocess.run(["dosbox-x", "-conf", temp_conf], check=True)
-        finally:
-            # Clean up temp config
-            if temp_conf.exists():
-                temp_conf.unlink()
+        self._launch_dosbox(f"Installing from {Path(iso_path).name}", autoexec, hdd_image)
     
     def format_disk(self):
         """Format hard disk image (creates a new one)"""
@@ -328,8 +604,15 @@ setup.exe
                                      "All data will be lost.\nDo you want to continue?"):
                 return
             
+            lock = self._lock_image(hdd_image)
+            if lock is None:
+                return
+            
             # Remove existing image
-            hdd_image.unlink()
+            try:
+                hdd_image.unlink()
+            finally:
+                lock.release()
         
         # Create new disk image
         if self.create_hdd_image():
@@ -352,37 +635,43 @@ setup.exe
         if not snapshot_name:
             return  # User cancelled
         
-        # Create valid filename
-        snapshot_name = ''.join(c if c.isalnum() or c in '_-' else '_' for c in snapshot_name)
-        
-        # Add timestamp
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        snapshot_file = snapshot_dir / f"{timestamp}_{snapshot_name}.img"
-        
-        # Show progress dialog
-        progress_window = tk.Toplevel(self.root)
-        progress_window.title("Creating Snapshot")
-        progress_window.geometry("400x100")
-        progress_window.transient(self.root)
-        progress_window.grab_set()
-        
-        ttk.Label(progress_window, text=f"Creating snapshot: {snapshot_name}...").pack(pady=10)
-        progress = ttk.Progressbar(progress_window, mode="indeterminate", length=300)
-        progress.pack(pady=10, padx=20)
-        progress.start()
-        
-        def copy_task():
-            try:
-                shutil.copy2(hdd_image, snapshot_file)
-                progress_window.destroy()
-                messagebox.showinfo("Snapshot Created", 
-                                  f"Snapshot '{snapshot_name}' created successfully.\n"
-                                  f"Location: {snapshot_file}")
-            except Exception as e:
-                progress_window.destroy()
-                messagebox.showerror("Error", f"Failed to create snapshot: {str(e)}")
-        
-        self.root.after(100, copy_task)
+        # Keep the name as typed as the snapshot note
+        snapshot_note = snapshot_name
+        
+        # Create valid filename, with a timestamp
+        snapshot_file_name = snapshot.snapshot_file_name(snapshot_name)
+        
+        # Record only the changes since the most recent manifest snapshot
+        parent = snapshot.latest_manifest(snapshot_dir)
+        
+        def snapshot_task(job):
+            # Locked, so a running DOSBox-X can't change the image while it is read
+            return run_locked(
+                hdd_image, snapshot.create_snapshot,
+                hdd_image, snapshot_dir, snapshot_file_name, parent=parent,
+                compression=self.settings.get('snapshots', 'compression'),
+                workers=self.settings.getint('snapshots', 'workers'),
+                reflink=self.settings.getboolean('snapshots', 'reflink'),
+                progress=job.progress, note=snapshot_note)
+        
+        def on_success(snapshot_file):
+            messagebox.showinfo("Snapshot Created", 
+                              f"Snapshot '{snapshot_name}' created successfully.\n"
+                              f"Location: {snapshot_file}")
+            
+            # Prune old snapshots quietly in the background
+            if self.settings.getboolean('retention', 'auto_prune'):
+                policy = retention.RetentionPolicy.from_settings(self.settings)
+                self.job_monitor.run("Pruning old snapshots",
+                                     lambda job: retention.apply_retention(snapshot_dir, policy),
+                                     show_dialog=False)
+        
+        def on_error(e):
+            messagebox.showerror("Error", f"Failed to create snapshot: {str(e)}")
+        
+        self.job_monitor.run(f"Creating snapshot {snapshot_name}", snapshot_task,
+                             total=vhd.disk_size(hdd_image),
+                             on_success=on_success, on_error=on_error)
     
     def restore_snapshot(self):
         """Restore a snapshot"""
@@ -390,62 +679,191 @@ setup.exe
         snapshot_dir = self.get_snapshot_dir()
         
         # Check if snapshots exist
-        snapshots = list(snapshot_dir.glob("*.img"))
-        if not snapshots:
+        with snapshot.open_catalog(snapshot_dir) as catalog:
+            records = catalog.list()
+        if not records:
             messagebox.showerror("Error", "No snapshots found.")
             return
         
         # Create snapshot selection dialog
         select_dialog = tk.Toplevel(self.root)
         select_dialog.title("Select Snapshot")
-        select_dialog.geometry("500x300")
+        select_dialog.geometry("700x350")
         select_dialog.transient(self.root)
-        select_dialog.grab_set()
+        
+        # No grab: verify and clean up jobs started from here show their own
+        # progress dialogs, which must stay usable
         
         ttk.Label(select_dialog, text="Select a snapshot to restore:").pack(pady=10)
         
-        # Create a listbox for snapshots
-        listbox_frame = ttk.Frame(select_dialog)
-        listbox_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
+        # Filter entry, matched against snapshot names and notes
+        filter_frame = ttk.Frame(select_dialog)
+        filter_frame.pack(fill=tk.X, padx=10)
+        ttk.Label(filter_frame, text="Filter:").pack(side=tk.LEFT)
+        filter_var = tk.StringVar()
+        ttk.Entry(filter_frame, textvariable=filter_var).pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
         
-        scrollbar = ttk.Scrollbar(listbox_frame)
+        # Create a table of snapshots
+        tree_frame = ttk.Frame(select_dialog)
+        tree_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
+        
+        scrollbar = ttk.Scrollbar(tree_frame)
         scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
         
-        snapshot_listbox = tk.Listbox(listbox_frame)
-        snapshot_listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        columns = {
+            'name': ("Name", 200),
+            'created': ("Created", 140),
+            'image_size': ("Size", 80),
+            'stored_size': ("Stored", 80),
+            'note': ("Note", 150),
+        }
+        snapshot_tree = ttk.Treeview(tree_frame, columns=list(columns), show="headings",
+                                     selectmode="browse")
+        snapshot_tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        
+        snapshot_tree.config(yscrollcommand=scrollbar.set)
+        scrollbar.config(command=snapshot_tree.yview)
+        
+        sort_state = {'column': 'created', 'descending': True}
+        records_by_name = {}
+        
+        def refresh(*args):
+            with snapshot.open_catalog(snapshot_dir) as catalog:
+                rows = catalog.list(order_by=sort_state['column'],
+                                    descending=sort_state['descending'],
+                                    search=filter_var.get().strip())
+            snapshot_tree.delete(*snapshot_tree.get_children())
+            records_by_name.clear()
+            for record in rows:
+                records_by_name[record['name']] = record
+                snapshot_tree.insert("", tk.END, iid=record['name'], values=(
+                    record['name'],
+                    (record['created'] or '').replace('T', ' '),
+                    format_size(record['image_size'] or 0),
+                    format_size(record['stored_size'] or 0),
+                    record['note'] or '',
+                ))
+        
+        def sort_by(column):
+            if sort_state['column'] == column:
+                sort_state['descending'] = not sort_state['descending']
+            else:
+                sort_state['column'] = column
+                sort_state['descending'] = False
+            refresh()
         
-        snapshot_listbox.config(yscrollcommand=scrollbar.set)
-        scrollbar.config(command=snapshot_listbox.yview)
+        for column, (heading, width) in columns.items():
+            snapshot_tree.heading(column, text=heading, command=lambda c=column: sort_by(c))
+            snapshot_tree.column(column, width=width)
         
-        # Add snapshots to listbox
-        snapshot_paths = []
-        for snap in snapshots:
-            snapshot_paths.append(snap)
-            snapshot_listbox.insert(tk.END, snap.name)
+        filter_var.trace_add("write", refresh)
+        refresh()
         
-        selected_index = [-1]  # Use list for closure
+        selected = [None]  # Use list for closure
         
         def on_select():
-            selected_index[0] = snapshot_listbox.curselection()
-            if selected_index[0]:
+            selection = snapshot_tree.selection()
+            if selection:
+                selected[0] = records_by_name[selection[0]]
                 select_dialog.destroy()
             
         def on_cancel():
-            selected_index[0] = -1
+            selected[0] = None
             select_dialog.destroy()
         
+        def on_delete():
+            selection = snapshot_tree.selection()
+            if not selection:
+                return
+            record = records_by_name[selection[0]]
+            if not messagebox.askyesno("Confirm Delete", f"Delete snapshot '{record['name']}'?",
+                                       parent=select_dialog):
+                return
+            
+            def on_deleted(_):
+                if select_dialog.winfo_exists():
+                    refresh()
+            
+            def on_error(e):
+                messagebox.showerror("Error", f"Failed to delete snapshot: {str(e)}")
+            
+            # Waits for snapshots being created, and frees the blocks only
+            # the deleted snapshot used
+            self.job_monitor.run(f"Deleting snapshot {record['name']}",
+                                 lambda job: retention.prune_snapshot(snapshot_dir / record['file']),
+                                 on_success=on_deleted, on_error=on_error)
+        
+        def on_clean_up():
+            policy = retention.RetentionPolicy.from_settings(self.settings)
+            
+            def on_planned(report):
+                if not report['pruned'] and not report['chunks']:
+                    messagebox.showinfo("Clean Up", "Nothing to clean up.", parent=select_dialog)
+                    return
+                if not messagebox.askyesno(
+                        "Clean Up",
+                        f"The retention policy would delete {len(report['pruned'])} snapshots "
+                        f"and free {format_size(report['bytes_freed'])}.\n\n"
+                        + "\n".join(report['pruned'][:15])
+                        + ("\n..." if len(report['pruned']) > 15 else "")
+                        + "\n\nContinue?", parent=select_dialog):
+                    return
+                
+                def on_pruned(report):
+                    refresh()
+                    messagebox.showinfo("Clean Up", f"Freed {format_size(report['bytes_freed'])}.",
+                                        parent=select_dialog)
+                
+                self.job_monitor.run("Pruning snapshots",
+                                     lambda job: retention.apply_retention(snapshot_dir, policy),
+                                     on_success=on_pruned)
+            
+            # Dry run first, to show what would go
+            self.job_monitor.run("Planning snapshot clean up",
+                                 lambda job: retention.apply_retention(snapshot_dir, policy, dry_run=True),
+                                 on_success=on_planned)
+        
+        def on_verify():
+            selection = snapshot_tree.selection()
+            if not selection:
+                return
+            record = records_by_name[selection[0]]
+            
+            def verify_task(job):
+                return snapshot.verify_snapshot(snapshot_dir / record['file'],
+                                                self.settings.getint('snapshots', 'workers'),
+                                                job.progress)
+            
+            def on_verified(bad_blocks):
+                self._report_verify_result(f"Snapshot '{record['name']}'", bad_blocks)
+            
+            self.job_monitor.run(f"Verifying snapshot {record['name']}", verify_task,
+                                 total=record['image_size'] or 0, on_success=on_verified)
+        
+        def on_browse():
+            selection = snapshot_tree.selection()
+            if not selection:
+                return
+            record = records_by_name[selection[0]]
+            self._open_browser(snapshot_dir / record['file'], f"Snapshot {record['name']}")
+        
         button_frame = ttk.Frame(select_dialog)
         button_frame.pack(fill=tk.X, pady=10)
-        ttk.Button(button_frame, text="Restore", command=on_select).pack(side=tk.LEFT, padx=20)
+        ttk.Button(button_frame, text="Restore", command=on_select).pack(side=tk.LEFT, padx=10)
+        ttk.Button(button_frame, text="Browse", command=on_browse).pack(side=tk.LEFT, padx=10)
+        ttk.Button(button_frame, text="Verify", command=on_verify).pack(side=tk.LEFT, padx=10)
+        ttk.Button(button_frame, text="Delete", command=on_delete).pack(side=tk.LEFT, padx=10)
+        ttk.Button(button_frame, text="Clean Up", command=on_clean_up).pack(side=tk.LEFT, padx=10)
         ttk.Button(button_frame, text="Cancel", command=on_cancel).pack(side=tk.RIGHT, padx=20)
         
         self.root.wait_window(select_dialog)
         
         # Check if user selected something
-        if selected_index[0] == -1 or not selected_index[0]:
+        if selected[0] is None:
             return
         
-        selected_snapshot = snapshot_paths[selected_index[0][0]]
+        selected_record = selected[0]
+        selected_snapshot = snapshot_dir / selected_record['file']
         
         # Confirm restore
         if not messagebox.askyesno("Confirm Restore", 
@@ -453,46 +871,232 @@ setup.exe
                                  "All unsaved changes will be lost.\n\nContinue?"):
             return
         
-        # Show progress dialog
-        progress_window = tk.Toplevel(self.root)
-        progress_window.title("Restoring Snapshot")
-        progress_window.geometry("400x100")
-        progress_window.transient(self.root)
-        progress_window.grab_set()
+        # Verifying first reads the snapshot once more
+        verify_first = self.settings.getboolean('snapshots', 'verify_before_restore')
+        total = selected_record['image_size'] * (2 if verify_first else 1)
         
-        ttk.Label(progress_window, text="Restoring snapshot...").pack(pady=10)
-        progress = ttk.Progressbar(progress_window, mode="indeterminate", length=300)
-        progress.pack(pady=10, padx=20)
-        progress.start()
+        def restore_task(job):
+            # The snapshot is checked first, then written next to the
+            # current image and swapped in atomically
+            run_locked(hdd_image, snapshot.restore_snapshot, selected_snapshot, hdd_image,
+                       workers=self.settings.getint('snapshots', 'workers'),
+                       progress=job.progress, verify=verify_first)
         
-        def restore_task():
-            try:
-                # Create backup of current image
-                backup_file = None
-                if hdd_image.exists():
-                    backup_file = hdd_image.with_suffix('.img.bak')
-                    shutil.copy2(hdd_image, backup_file)
-                
-                # Copy snapshot to disk image location
-                shutil.copy2(selected_snapshot, hdd_image)
-                
-                # Remove backup if restoration was successful
-                if backup_file and backup_file.exists():
-                    backup_file.unlink()
-                
-                progress_window.destroy()
-                messagebox.showinfo("Snapshot Restored", "Snapshot restored successfully.")
+        def on_success(_):
+            messagebox.showinfo("Snapshot Restored", "Snapshot restored successfully.")
+        
+        def on_error(e):
+            messagebox.showerror("Error", f"Failed to restore snapshot: {str(e)}\n\n"
+                                          "The current disk image was left untouched.")
+        
+        self.job_monitor.run("Restoring snapshot", restore_task, total=total,
+                             on_success=on_success, on_error=on_error)
+    
+    def _report_verify_result(self, what, bad_blocks):
+        """Show the outcome of an integrity check"""
+        if not bad_blocks:
+            messagebox.showinfo("Verification Passed", f"{what} is intact.")
+            return
+        
+        shown = ", ".join(str(block) for block in bad_blocks[:20])
+        if len(bad_blocks) > 20:
+            shown += ", ..."
+        messagebox.showerror("Verification Failed",
+                           f"{what} is corrupt: {len(bad_blocks)} blocks of "
+                           f"{format_size(snapshot.DEFAULT_BLOCK_SIZE)} differ.\n\n"
+                           f"Bad blocks: {shown}")
+    
+    def verify_disk(self):
+        """Check the current disk image against its integrity seal"""
+        hdd_image = self.get_current_hdd()
+        
+        if not hdd_image.exists():
+            messagebox.showerror("Error", "HDD image not found.")
+            return
+        
+        workers = self.settings.getint('snapshots', 'workers')
+        size = hdd_image.stat().st_size
+        
+        # The seal is only meaningful until Windows writes to the image again
+        seal_path = verify.tree_path(hdd_image)
+        try:
+            tree = verify.read_tree(seal_path)
+        except (OSError, ValueError):
+            tree = None
+        
+        if tree is None or tree.get('mtime') != hdd_image.stat().st_mtime:
+            if not messagebox.askyesno("No Integrity Seal",
+                                     "The disk image has no integrity seal, or Windows has changed it "
+                                     "since it was sealed.\n\nSeal the current contents now so later "
+                                     "checks can detect corruption?"):
+                return
             
-            except Exception as e:
-                progress_window.destroy()
-                messagebox.showerror("Error", f"Failed to restore snapshot: {str(e)}")
-                
-                # Try to restore backup
-                if backup_file and backup_file.exists() and not hdd_image.exists():
-                    shutil.copy2(backup_file, hdd_image)
-                    backup_file.unlink()
+            self.job_monitor.run("Sealing disk image",
+                                 lambda job: run_locked(hdd_image, verify.seal_image, hdd_image, workers,
+                                                        job.progress),
+                                 total=size,
+                                 on_success=lambda tree: messagebox.showinfo(
+                                     "Disk Image Sealed", "The disk image has been sealed."))
+            return
+        
+        def on_verified(bad_blocks):
+            self._report_verify_result("The disk image", bad_blocks)
+        
+        self.job_monitor.run("Verifying disk image",
+                             lambda job: run_locked(hdd_image, verify.verify_image, hdd_image, tree,
+                                                    workers=workers, progress=job.progress),
+                             total=size, on_success=on_verified)
+    
+    def browse_disk(self):
+        """Browse the files of the current disk image"""
+        hdd_image = self.get_current_hdd()
+        
+        if not hdd_image.exists():
+            messagebox.showerror("Error", "HDD image not found.")
+            return
+        
+        self._open_browser(hdd_image, f"Disk Image {hdd_image.name}", writable=not vhd.is_vhd(hdd_image))
+    
+    def compact_disk(self):
+        """Release the free space of the current disk image to the host"""
+        hdd_image = self.get_current_hdd()
+        
+        if not hdd_image.exists():
+            messagebox.showerror("Error", "HDD image not found.")
+            return
+        
+        if vhd.is_vhd(hdd_image):
+            messagebox.showinfo("Compact Disk Image",
+                              "Only raw disk images can be compacted. Convert the VHD to a raw "
+                              "image first.")
+            return
+        
+        def on_success(report):
+            freed = max(report['before'] - report['after'], 0)
+            if report['method'] == 'punch':
+                message = (f"Released {format_size(freed)}. The disk image now uses "
+                           f"{format_size(report['after'])} on the host.")
+            else:
+                message = ("The host file system can't release space inside files, so the free "
+                           "space was zeroed instead. Snapshots will skip it.")
+            messagebox.showinfo("Disk Image Compacted", message)
+        
+        self.job_monitor.run("Compacting disk image",
+                             lambda job: run_locked(hdd_image, compact.compact_image, hdd_image, job.progress),
+                             total=hdd_image.stat().st_size, on_success=on_success)
+    
+    def defragment_disk(self):
+        """Defragment the current disk image after showing its fragmentation"""
+        hdd_image = self.get_current_hdd()
+        
+        if not hdd_image.exists():
+            messagebox.showerror("Error", "HDD image not found.")
+            return
+        
+        if vhd.is_vhd(hdd_image):
+            messagebox.showinfo("Defragment Disk",
+                              "Only raw disk images can be defragmented. Convert the VHD to a raw "
+                              "image first.")
+            return
+        
+        def describe(stats):
+            return (f"{stats['fragmented']} of {stats['files']} files and directories fragmented "
+                    f"({stats['percent']:.1f}%), {stats['fragments']} fragments")
+        
+        def on_defragmented(report):
+            messagebox.showinfo("Defragmentation Complete",
+                                f"Before: {describe(report['before'])}\n"
+                                f"After: {describe(report['after'])}")
+        
+        def on_analyzed(result):
+            stats, used = result
+            if not stats['fragmented']:
+                messagebox.showinfo("Defragment Disk", f"No defragmentation needed.\n\n{describe(stats)}")
+                return
+            if not messagebox.askyesno("Defragment Disk",
+                                     f"{describe(stats)}.\n\nDefragmenting rewrites the used part of "
+                                     f"the disk image ({format_size(used)}) and needs that much free "
+                                     f"space on the host while it runs.\n\nDefragment now?"):
+                return
+            self.job_monitor.run("Defragmenting disk image",
+                                 lambda job: run_locked(hdd_image, defrag.defragment_image,
+                                                        hdd_image, job.progress),
+                                 total=used, on_success=on_defragmented)
+        
+        self.job_monitor.run("Analyzing disk image",
+                             lambda job: (defrag.analyze_image(hdd_image), defrag.used_size(hdd_image)),
+                             on_success=on_analyzed)
+    
+    def convert_disk(self):
+        """Convert the current disk image between raw and dynamic VHD"""
+        hdd_image = self.get_current_hdd()
+        
+        if not hdd_image.exists():
+            messagebox.showerror("Error", "HDD image not found.")
+            return
+        
+        target = "a raw image" if vhd.is_vhd(hdd_image) else "a dynamic VHD"
+        if not messagebox.askyesno("Convert Disk Image",
+                                 f"Convert {hdd_image.name} to {target}?\n\n"
+                                 "Only the data in use is copied. The current image is removed "
+                                 "once the conversion is complete."):
+            return
+        
+        def on_success(converted):
+            messagebox.showinfo("Disk Image Converted",
+                              f"The disk image is now {converted.name}, using "
+                              f"{format_size(compact.allocated_size(converted))} on the host.")
+        
+        def on_error(e):
+            messagebox.showerror("Error", f"Failed to convert the disk image: {str(e)}\n\n"
+                                          "The current disk image was left untouched.")
+        
+        self.job_monitor.run("Converting disk image",
+                             lambda job: run_locked(hdd_image, convert_image, hdd_image, job.progress),
+                             total=vhd.disk_size(hdd_image),
+                             on_success=on_success, on_error=on_error)
+    
+    def _open_browser(self, image_path, title, writable=False):
+        """Open a file browser window on a disk image or snapshot"""
+        try:
+            DiskBrowser(self.root, image_path, self.job_monitor, title, writable)
+        except (OSError, ValueError, fatfs.FatError, vhd.VhdError) as e:
+            messagebox.showerror("Error", f"Failed to read the disk image: {str(e)}")
+    
+    def calibrate_performance(self):
+        """Benchmark DOSBox-X and save the best CPU options as this host's profile"""
+        emulator = check_requirements(report=lambda message: messagebox.showerror("Error", message),
+                                      configured=self.settings.get('emulator', 'path'))
+        if emulator is None:
+            return
+        
+        if not messagebox.askokcancel("Calibrate Performance",
+                                    "DOSBox-X will run a short benchmark about a dozen times, which takes "
+                                    "a minute or two. Leave the computer otherwise idle meanwhile."):
+            return
+        
+        name = self.settings.get('performance', 'profile')
+        if name in ('', NO_PROFILE):
+            name = host_profile_name()
+        
+        def calibrate_task(job):
+            # Cancelling stops between two benchmark runs
+            calibrator = Calibrator(emulator, self.layout, progress=lambda measurement: job.check_cancelled())
+            options, details = calibrator.calibrate()
+            save_profile(self.layout.profiles_conf, name, options, details)
+            return options
+        
+        def on_success(options):
+            details = "\n".join(f"{option} = {value}" for option, value in options.items())
+            note = ("\n\nSet profile in the [performance] section of the settings to use it."
+                    if self.settings.get('performance', 'profile') == NO_PROFILE else "")
+            messagebox.showinfo("Calibration Done", f"Saved as profile {name}:\n\n{details}{note}")
+        
+        def on_error(e):
+            messagebox.showerror("Error", f"Calibration failed: {str(e)}")
         
-        self.root.after(100, restore_task)
+        self.job_monitor.run("Calibrating DOSBox-X performance", calibrate_task,
+                             on_success=on_success, on_error=on_error)
     
     def open_settings(self):
         """Open DOSBox-X settings editor"""
@@ -507,7 +1111,8 @@ setup.exe
         settings_dialog.grab_set()
         
         # Read current configuration
-        config = configparser.ConfigParser()
+        # DOSBox-X values such as "max 80%" aren't interpolation syntax
+        config = configparser.ConfigParser(interpolation=None)
         config.read(self.dosbox_conf)
         
         # Create a notebook for different configuration sections
@@ -3,9 +3,132 @@ Configuration utilities for Win9xManager
 """
 
 import configparser
-import string
+import os
+import tempfile
 from pathlib import Path
 
+from win9xman.utils.profiles import PROFILES_NAME, get_profile, profile_overrides
+from win9xman.utils.templates import RenderedCache, load_template, source_key
+
+RUNTIME_DIR_NAME = "win9xman"
+# Subdirectory of the runtime directory holding rendered launch configs
+CONFIGS_DIR_NAME = "configs"
+
+# Values of the DOSBox-X config template when dosbox.conf doesn't set them;
+# a performance profile replaces the CPU options at launch
+DEFAULT_CONFIG_VARS = {
+    'memsize': '64',
+    'cycles': 'max 80% limit 33000',
+    'machine': 'svga_s3',
+    'windowresolution': '1024x768',
+    'output': 'opengl',
+}
+
+# Run instead of booting when Windows resumes from a save state
+RESUME_COMMAND = "echo Resuming Windows from its saved state (Load State in the DOSBox-X menu)"
+
+# Defaults for the manager's own settings file (config/win9xman.conf)
+SETTINGS_DEFAULTS = {
+    'snapshots': {
+        # Compression codec for snapshot blocks: auto, none, zlib, lzma or zstd
+        'compression': 'auto',
+        # Worker threads for snapshot and restore, 0 means one per CPU core
+        'workers': '0',
+        # Check snapshots for corruption before restoring them
+        'verify_before_restore': 'yes',
+        # Clone the image copy-on-write where the file system supports it,
+        # instead of a compressed, deduplicated manifest
+        'reflink': 'yes',
+    },
+    'retention': {
+        # Prune old snapshots in the background after each new snapshot
+        'auto_prune': 'no',
+        # Snapshots to keep; 0 disables a rule
+        'keep_last': '10',
+        'keep_daily': '7',
+        'keep_weekly': '4',
+        # Cap on the total space used by the snapshots of one OS, in MB
+        'max_total_size': '0',
+    },
+    'sessions': {
+        # Directory RAM sessions copy the disk image to, on a tmpfs;
+        # empty picks /dev/shm where it exists
+        'ram_dir': '',
+    },
+    'emulator': {
+        # DOSBox-X binary to run; empty looks for dosbox-x on the PATH,
+        # then for the flatpak
+        'path': '',
+    },
+    'performance': {
+        # Profile of CPU options from config/profiles.conf applied to every
+        # launch; empty for the one calibrated for this host, none to use
+        # dosbox.conf as it is
+        'profile': '',
+    },
+    'instances': {
+        # CPUs each DOSBox-X instance is pinned to, e.g. 0-3 or 2,3; empty
+        # for no pinning, auto to give each instance CPUs of its own
+        'cpu_affinity': '',
+        # Number of CPUs each instance gets with cpu_affinity = auto
+        'cpus_per_instance': '1',
+        # Niceness added to DOSBox-X, 0 to run it at normal priority
+        'nice': '0',
+        # I/O scheduling class: idle, best-effort or realtime, optionally
+        # with a level such as best-effort:7; empty for the default
+        'ionice': '',
+    },
+}
+
+def load_settings(settings_path):
+    """Load the manager settings, falling back to defaults for missing values
+    
+    Args:
+        settings_path: Path to the settings file, which may not exist yet
+    
+    Returns:
+        configparser.ConfigParser: The merged settings
+    """
+    config = configparser.ConfigParser()
+    config.read_dict(SETTINGS_DEFAULTS)
+    config.read(settings_path)
+    return config
+
+def runtime_directory():
+    """Get the private directory for files that only live while DOSBox-X runs
+    
+    Uses $XDG_RUNTIME_DIR where it is set, the temporary directory otherwise.
+    
+    Returns:
+        Path: The directory, created readable by the current user only
+    """
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir and Path(runtime_dir).is_dir():
+        path = Path(runtime_dir) / RUNTIME_DIR_NAME
+    elif hasattr(os, 'getuid'):
+        # The shared temporary directory needs a name per user
+        path = Path(tempfile.gettempdir()) / f"{RUNTIME_DIR_NAME}-{os.getuid()}"
+    else:
+        path = Path(tempfile.gettempdir()) / RUNTIME_DIR_NAME
+    path.mkdir(mode=0o700, exist_ok=True)
+    
+    # Refuse a directory someone else made in our place
+    if hasattr(os, 'getuid') and path.stat().st_uid != os.getuid():
+        raise PermissionError(f"{path} belongs to another user")
+    return path
+
+def cache_directory():
+    """Get the directory for data the manager can recompute, like probe results
+    
+    Uses $XDG_CACHE_HOME where it is set, ~/.cache otherwise.
+    
+    Returns:
+        Path: The directory; it may not exist yet
+    """
+    cache_home = os.environ.get('XDG_CACHE_HOME')
+    base = Path(cache_home) if cache_home else Path.home() / ".cache"
+    return base / RUNTIME_DIR_NAME
+
 def create_default_template(templates_dir):
     """Create the default DOSBox-X template file"""
     template_path = templates_dir / "dosbox_template.conf"
@@ -103,19 +226,151 @@ def generate_config_from_template(templates_dir, template_name, output_path, var
     if not template_path.exists():
         raise FileNotFoundError(f"Template file {template_path} not found")
     
-    with open(template_path, 'r') as f:
-        template_content = f.read()
-    
-    # Use string.Template for variable substitution
-    template = string.Template(template_content)
+    # Compiled once, and again only when the template changes
+    template = load_template(template_path)
     output_content = template.safe_substitute(variables)
     
     # Write the output file
     with open(output_path, 'w') as f:
         f.write(output_content)
 
-def create_temp_config(dosbox_conf, autoexec_content, templates_dir, base_dir):
-    """Create a temporary DOSBox-X configuration file with custom autoexec section"""
+def windows_autoexec(hdd_image, drive_dir, iso_path=None, boot_command="boot c:"):
+    """Build the [autoexec] section that boots Windows from a disk image
+    
+    Args:
+        hdd_image: Disk image mounted as drive C
+        drive_dir: Host directory mounted as drive E
+        iso_path: Optional ISO mounted as drive D
+        boot_command: Command run once the drives are mounted
+    """
+    autoexec = f"""
+# Mount the Windows HDD image as drive C
+imgmount c "{hdd_image}" -t hdd -fs fat
+"""
+    if iso_path:
+        autoexec += f"""# Mount the ISO as drive D
+imgmount d "{iso_path}" -t iso
+"""
+    autoexec += f"""# Mount the local directory as drive E
+mount e "{drive_dir}"
+{boot_command}
+"""
+    return autoexec
+
+def setup_autoexec(hdd_image, iso_path):
+    """Build the [autoexec] section that runs Windows setup from an ISO
+    
+    Args:
+        hdd_image: Disk image to install to, mounted as drive C
+        iso_path: Installation ISO, mounted as drive D
+    """
+    return f"""
+# Mount the Windows HDD image as drive C
+imgmount c "{hdd_image}" -t hdd -fs fat
+# Mount the ISO as drive D
+imgmount d "{iso_path}" -t iso
+# Start the setup program
+d:
+setup.exe
+"""
+
+def render_autoexec(templates_dir, os_name, hdd_image, drive_dir, iso_path=None, install=False, resume=False):
+    """Build the [autoexec] section of a launch from the template of the OS
+    
+    Uses templates/<os>_autoexec_template.txt, whose ${hdd_image},
+    ${drive_dir}, ${iso_mount} and ${boot_command} are filled in, and the
+    built-in section when the OS has no template.
+    
+    Args:
+        templates_dir: Directory containing templates
+        os_name: win98 or win95
+        hdd_image: Disk image mounted as drive C
+        drive_dir: Host directory mounted as drive E
+        iso_path: Optional ISO mounted as drive D
+        install: Run Windows setup from the ISO instead of booting drive C
+        resume: Only mount the drives, for a save state to be loaded (see
+            win9xman.core.savestate)
+    """
+    boot_command = RESUME_COMMAND if resume else "boot c:"
+    template_path = templates_dir / f"{os_name}_autoexec_template.txt"
+    if not template_path.exists():
+        if install:
+            return setup_autoexec(hdd_image, iso_path)
+        return windows_autoexec(hdd_image, drive_dir, iso_path, boot_command)
+    
+    return load_template(template_path).safe_substitute({
+        'hdd_image': hdd_image,
+        'drive_dir': drive_dir,
+        'iso_mount': f'imgmount d "{iso_path}" -t iso' if iso_path else '',
+        'boot_command': "d:\nsetup.exe" if install else boot_command,
+    })
+
+def apply_overrides(content, overrides):
+    """Set options in the text of a DOSBox-X config
+    
+    Options already in their section get the new value, the others are added
+    at the end of their section, which is added if missing.
+    
+    Args:
+        content: Text of the config
+        overrides: Dict of section name to dict of option to value
+    
+    Returns:
+        str: The new text
+    """
+    pending = {section: dict(options) for section, options in overrides.items()}
+    lines = []
+    section = None
+    
+    def flush():
+        # Options of the section just ended that it didn't have, before
+        # the blank lines that end it
+        while lines and not lines[-1].strip():
+            lines.pop()
+        for option, value in pending.pop(section, {}).items():
+            lines.append(f"{option}={value}")
+        lines.append('')
+    
+    for line in content.split('\n'):
+        stripped = line.strip()
+        if stripped.startswith('[') and stripped.endswith(']'):
+            flush()
+            section = stripped[1:-1].strip().lower()
+        elif section in pending and '=' in stripped and not stripped.startswith('#'):
+            option = stripped.split('=', 1)[0].strip()
+            if option in pending[section]:
+                line = f"{option}={pending[section].pop(option)}"
+        lines.append(line)
+    flush()
+    
+    for section, options in pending.items():
+        lines.append(f"[{section}]")
+        lines.extend(f"{option}={value}" for option, value in options.items())
+        lines.append('')
+    return '\n'.join(lines).strip('\n') + '\n'
+
+def create_temp_config(dosbox_conf, autoexec_content, templates_dir, base_dir, overrides=None, profile=''):
+    """Get a DOSBox-X configuration file with custom autoexec section
+    
+    Configs are rendered into a cache in the runtime directory, named by the
+    hash of the base config and template versions, the overrides and the
+    autoexec section. Launching the same thing again reuses the rendered file
+    without parsing or writing anything. The file may be shared by several
+    launches, so the caller must not remove it; old configs are pruned.
+    
+    The CPU options of the performance profile (see win9xman.utils.profiles)
+    in profiles.conf next to the base config are applied automatically.
+    
+    Args:
+        overrides: Optional dict of section name to dict of options set for
+            this launch only, e.g. the save file of a save state; they take
+            precedence over the profile
+        profile: Name of the performance profile, empty for the one of this
+            host, NO_PROFILE for none
+    
+    Returns:
+        Path: The config
+    """
     # Make sure the base config exists
     if not dosbox_conf.exists():
         # Create default config
@@ -128,21 +383,25 @@ def create_temp_config(dosbox_conf, autoexec_content, templates_dir, base_dir):
             create_default_template(templates_dir)
         
         # Create config from template
-        template_vars = {
-            'memsize': '64',
-            'cycles': 'max 80% limit 33000',
-            'machine': 'svga_s3',
-            'windowresolution': '1024x768',
-            'output': 'opengl'
-        }
-        generate_config_from_template(templates_dir, 'dosbox_template.conf', dosbox_conf, template_vars)
-    
-    # Create a temp config based on current settings
-    temp_conf = base_dir / "temp_dosbox.conf"
+        generate_config_from_template(templates_dir, 'dosbox_template.conf', dosbox_conf, DEFAULT_CONFIG_VARS)
+    
+    template_path = templates_dir / "dosbox_template.conf"
+    cache = RenderedCache(runtime_directory() / CONFIGS_DIR_NAME, suffix=".conf")
+    selected = profile_overrides(get_profile(dosbox_conf.parent / PROFILES_NAME, profile))
+    for section, options in (overrides or {}).items():
+        selected[section] = dict(selected.get(section, {}), **options)
+    overrides = selected
+    key = cache.key(source_key(dosbox_conf), source_key(template_path),
+                    sorted((section, sorted(options.items())) for section, options in overrides.items()),
+                    autoexec_content)
+    cached = cache.get(key)
+    if cached:
+        return cached
     
     # Read current config to preserve settings
     current_config = {}
-    config = configparser.ConfigParser()
+    # DOSBox-X values such as "max 80%" aren't interpolation syntax
+    config = configparser.ConfigParser(interpolation=None)
     config.read(dosbox_conf)
     
     for section in config.sections():
@@ -151,21 +410,21 @@ def create_temp_config(dosbox_conf, autoexec_content, templates_dir, base_dir):
     
     # Generate the temporary config file from template
     template_vars = {
-        'memsize': current_config.get('dosbox', {}).get('memsize', '64'),
-        'cycles': current_config.get('cpu', {}).get('cycles', 'max 80% limit 33000'),
-        'machine': current_config.get('dosbox', {}).get('machine', 'svga_s3'),
-        'windowresolution': current_config.get('sdl', {}).get('windowresolution', '1024x768'),
-        'output': current_config.get('sdl', {}).get('output', 'opengl')
+        'memsize': current_config.get('dosbox', {}).get('memsize', DEFAULT_CONFIG_VARS['memsize']),
+        'cycles': current_config.get('cpu', {}).get('cycles', DEFAULT_CONFIG_VARS['cycles']),
+        'machine': current_config.get('dosbox', {}).get('machine', DEFAULT_CONFIG_VARS['machine']),
+        'windowresolution': current_config.get('sdl', {}).get('windowresolution',
+                                                             DEFAULT_CONFIG_VARS['windowresolution']),
+        'output': current_config.get('sdl', {}).get('output', DEFAULT_CONFIG_VARS['output'])
     }
     
-    # Create temp config
-    generate_config_from_template(templates_dir, 'dosbox_template.conf', temp_conf, template_vars)
-    
-    # Add autoexec section to the generated config
-    with open(temp_conf, 'a') as f:
-        f.write("\n[autoexec]\n")
-        for line in autoexec_content.split('\n'):
-            if line.strip():
-                f.write(f"{line}\n")
+    # Render the config from the template, with the autoexec section added
+    content = load_template(template_path).safe_substitute(template_vars)
+    if overrides:
+        content = apply_overrides(content, overrides)
+    content += "\n[autoexec]\n"
+    for line in autoexec_content.split('\n'):
+        if line.strip():
+            content += f"{line}\n"
     
-    return temp_conf
+    return cache.put(key, content)
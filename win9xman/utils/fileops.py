@@ -0,0 +1,256 @@
+"""
+File copy helpers for large, mostly sparse disk images
+"""
+
+import errno
+import functools
+import os
+import shutil
+import sys
+
+# ioctl request number of FICLONE (_IOW(0x94, 9, int)) on Linux
+FICLONE = 0x40049409
+
+# fallocate mode flags from linux/falloc.h
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Errors meaning "this file system can't do that", as opposed to real I/O errors
+_UNSUPPORTED_ERRNOS = {
+    errno.EOPNOTSUPP,
+    errno.ENOTTY,
+    errno.EINVAL,
+    errno.EXDEV,
+    errno.ENOSYS,
+    errno.EBADF,
+}
+
+
+def reflink_file(src, dst):
+    """Clone a file with a copy-on-write reflink (btrfs, XFS, ...)
+
+    The clone shares all data extents with the source and takes constant time
+    regardless of the file size.
+
+    Returns:
+        bool: True if the clone was made, False if reflinks are not supported
+    """
+    if not sys.platform.startswith('linux'):
+        return False
+
+    import fcntl
+
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return True
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED_ERRNOS:
+                raise
+
+    # Don't leave an empty file behind for the caller to trip over
+    os.unlink(dst)
+    return False
+
+
+@functools.lru_cache(maxsize=None)
+def _libc_fallocate():
+    """Get libc's fallocate with its argument types set, or None"""
+    if not sys.platform.startswith('linux'):
+        return None
+    import ctypes
+    import ctypes.util
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+        fallocate = libc.fallocate
+    except (OSError, AttributeError):
+        return None
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    fallocate.restype = ctypes.c_int
+    return fallocate
+
+
+def punch_hole(fd, offset, length):
+    """Deallocate a byte range of a file, which then reads back as zeros
+
+    The file size is unchanged. Partial file system blocks at either end are
+    zeroed instead of freed.
+
+    Returns:
+        bool: True if the range was punched, False if the platform or file
+        system doesn't support hole punching
+    """
+    fallocate = _libc_fallocate()
+    if fallocate is None:
+        return False
+    if fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, length) == 0:
+        return True
+
+    import ctypes
+    err = ctypes.get_errno()
+    if err in _UNSUPPORTED_ERRNOS:
+        return False
+    raise OSError(err, os.strerror(err))
+
+
+def iter_data_ranges(fd, size):
+    """Iterate over the (offset, length) ranges of a file that hold data
+
+    Holes are skipped using SEEK_DATA/SEEK_HOLE. When the platform or file
+    system doesn't support them the whole file is reported as data.
+    """
+    if not hasattr(os, 'SEEK_DATA'):
+        if size:
+            yield 0, size
+        return
+
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # No more data after offset
+                return
+            if e.errno in _UNSUPPORTED_ERRNOS:
+                yield offset, size - offset
+                return
+            raise
+        end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+        yield start, end - start
+        offset = end
+
+
+def intersect_ranges(ranges_a, ranges_b):
+    """Intersect two sorted lists of (offset, length) ranges"""
+    result = []
+    i = j = 0
+    while i < len(ranges_a) and j < len(ranges_b):
+        start = max(ranges_a[i][0], ranges_b[j][0])
+        end_a = ranges_a[i][0] + ranges_a[i][1]
+        end_b = ranges_b[j][0] + ranges_b[j][1]
+        end = min(end_a, end_b)
+        if start < end:
+            result.append((start, end - start))
+        if end_a < end_b:
+            i += 1
+        else:
+            j += 1
+    return result
+
+
+def iter_data_blocks(fd, image_size, block_size):
+    """Iterate over the indexes of the blocks that overlap allocated data"""
+    return range_blocks(iter_data_ranges(fd, image_size), block_size)
+
+
+def range_blocks(ranges, block_size):
+    """Iterate over the indexes of the blocks that overlap sorted (offset, length) ranges"""
+    next_index = 0
+    for offset, length in ranges:
+        first = max(offset // block_size, next_index)
+        last = (offset + length - 1) // block_size
+        yield from range(first, last + 1)
+        next_index = last + 1
+
+
+def copy_range(fd_in, fd_out, offset, length, progress=None, out_offset=None):
+    """Copy a byte range between two files
+
+    Args:
+        fd_in: File descriptor to read from
+        fd_out: File descriptor to write to
+        offset: Offset of the range in the input
+        length: Number of bytes to copy
+        progress: Optional callable receiving the number of bytes copied
+        out_offset: Offset to write at, the input offset by default
+    """
+    if out_offset is None:
+        out_offset = offset
+
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while length > 0:
+                copied = os.copy_file_range(fd_in, fd_out, min(length, COPY_CHUNK_SIZE), offset, out_offset)
+                if copied == 0:
+                    break
+                offset += copied
+                out_offset += copied
+                length -= copied
+                if progress:
+                    progress(copied)
+            if length == 0:
+                return
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED_ERRNOS:
+                raise
+
+    while length > 0:
+        data = os.pread(fd_in, min(length, COPY_CHUNK_SIZE), offset)
+        if not data:
+            break
+        os.pwrite(fd_out, data, out_offset)
+        offset += len(data)
+        out_offset += len(data)
+        length -= len(data)
+        if progress:
+            progress(len(data))
+
+
+def sparse_copy(src, dst, progress=None):
+    """Copy a file, preserving holes
+
+    Only the allocated ranges of the source are read and written; holes stay
+    holes in the destination. Data ranges go through copy_file_range where
+    available, which lets the kernel share extents or copy without a round
+    trip through user space.
+
+    Args:
+        src: Path of the file to copy
+        dst: Path of the copy
+        progress: Optional callable receiving the number of bytes processed,
+            holes included, so the total matches the file size
+    """
+    size = os.stat(src).st_size
+    copied = 0
+
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        fd_in = fsrc.fileno()
+        fd_out = fdst.fileno()
+        for offset, length in iter_data_ranges(fd_in, size):
+            if progress:
+                # Account for the hole skipped before this range
+                progress(offset - copied)
+            copy_range(fd_in, fd_out, offset, length, progress)
+            copied = offset + length
+        os.ftruncate(fd_out, size)
+
+    if progress:
+        progress(size - copied)
+
+
+def clone_file(src, dst, progress=None):
+    """Copy a disk image as cheaply as the file system allows
+
+    Tries a reflink clone first and falls back to a sparse-aware copy.
+    File metadata is copied like shutil.copy2 does.
+
+    Args:
+        src: Path of the file to copy
+        dst: Path of the copy
+        progress: Optional callable receiving the number of bytes processed
+
+    Returns:
+        bool: True if the copy was made with a reflink
+    """
+    reflinked = reflink_file(src, dst)
+    if reflinked:
+        if progress:
+            progress(os.path.getsize(src))
+    else:
+        sparse_copy(src, dst, progress)
+    shutil.copystat(src, dst)
+    return reflinked
@@ -0,0 +1,30 @@
+"""
+Thread pool helpers for block-parallel disk image processing
+"""
+
+import collections
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+
+def get_worker_count(workers=0):
+    """Get the number of worker threads to use, 0 meaning one per core"""
+    return workers if workers > 0 else (os.cpu_count() or 1)
+
+
+def parallel_map(func, items, workers=0):
+    """Map a function over items on a thread pool, yielding results in order
+
+    Only a few tasks per worker are in flight at any time, so memory stays
+    bounded and a consumer that stops early (for example because a job was
+    cancelled) doesn't wait for the whole input to be processed.
+    """
+    workers = get_worker_count(workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
@@ -0,0 +1,59 @@
+"""
+Locations of the files of Win9xManager, shared by the GUI and the command line
+"""
+
+from pathlib import Path
+
+from win9xman.core.vhd import VHD_SUFFIX
+from win9xman.utils.profiles import PROFILES_NAME
+
+OS_NAMES = ("win98", "win95")
+OS_TITLES = {"win98": "Windows 98", "win95": "Windows 95"}
+
+
+def default_base_dir():
+    """Get the directory holding win9xman.py and the manager's files"""
+    return Path(__file__).resolve().parent.parent.parent
+
+
+class Layout:
+    """The directories and files of a manager installation
+
+    Args:
+        base_dir: Base directory, the one of win9xman.py by default
+    """
+
+    def __init__(self, base_dir=None):
+        self.base_dir = Path(base_dir) if base_dir else default_base_dir()
+        self.templates_dir = self.base_dir / "templates"
+        self.config_dir = self.base_dir / "config"
+        self.dosbox_conf = self.config_dir / "dosbox.conf"
+        self.settings_conf = self.config_dir / "win9xman.conf"
+        self.profiles_conf = self.config_dir / PROFILES_NAME
+        self.iso_dir = self.base_dir / "iso"
+        self.img_dir = self.base_dir / "disks"
+
+    def raw_image(self, os_name):
+        """Get the path of the raw disk image of an OS"""
+        return self.img_dir / f"{os_name}.img"
+
+    def hdd_image(self, os_name):
+        """Get the disk image of an OS; a dynamic VHD takes the place of the raw image when there is one"""
+        raw_image = self.raw_image(os_name)
+        vhd_image = raw_image.with_suffix(VHD_SUFFIX)
+        return vhd_image if vhd_image.exists() else raw_image
+
+    def drive_dir(self, os_name):
+        """Get the host directory mounted as drive E for an OS"""
+        return self.base_dir / f"{os_name}_drive"
+
+    def snapshot_dir(self, os_name):
+        """Get the snapshot directory of an OS"""
+        return self.base_dir / ("snapshots" if os_name == "win98" else f"snapshots_{os_name}")
+
+    def directories(self):
+        """List the directories the manager needs"""
+        return ([self.drive_dir(os_name) for os_name in OS_NAMES]
+                + [self.iso_dir, self.img_dir]
+                + [self.snapshot_dir(os_name) for os_name in OS_NAMES]
+                + [self.config_dir, self.templates_dir])
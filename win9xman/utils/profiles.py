@@ -0,0 +1,108 @@
+"""
+Per-host DOSBox-X performance profiles
+
+A profile holds the CPU options found best for a host by calibration (see
+win9xman.core.calibrate): cycles, core and cputype. Profiles are kept in
+config/profiles.conf next to dosbox.conf, one section per profile, named
+after the host by default, so a manager directory shared between machines
+keeps one for each. Launch configs get the options of the active profile
+over those of dosbox.conf.
+"""
+
+import configparser
+import os
+import socket
+import threading
+
+from win9xman.utils.templates import source_key
+
+PROFILES_NAME = "profiles.conf"
+
+# DOSBox-X [cpu] options a profile sets
+PROFILE_OPTIONS = ('cycles', 'core', 'cputype')
+
+# Profile setting that turns profiles off
+NO_PROFILE = "none"
+
+# Parsed profile files by path: (source key, ConfigParser)
+_loaded = {}
+_loaded_lock = threading.Lock()
+
+
+def host_profile_name():
+    """Get the name of the profile of this host"""
+    return socket.gethostname().split('.')[0] or "default"
+
+
+def _load(path):
+    """Parse a profile file, again only if it changed since last time"""
+    try:
+        key = source_key(path)
+    except FileNotFoundError:
+        return None
+    with _loaded_lock:
+        cached = _loaded.get(key[0])
+    if cached and cached[0] == key:
+        return cached[1]
+
+    # Cycles such as "max 80%" aren't interpolation syntax
+    profiles = configparser.ConfigParser(interpolation=None)
+    profiles.read(path)
+    with _loaded_lock:
+        _loaded[key[0]] = (key, profiles)
+    return profiles
+
+
+def get_profile(path, name=''):
+    """Get the options of a profile
+
+    Args:
+        path: Profile file
+        name: Profile name, empty for the one of this host, NO_PROFILE for none
+
+    Returns:
+        dict: The [cpu] options of the profile, or None if there is no such profile
+    """
+    if name == NO_PROFILE:
+        return None
+    profiles = _load(path)
+    name = name or host_profile_name()
+    if profiles is None or not profiles.has_section(name):
+        return None
+    return {option: profiles[name][option] for option in PROFILE_OPTIONS if profiles[name].get(option)}
+
+
+def list_profiles(path):
+    """Get every profile of a file, with the details recorded by calibration
+
+    Returns:
+        dict: Profile name to dict of its values
+    """
+    profiles = _load(path)
+    if profiles is None:
+        return {}
+    return {name: dict(profiles[name]) for name in profiles.sections()}
+
+
+def save_profile(path, name, options, details=None):
+    """Store a profile, replacing any profile of the same name
+
+    Args:
+        path: Profile file
+        name: Profile name
+        options: The [cpu] options of the profile
+        details: Optional values recorded alongside, e.g. measurements
+    """
+    profiles = configparser.ConfigParser(interpolation=None)
+    profiles.read(path)
+    profiles[name] = dict(options, **(details or {}))
+
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, 'w') as f:
+        profiles.write(f)
+    os.replace(tmp_path, path)
+
+
+def profile_overrides(profile):
+    """Get the config overrides applying a profile, see create_temp_config"""
+    return {'cpu': dict(profile)} if profile else {}
@@ -2,23 +2,36 @@
 System-related utility functions for Win9xManager
 """
 
-import subprocess
-from tkinter import messagebox
-
-def check_requirements():
-    """Check if required programs are installed"""
-    # Check for DOSBox-X
-    try:
-        subprocess.run(['dosbox-x', '-version'], 
-                      stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
-        return True
-    except FileNotFoundError:
-        # Try with flatpak
-        try:
-            subprocess.run(['flatpak', 'run', 'com.dosbox_x.DOSBox-X', '-version'], 
-                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
-            return True
-        except FileNotFoundError:
-            messagebox.showerror("Error", "DOSBox-X is not installed or not in PATH.\n"
-                               "Please install DOSBox-X from https://dosbox-x.com/")
-            return False
+import sys
+
+from win9xman.core.resolver import resolve_emulator
+
+MISSING_DOSBOX_MESSAGE = ("DOSBox-X is not installed or not in PATH.\n"
+                          "Please install DOSBox-X from https://dosbox-x.com/")
+
+def _print_error(message):
+    """Report an error on stderr"""
+    print(f"Error: {message}", file=sys.stderr)
+
+def check_requirements(report=_print_error, configured=''):
+    """Check if required programs are installed
+
+    DOSBox-X is only started to probe it when it is new or has changed
+    since last time (see win9xman.core.resolver).
+
+    Args:
+        report: Called with the error message if something is missing;
+            prints it to stderr by default, the GUI shows it in a dialog
+        configured: DOSBox-X binary from the [emulator] settings, if any
+
+    Returns:
+        Emulator: The DOSBox-X installation to run, or None if missing
+    """
+    emulator = resolve_emulator(configured)
+    if emulator is None:
+        if configured:
+            report(f"The configured DOSBox-X binary {configured} was not found.\n"
+                   "Check the path setting in the [emulator] section.")
+        else:
+            report(MISSING_DOSBOX_MESSAGE)
+    return emulator
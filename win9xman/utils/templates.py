@@ -0,0 +1,127 @@
+"""
+Compiled templates and a cache of rendered files
+
+Templates are read and compiled once per process and only read again when
+their file changes. Rendered files, such as the DOSBox-X config of a launch,
+are kept in a directory under the hash of everything they were made from -
+the identity and modification time of their source files, and the values
+substituted - so rendering the same thing again reuses the file as it is.
+"""
+
+import hashlib
+import os
+import string
+import threading
+from pathlib import Path
+
+# Rendered files kept per cache directory, least recently used go first
+MAX_RENDERED = 32
+
+# Compiled templates by path: (source key, string.Template)
+_compiled = {}
+_compiled_lock = threading.Lock()
+
+
+def source_key(path):
+    """Identify the current version of a source file
+
+    Returns:
+        tuple: Path, modification time in ns and size, which change when the
+        file is edited
+
+    Raises:
+        FileNotFoundError: If the file doesn't exist
+    """
+    st = os.stat(path)
+    return (str(path), st.st_mtime_ns, st.st_size)
+
+
+def load_template(path):
+    """Get the compiled template of a file, reading it again only if it changed
+
+    Raises:
+        FileNotFoundError: If the template doesn't exist
+    """
+    key = source_key(path)
+    with _compiled_lock:
+        cached = _compiled.get(key[0])
+    if cached and cached[0] == key:
+        return cached[1]
+
+    with open(path, 'r') as f:
+        template = string.Template(f.read())
+    with _compiled_lock:
+        _compiled[key[0]] = (key, template)
+    return template
+
+
+class RenderedCache:
+    """Rendered files in a directory, named by the hash of their inputs
+
+    Args:
+        directory: Directory of the files, created if needed
+        suffix: File name suffix of the rendered files
+        max_entries: Number of files kept, the least recently used are
+            removed beyond that
+    """
+
+    def __init__(self, directory, suffix="", max_entries=MAX_RENDERED):
+        self.directory = Path(directory)
+        self.suffix = suffix
+        self.max_entries = max_entries
+
+    @staticmethod
+    def key(*inputs):
+        """Hash the inputs of a rendering, e.g. source keys and variables"""
+        return hashlib.sha256(repr(inputs).encode('utf-8')).hexdigest()[:32]
+
+    def path(self, key):
+        """Get the path of the rendered file of a key"""
+        return self.directory / f"{key}{self.suffix}"
+
+    def get(self, key):
+        """Get the rendered file of a key, or None if it isn't cached"""
+        path = self.path(key)
+        try:
+            # Mark it as recently used, so pruning keeps it
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key, content):
+        """Store a rendered file atomically
+
+        Returns:
+            Path: The path of the file
+        """
+        self.directory.mkdir(mode=0o700, parents=True, exist_ok=True)
+        path = self.path(key)
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            with open(tmp_path, 'w') as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if tmp_path.exists():
+                tmp_path.unlink()
+            raise
+        self.prune()
+        return path
+
+    def prune(self):
+        """Remove the least recently used files beyond max_entries"""
+        entries = []
+        for path in self.directory.glob(f"*{self.suffix}"):
+            if path.name.startswith('.'):
+                continue
+            try:
+                entries.append((path.stat().st_mtime, path))
+            except FileNotFoundError:
+                pass
+        entries.sort(reverse=True)
+        for _, path in entries[self.max_entries:]:
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass